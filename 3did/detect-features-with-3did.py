@@ -1,8 +1,6 @@
 import pandas as pd
 import numpy as np
 import peakutils
-from scipy import signal
-import math
 import os
 import time
 import argparse
@@ -17,8 +15,13 @@ import warnings
 from scipy.optimize import OptimizeWarning
 from sklearn.metrics.pairwise import cosine_similarity
 import shutil
-import alphatims.bruker
 
+# the library code shared between the scripts is in the repository's base directory
+TFDE_BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(1, TFDE_BASE_DIR)
+from core import raw_cache
+from core import isotope_model
+from core import peaks
 
 # determine the number of workers based on the number of available cores and the proportion of the machine to be used
 def number_of_workers():
@@ -26,113 +29,12 @@ def number_of_workers():
     number_of_workers = int(args.proportion_of_cores_to_use * number_of_cores)
     return number_of_workers
 
-# determine the maximum filter length for the number of points
-def find_filter_length(number_of_points):
-    filter_lengths = [51,11,5]  # must be a positive odd number, greater than the polynomial order, and less than the number of points to be filtered
-    return filter_lengths[next(x[0] for x in enumerate(filter_lengths) if x[1] < number_of_points)]
-
 # define a straight line to exclude the charge-1 cloud
 def scan_coords_for_single_charge_region(mz_lower, mz_upper):
     scan_for_mz_lower = max(int(-1 * ((1.2 * mz_lower) - 1252)), 0)
     scan_for_mz_upper = max(int(-1 * ((1.2 * mz_upper) - 1252)), 0)
     return {'scan_for_mz_lower':scan_for_mz_lower, 'scan_for_mz_upper':scan_for_mz_upper}
 
-# calculate the intensity-weighted centroid
-# takes a numpy array of intensity, and another of mz
-def intensity_weighted_centroid(_int_f, _x_f):
-    return ((_int_f/_int_f.sum()) * _x_f).sum()
-
-# find 3sigma for a specified m/z
-def calculate_peak_delta(mz):
-    delta_m = mz / INSTRUMENT_RESOLUTION  # FWHM of the peak
-    sigma = delta_m / 2.35482  # std dev is FWHM / 2.35482. See https://en.wikipedia.org/wiki/Full_width_at_half_maximum
-    peak_delta = 3 * sigma  # 99.7% of values fall within +/- 3 sigma
-    return peak_delta
-
-# peaks_a is a numpy array of [mz,intensity]
-# returns a numpy array of [intensity_weighted_centroid,summed_intensity]
-def intensity_descent(peaks_a, peak_delta=None):
-    # intensity descent
-    peaks_l = []
-    while len(peaks_a) > 0:
-        # find the most intense point
-        max_intensity_index = np.argmax(peaks_a[:,1])
-        peak_mz = peaks_a[max_intensity_index,0]
-        if peak_delta == None:
-            peak_delta = calculate_peak_delta(mz=peak_mz)
-        peak_mz_lower = peak_mz - peak_delta
-        peak_mz_upper = peak_mz + peak_delta
-
-        # get all the raw points within this m/z region
-        peak_indexes = np.where((peaks_a[:,0] >= peak_mz_lower) & (peaks_a[:,0] <= peak_mz_upper))[0]
-        if len(peak_indexes) > 0:
-            mz_cent = intensity_weighted_centroid(peaks_a[peak_indexes,1], peaks_a[peak_indexes,0])
-            summed_intensity = peaks_a[peak_indexes,1].sum()
-            peaks_l.append((mz_cent, summed_intensity))
-            # remove the raw points assigned to this peak
-            peaks_a = np.delete(peaks_a, peak_indexes, axis=0)
-    return np.array(peaks_l)
-
-# Find the ratio of H(peak_number)/H(peak_number-1) for peak_number=1..6
-# peak_number = 0 refers to the monoisotopic peak
-# number_of_sulphur = number of sulphur atoms in the molecule
-#
-# source: Valkenborg et al, "A Model-Based Method for the Prediction of the Isotopic Distribution of Peptides", https://core.ac.uk/download/pdf/82021511.pdf
-def peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur):
-    MAX_NUMBER_OF_SULPHUR_ATOMS = 3
-    MAX_NUMBER_OF_PREDICTED_RATIOS = 6
-
-    S0_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S0_r[1] = np.array([-0.00142320578040, 0.53158267080224, 0.00572776591574, -0.00040226083326, -0.00007968737684])
-    S0_r[2] = np.array([0.06258138406507, 0.24252967352808, 0.01729736525102, -0.00427641490976, 0.00038011211412])
-    S0_r[3] = np.array([0.03092092306220, 0.22353930450345, -0.02630395501009, 0.00728183023772, -0.00073155573939])
-    S0_r[4] = np.array([-0.02490747037406, 0.26363266501679, -0.07330346656184, 0.01876886839392, -0.00176688757979])
-    S0_r[5] = np.array([-0.19423148776489, 0.45952477474223, -0.18163820209523, 0.04173579115885, -0.00355426505742])
-    S0_r[6] = np.array([0.04574408690798, -0.05092121193598, 0.13874539944789, -0.04344815868749, 0.00449747222180])
-
-    S1_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S1_r[1] = np.array([-0.01040584267474, 0.53121149663696, 0.00576913817747, -0.00039325152252, -0.00007954180489])
-    S1_r[2] = np.array([0.37339166598255, -0.15814640001919, 0.24085046064819, -0.06068695741919, 0.00563606634601])
-    S1_r[3] = np.array([0.06969331604484, 0.28154425636993, -0.08121643989151, 0.02372741957255, -0.00238998426027])
-    S1_r[4] = np.array([0.04462649178239, 0.23204790123388, -0.06083969521863, 0.01564282892512, -0.00145145206815])
-    S1_r[5] = np.array([-0.20727547407753, 0.53536509500863, -0.22521649838170, 0.05180965157326, -0.00439750995163])
-    S1_r[6] = np.array([0.27169670700251, -0.37192045082925, 0.31939855191976, -0.08668833166842, 0.00822975581940])
-
-    S2_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S2_r[1] = np.array([-0.01937823810470, 0.53084210514216, 0.00580573751882, -0.00038281138203, -0.00007958217070])
-    S2_r[2] = np.array([0.68496829280011, -0.54558176102022, 0.44926662609767, -0.11154849560657, 0.01023294598884])
-    S2_r[3] = np.array([0.04215807391059, 0.40434195078925, -0.15884974959493, 0.04319968814535, -0.00413693825139])
-    S2_r[4] = np.array([0.14015578207913, 0.14407679007180, -0.01310480312503, 0.00362292256563, -0.00034189078786])
-    S2_r[5] = np.array([-0.02549241716294, 0.32153542852101, -0.11409513283836, 0.02617210469576, -0.00221816103608])
-    S2_r[6] = np.array([-0.14490868030324, 0.33629928307361, -0.08223564735018, 0.01023410734015, -0.00027717589598])
-
-    model_params = np.empty(MAX_NUMBER_OF_SULPHUR_ATOMS, dtype=np.ndarray)
-    model_params[0] = S0_r
-    model_params[1] = S1_r
-    model_params[2] = S2_r
-
-    ratio = None
-    if (((1 <= peak_number <= 3) & (((number_of_sulphur == 0) & (498 <= monoisotopic_mass <= 3915)) |
-                                    ((number_of_sulphur == 1) & (530 <= monoisotopic_mass <= 3947)) |
-                                    ((number_of_sulphur == 2) & (562 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 4) & (((number_of_sulphur == 0) & (907 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (939 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (971 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 5) & (((number_of_sulphur == 0) & (1219 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (1251 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (1283 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 6) & (((number_of_sulphur == 0) & (1559 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (1591 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (1623 <= monoisotopic_mass <= 3978))))):
-        beta0 = model_params[number_of_sulphur][peak_number][0]
-        beta1 = model_params[number_of_sulphur][peak_number][1]
-        beta2 = model_params[number_of_sulphur][peak_number][2]
-        beta3 = model_params[number_of_sulphur][peak_number][3]
-        beta4 = model_params[number_of_sulphur][peak_number][4]
-        scaled_m = monoisotopic_mass / 1000.0
-        ratio = beta0 + (beta1*scaled_m) + beta2*(scaled_m**2) + beta3*(scaled_m**3) + beta4*(scaled_m**4)
-    return ratio
-
 # calculate the cosine similarity of two peaks; each DF is assumed to have an 'x' column that reflects the x-axis values, and an 'intensity' column
 def measure_peak_similarity(isotopeA_df, isotopeB_df, x_label, scale):
     # scale the x axis so we can join them
@@ -153,7 +55,7 @@ def determine_isotope_characteristics(envelope, rt_apex, monoisotopic_mass, feat
         # gather the points that belong to this isotope
         iso_mz = isotope[0]
         iso_intensity = isotope[1]
-        iso_mz_delta = calculate_peak_delta(iso_mz)
+        iso_mz_delta = peaks.calculate_peak_delta(iso_mz, instrument_resolution=INSTRUMENT_RESOLUTION)
         iso_mz_lower = iso_mz - iso_mz_delta
         iso_mz_upper = iso_mz + iso_mz_delta
         isotope_df = feature_region_3d_df[(feature_region_3d_df.mz >= iso_mz_lower) & (feature_region_3d_df.mz <= iso_mz_upper)]
@@ -211,7 +113,7 @@ def determine_isotope_characteristics(envelope, rt_apex, monoisotopic_mass, feat
             Hpn = isotopes_df.iloc[unsaturated_idx].intensity
             for peak_number in reversed(range(1,unsaturated_idx+1)):
                 # calculate the phr for the next-lower peak
-                phr = peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
+                phr = isotope_model.peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
                 if phr is not None:
                     Hpn_minus_1 = Hpn / phr
                     isotopes_df.at[peak_number-1, 'inferred_intensity'] = int(Hpn_minus_1)
@@ -238,11 +140,6 @@ def determine_isotope_characteristics(envelope, rt_apex, monoisotopic_mass, feat
     result_d['voxels_processed'] = voxels_processed
     return result_d
 
-# calculate the monoisotopic mass    
-def calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge):
-    monoisotopic_mass = (monoisotopic_mz * charge) - (PROTON_MASS * charge)
-    return monoisotopic_mass
-
 # determine the voxels included by the raw points
 def voxels_for_points(points_df):
     # calculate the intensity contribution of the points to their voxel's intensity
@@ -279,11 +176,16 @@ def measure_curve(x, y):
         pass
     return r_squared
 
+# load the ms1 raw points for a segment from the run's raw data cache
+def load_segment(raw_d, segment_d):
+    return raw_cache.slice_points(raw_d, rt_lower=segment_d['rt_lower'], rt_upper=segment_d['rt_upper'], scan_lower=segment_d['scan_limit'], scan_upper=raw_d['scan_max_index']-1, frame_type=FRAME_TYPE_MS1, mz_lower=segment_d['mz_lower'], mz_upper=segment_d['mz_upper']+SEGMENT_EXTENSION)
+
 # process a segment of this run's data, and return a list of features
 @ray.remote
-def find_features(segment_d):
+def find_features(segment_d, raw_cache_dir):
     # segment_df = pd.read_pickle(segment_d['segment_name'])
-    segment_df = segment_d['segment_df'].copy()
+    raw_d = raw_cache.open_cache(raw_cache_dir)
+    segment_df = load_segment(raw_d, segment_d)
     segment_id = segment_d['segment_id']
     features_l = []
     if len(segment_df) > 0:
@@ -349,10 +251,10 @@ def find_features(segment_d):
 
                 # find the voxel's mz intensity-weighted centroid
                 points_a = voxel_points_df[['mz','intensity']].to_numpy()
-                voxel_mz_centroid = intensity_weighted_centroid(points_a[:,1], points_a[:,0])
+                voxel_mz_centroid = peaks.intensity_weighted_centroid(points_a[:,1], points_a[:,0])
 
                 # isolate the isotope's points in the m/z dimension; note the isotope may be offset so some of the points may be outside the voxel
-                iso_mz_delta = calculate_peak_delta(voxel_mz_centroid)
+                iso_mz_delta = peaks.calculate_peak_delta(voxel_mz_centroid, instrument_resolution=INSTRUMENT_RESOLUTION)
                 iso_mz_lower = voxel_mz_centroid - iso_mz_delta
                 iso_mz_upper = voxel_mz_centroid + iso_mz_delta
 
@@ -373,41 +275,12 @@ def find_features(segment_d):
                 scan_df.sort_values(by=['scan'], ascending=True, inplace=True)
                 if len(scan_df) >= MINIMUM_NUMBER_OF_SCANS_IN_BASE_PEAK:
 
-                    # apply a smoothing filter to the points
-                    scan_df['filtered_intensity'] = scan_df.intensity  # set the default
-                    try:
-                        scan_df['filtered_intensity'] = signal.savgol_filter(scan_df.intensity, window_length=find_filter_length(number_of_points=len(scan_df)), polyorder=SCAN_FILTER_POLY_ORDER)
-                    except:
-                        pass
-
-                    # find the peak(s)
-                    peak_x_l = []
-                    try:
-                        peak_idxs = peakutils.indexes(scan_df.filtered_intensity.values.astype(int), thres=PEAKS_THRESHOLD_SCAN, min_dist=PEAKS_MIN_DIST_SCAN, thres_abs=False)
-                        peak_x_l = scan_df.iloc[peak_idxs].scan.to_list()
-                    except:
-                        pass
-                    if len(peak_x_l) == 0:
-                        # if we couldn't find any peaks, take the maximum intensity point
-                        peak_x_l = [scan_df.loc[scan_df.filtered_intensity.idxmax()].scan]
-                    # peaks_df should now contain the rows from flattened_points_df that represent the peaks
-                    peaks_df = scan_df[scan_df.scan.isin(peak_x_l)].copy()
-
-                    # find the closest peak to the voxel highpoint
-                    peaks_df['delta'] = abs(peaks_df.scan - voxel_scan_midpoint)
-                    peaks_df.sort_values(by=['delta'], ascending=True, inplace=True)
-                    scan_apex = peaks_df.iloc[0].scan
-
-                    # find the valleys nearest the scan apex
-                    valley_idxs = peakutils.indexes(-scan_df.filtered_intensity.values.astype(int), thres=VALLEYS_THRESHOLD_SCAN, min_dist=VALLEYS_MIN_DIST_SCAN, thres_abs=False)
-                    valley_x_l = scan_df.iloc[valley_idxs].scan.to_list()
-                    valleys_df = scan_df[scan_df.scan.isin(valley_x_l)]
-
-                    upper_x = valleys_df[valleys_df.scan > scan_apex].scan.min()
-                    if math.isnan(upper_x):
+                    # find the peak closest to the voxel highpoint, and the valleys either side of it
+                    filtered_intensity_a, scan_apex, lower_x, upper_x = peaks.find_apex_and_valleys(scan_df.scan.to_numpy(), scan_df.intensity.to_numpy(), SCAN_FILTER_POLY_ORDER, PEAKS_THRESHOLD_SCAN, PEAKS_MIN_DIST_SCAN, VALLEYS_THRESHOLD_SCAN, VALLEYS_MIN_DIST_SCAN, reference_x=voxel_scan_midpoint)
+                    scan_df['filtered_intensity'] = filtered_intensity_a
+                    if upper_x is None:
                         upper_x = scan_apex + (SCAN_BASE_PEAK_WIDTH / 2)
-                    lower_x = valleys_df[valleys_df.scan < scan_apex].scan.max()
-                    if math.isnan(lower_x):
+                    if lower_x is None:
                         lower_x = scan_apex - (SCAN_BASE_PEAK_WIDTH / 2)
 
                     # mobility extent of the isotope
@@ -424,41 +297,13 @@ def find_features(segment_d):
                     rt_df = isotope_points_df.groupby(['frame_id','retention_time_secs'], as_index=False).intensity.sum()
                     rt_df.sort_values(by=['retention_time_secs'], ascending=True, inplace=True)
 
-                    # filter the points
-                    rt_df['filtered_intensity'] = rt_df.intensity  # set the default
-                    try:
-                        rt_df['filtered_intensity'] = signal.savgol_filter(rt_df.intensity, window_length=find_filter_length(number_of_points=len(rt_df)), polyorder=RT_FILTER_POLY_ORDER)
-                    except:
-                        pass
-
-                    # find the peak(s)
-                    peak_x_l = []
-                    try:
-                        peak_idxs = peakutils.indexes(rt_df.filtered_intensity.values.astype(int), thres=PEAKS_THRESHOLD_RT, min_dist=PEAKS_MIN_DIST_RT, thres_abs=False)
-                        peak_x_l = rt_df.iloc[peak_idxs].retention_time_secs.to_list()
-                    except:
-                        pass
-                    if len(peak_x_l) == 0:
-                        # if we couldn't find any peaks, take the maximum intensity point
-                        peak_x_l = [rt_df.loc[rt_df.filtered_intensity.idxmax()].retention_time_secs]
-                    # peaks_df should now contain the rows from flattened_points_df that represent the peaks
-                    peaks_df = rt_df[rt_df.retention_time_secs.isin(peak_x_l)].copy()
-
-                    # find the closest peak to the voxel highpoint
-                    peaks_df['delta'] = abs(peaks_df.retention_time_secs - voxel_rt_midpoint)
-                    peaks_df.sort_values(by=['delta'], ascending=True, inplace=True)
-                    rt_apex = peaks_df.iloc[0].retention_time_secs
-
-                    # find the valleys nearest the RT apex
-                    valley_idxs = peakutils.indexes(-rt_df.filtered_intensity.values.astype(int), thres=VALLEYS_THRESHOLD_RT, min_dist=VALLEYS_MIN_DIST_RT, thres_abs=False)
-                    valley_x_l = rt_df.iloc[valley_idxs].retention_time_secs.to_list()
-                    valleys_df = rt_df[rt_df.retention_time_secs.isin(valley_x_l)]
-
-                    upper_x = valleys_df[valleys_df.retention_time_secs > rt_apex].retention_time_secs.min()
-                    if math.isnan(upper_x):
+                    # find the peak closest to the voxel highpoint, and the valleys either side of it
+                    filtered_intensity_a, rt_apex, lower_x, upper_x = peaks.find_apex_and_valleys(rt_df.retention_time_secs.to_numpy(), rt_df.intensity.to_numpy(), RT_FILTER_POLY_ORDER, PEAKS_THRESHOLD_RT, PEAKS_MIN_DIST_RT, VALLEYS_THRESHOLD_RT, VALLEYS_MIN_DIST_RT, reference_x=voxel_rt_midpoint)
+                    rt_df['filtered_intensity'] = filtered_intensity_a
+                    rt_apex = np.float64(rt_apex)
+                    if upper_x is None:
                         upper_x = rt_apex + (RT_BASE_PEAK_WIDTH / 2)
-                    lower_x = valleys_df[valleys_df.retention_time_secs < rt_apex].retention_time_secs.max()
-                    if math.isnan(lower_x):
+                    if lower_x is None:
                         lower_x = rt_apex - (RT_BASE_PEAK_WIDTH / 2)
 
                     # RT extent of the isotope
@@ -510,7 +355,7 @@ def find_features(segment_d):
 
                         # intensity descent
                         raw_points_a = feature_region_3d_df[['mz','intensity']].to_numpy()
-                        peaks_a = intensity_descent(peaks_a=raw_points_a, peak_delta=None)
+                        peaks_a = peaks.intensity_descent(peaks_a=raw_points_a, instrument_resolution=INSTRUMENT_RESOLUTION, peak_delta=None, use_numba=args.use_numba)
 
                         # deconvolution - see https://mobiusklein.github.io/ms_deisotope/docs/_build/html/deconvolution/deconvolution.html
                         # returns a collection of DeconvolutedPeak (https://github.com/mobiusklein/ms_deisotope/blob/bce522a949579a5f54465eab24194eb5693f40ef/ms_deisotope/peak_set.py#L78) representing a single deconvoluted peak 
@@ -539,7 +384,7 @@ def find_features(segment_d):
                             for idx,feature in enumerate(deconvolution_features_df.itertuples()):
                                 feature_d = {}
                                 envelope_mono_mz = feature.envelope[0][0]
-                                mz_delta = calculate_peak_delta(mz=envelope_mono_mz)
+                                mz_delta = peaks.calculate_peak_delta(mz=envelope_mono_mz, instrument_resolution=INSTRUMENT_RESOLUTION)
                                 mono_mz_lower = envelope_mono_mz - mz_delta
                                 mono_mz_upper = envelope_mono_mz + mz_delta
                                 feature_d['mono_mz_lower'] = mono_mz_lower
@@ -563,7 +408,7 @@ def find_features(segment_d):
                                     if feature_d['isotope_count'] >= MINIMUM_NUMBER_OF_ISOTOPES:
                                         feature_d['monoisotopic_mz'] = feature.mono_mz
                                         feature_d['charge'] = feature.charge
-                                        feature_d['monoisotopic_mass'] = calculate_monoisotopic_mass_from_mz(monoisotopic_mz=feature_d['monoisotopic_mz'], charge=feature_d['charge'])
+                                        feature_d['monoisotopic_mass'] = peaks.calculate_monoisotopic_mass_from_mz(monoisotopic_mz=feature_d['monoisotopic_mz'], charge=feature_d['charge'], proton_mass=PROTON_MASS)
                                         feature_d['feature_intensity'] = isotope_characteristics_d['intensity_with_saturation_correction'] if (isotope_characteristics_d['intensity_with_saturation_correction'] > isotope_characteristics_d['intensity_without_saturation_correction']) else isotope_characteristics_d['intensity_without_saturation_correction']
                                         feature_d['deconvolution_envelope'] = json.dumps([tuple(e) for e in feature.envelope])
                                         feature_d['deconvolution_score'] = feature.score
@@ -627,6 +472,7 @@ parser.add_argument('-minvi','--minimum_voxel_intensity', type=int, default='250
 parser.add_argument('-ini','--ini_file', type=str, default='./tfde/pipeline/pasef-process-short-gradient.ini', help='Path to the config file.', required=False)
 parser.add_argument('-rm','--ray_mode', type=str, choices=['local','cluster'], help='The Ray mode to use.', required=True)
 parser.add_argument('-pc','--proportion_of_cores_to_use', type=float, default=0.9, help='Proportion of the machine\'s cores to use for this program.', required=False)
+parser.add_argument('-nb','--use_numba', action='store_true', help='Use the numba-compiled kernel for intensity descent.')
 parser.add_argument('-v','--verbose', action='store_true', help='Print more information during processing.')
 args = parser.parse_args()
 
@@ -651,6 +497,11 @@ if not os.path.exists(RAW_DATABASE_NAME):
     print("The raw database is required but doesn't exist: {}".format(RAW_DATABASE_NAME))
     sys.exit(1)
 
+# check numba is available if it's needed
+if args.use_numba and not peaks.NUMBA_AVAILABLE:
+    print("The numba intensity descent kernel was requested but numba is not installed.")
+    sys.exit(1)
+
 # check the INI file exists
 if not os.path.isfile(args.ini_file):
     print("The configuration file doesn't exist: {}".format(args.ini_file))
@@ -735,33 +586,22 @@ os.makedirs(SUMMARY_DIR)
 # set up Ray
 print("setting up Ray")
 if not ray.is_initialized():
+    # the workers need to import the shared library code
+    os.environ['PYTHONPATH'] = os.pathsep.join([TFDE_BASE_DIR] + ([os.environ['PYTHONPATH']] if 'PYTHONPATH' in os.environ else []))
     if args.ray_mode == "cluster":
         ray.init(num_cpus=number_of_workers())
     else:
         ray.init(local_mode=True)
 
-# load the raw database
-RAW_HDF_FILE = '{}.hdf'.format(args.run_name)
-RAW_HDF_PATH = '{}/{}'.format(RAW_DATABASE_BASE_DIR, RAW_HDF_FILE)
-if not os.path.isfile(RAW_HDF_PATH):
-    print('{} doesn\'t exist so loading the raw data from {}'.format(RAW_HDF_PATH, RAW_DATABASE_NAME))
-    data = alphatims.bruker.TimsTOF(RAW_DATABASE_NAME)
-    print('saving to {}'.format(RAW_HDF_PATH))
-    _ = data.save_as_hdf(
-        directory=RAW_DATABASE_BASE_DIR,
-        file_name=RAW_HDF_FILE,
-        overwrite=True
-    )
-else:
-    print('loading raw data from {}'.format(RAW_HDF_PATH))
-    data = alphatims.bruker.TimsTOF(RAW_HDF_PATH)
+# make sure the run's raw data cache exists; the workers memory-map it and slice their segment's points from it
+RAW_CACHE_DIR = raw_cache.convert_raw(RAW_DATABASE_BASE_DIR, args.run_name)
+print('using the raw data cache {}'.format(RAW_CACHE_DIR))
 
 # calculate the segments
 mz_range = args.mz_upper - args.mz_lower
 NUMBER_OF_MZ_SEGMENTS = (mz_range // args.mz_width_per_segment) + (mz_range % args.mz_width_per_segment > 0)  # thanks to https://stackoverflow.com/a/23590097/1184799
 
-# split the raw data into segments
-print('segmenting the raw data')
+# define the segments
 segment_packages_l = []
 for i in range(NUMBER_OF_MZ_SEGMENTS):
     mz_lower=float(args.mz_lower+(i*args.mz_width_per_segment))
@@ -770,32 +610,11 @@ for i in range(NUMBER_OF_MZ_SEGMENTS):
     rt_upper=float(args.rt_upper)
     scan_limit = scan_coords_for_single_charge_region(mz_lower=mz_lower, mz_upper=mz_upper)['scan_for_mz_upper']
     segment_id=i+1
-    # extract the raw points for this segment
-    segment_df = data[
-        {
-            "rt_values": slice(rt_lower, rt_upper),
-            "mz_values": slice(mz_lower, mz_upper+SEGMENT_EXTENSION),
-            "scan_indices": slice(scan_limit, None),
-            "precursor_indices": 0,
-        }
-    ][['mz_values','scan_indices','frame_indices','rt_values','intensity_values']]
-    segment_df.rename(columns={'mz_values':'mz', 'scan_indices':'scan', 'frame_indices':'frame_id', 'rt_values':'retention_time_secs', 'intensity_values':'intensity'}, inplace=True)
-    # downcast the data types to minimise the memory used
-    int_columns = ['frame_id','scan','intensity']
-    segment_df[int_columns] = segment_df[int_columns].apply(pd.to_numeric, downcast="unsigned")
-    float_columns = ['retention_time_secs']
-    segment_df[float_columns] = segment_df[float_columns].apply(pd.to_numeric, downcast="float")    
-    # save the segment
-    # segment_name = '{}/segment-{}.pkl'.format(SEGMENTS_DIR, segment_id)
-    # segment_df.to_pickle(segment_name)
-    # segment_packages_l.append({'mz_lower':mz_lower, 'mz_upper':mz_upper, 'rt_lower':rt_lower, 'rt_upper':rt_upper, 'scan_limit':scan_limit, 'segment_id':segment_id, 'segment_name':segment_name})
-    segment_packages_l.append({'mz_lower':mz_lower, 'mz_upper':mz_upper, 'rt_lower':rt_lower, 'rt_upper':rt_upper, 'scan_limit':scan_limit, 'segment_id':segment_id, 'segment_df':segment_df})
-del data
+    segment_packages_l.append({'mz_lower':mz_lower, 'mz_upper':mz_upper, 'rt_lower':rt_lower, 'rt_upper':rt_upper, 'scan_limit':scan_limit, 'segment_id':segment_id})
 
 # find all the features
 print('finding features')
-interim_names_l = ray.get([find_features.remote(segment_d=sp) for sp in segment_packages_l])
-# interim_names_l = [find_features(segment_d=sp) for sp in segment_packages_l]
+interim_names_l = ray.get([find_features.remote(segment_d=sp, raw_cache_dir=RAW_CACHE_DIR) for sp in segment_packages_l])
 segment_packages_l = None
 
 # join the list of dataframes into a single dataframe
@@ -0,0 +1 @@
+# library code shared by the pipeline and 3did scripts
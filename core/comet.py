@@ -0,0 +1,83 @@
+import os
+import shutil
+import json
+
+# A run's MGF can be searched as several shards, each by its own Comet process, and their outputs merged into the
+# files a search of the whole MGF would have produced. Each shard is searched in its own directory with the same MGF
+# file name and fileroot as the whole run, so the shards' outputs have the same names, and the PSM IDs Comet derives
+# from the MGF's name are the same as they would be for the whole run.
+
+# the first column of the header line of Comet's tabular outputs; the Percolator input, and the text output
+HEADER_COLUMNS = ['SpecId', 'scan']
+
+# the most lines before the results of a tabular output
+MAXIMUM_HEADER_LINES = 5
+
+# the number of leading lines of a tabular output before its results: up to and including the line of column names,
+# and the line of Percolator's default direction if there is one. Comet's text output has a line with its version
+# before the column names.
+def number_of_header_lines(file_name):
+    with open(file_name, 'r') as handle:
+        first_columns_l = [handle.readline().split('\t', 1)[0].strip() for _ in range(MAXIMUM_HEADER_LINES)]
+    header_idxs_l = [idx for idx,column in enumerate(first_columns_l) if column in HEADER_COLUMNS]
+    if len(header_idxs_l) == 0:
+        return 1
+    number_of_lines = header_idxs_l[0] + 1
+    if (number_of_lines < MAXIMUM_HEADER_LINES) and (first_columns_l[number_of_lines] == 'DefaultDirection'):
+        number_of_lines += 1
+    return number_of_lines
+
+# join the shards' tabular outputs into one, keeping the header of the first
+def merge_tabular_outputs(shard_files_l, output_file):
+    header_lines = number_of_header_lines(shard_files_l[0])
+    temp_output_file = '{}-tmp-{}'.format(output_file, os.getpid())
+    with open(temp_output_file, 'w', buffering=1024*1024) as output_handle:
+        for shard_idx,shard_file in enumerate(shard_files_l):
+            with open(shard_file, 'r') as shard_handle:
+                for line_idx,line in enumerate(shard_handle):
+                    if (shard_idx == 0) or (line_idx >= header_lines):
+                        output_handle.write(line)
+    os.replace(temp_output_file, output_file)
+
+# merge the outputs of the shards' searches into the output directory. The tabular outputs are joined in shard order,
+# the parameters are taken from the first shard, and the logs are concatenated. Returns the names of the merged files.
+def merge_shard_outputs(shard_dirs_l, output_dir):
+    merged_l = []
+    for output_name in sorted(os.listdir(shard_dirs_l[0])):
+        shard_files_l = ['{}/{}'.format(d, output_name) for d in shard_dirs_l]
+        if not all(os.path.isfile(f) for f in shard_files_l):
+            continue
+        output_file = '{}/{}'.format(output_dir, output_name)
+        if output_name.endswith('.log.txt'):
+            with open(output_file, 'wb') as output_handle:
+                for shard_file in shard_files_l:
+                    with open(shard_file, 'rb') as shard_handle:
+                        shutil.copyfileobj(shard_handle, output_handle)
+        elif output_name.endswith('.params.txt'):
+            shutil.copyfile(shard_files_l[0], output_file)
+        elif output_name.endswith('.pin') or output_name.endswith('.txt'):
+            merge_tabular_outputs(shard_files_l, output_file)
+        else:
+            continue
+        merged_l.append(output_name)
+    return merged_l
+
+# Each search writes a sidecar next to its Percolator input, recording the run it's for, so the run of each of
+# Percolator's input files doesn't have to be worked out from the file's name or Percolator's log.
+
+# the sidecar of a search's output
+def sidecar_path(output_file):
+    return '{}.json'.format(output_file)
+
+# record the run the search output is for
+def write_sidecar(output_file, run_name, mgf_file, param_file):
+    with open(sidecar_path(output_file), 'w') as handle:
+        json.dump({'run_name':run_name, 'output_file':os.path.basename(output_file), 'mgf_file':mgf_file, 'param_file':param_file}, handle)
+
+# the run the search output is for. The outputs of searches from before the sidecars were written are named for
+# their run, e.g. 190719_Hela_Ecoli_1to3_06.comet.pin.
+def run_name_of_output(output_file):
+    if os.path.isfile(sidecar_path(output_file)):
+        with open(sidecar_path(output_file), 'r') as handle:
+            return json.load(handle)['run_name']
+    return os.path.basename(output_file).split('.')[0]
@@ -0,0 +1,103 @@
+import numpy as np
+import os
+import hashlib
+import pickle
+from collections import OrderedDict
+
+# Deconvolving a peak list is the most expensive step of the feature detection, and when the precursor cuboids overlap
+# the same peaks are deconvolved more than once. The results are cached under a fingerprint of the peak list and the
+# deconvolution parameters. Each worker process holds the most recently used results in memory, and if a cache
+# directory is given the results are also stored there as a pickle file each, so they're shared between the workers
+# and reused when the detection is run again.
+
+CACHE_VERSION = 1
+MAXIMUM_ENTRIES_IN_MEMORY = 20000
+
+# the peak lists are rounded before they're fingerprinted, so floating point noise in the intensity descent doesn't
+# cause a miss
+MZ_DECIMALS = 6
+INTENSITY_DECIMALS = 1
+
+# the caches opened in this process, by directory
+_caches_d = {}
+
+# fingerprint a peak list, a numpy array of [mz,intensity], and the parameters used to deconvolve it
+def fingerprint(peaks_a, params_d):
+    peaks_a = np.asarray(peaks_a, dtype=np.float64).reshape(-1, 2)
+    rounded_a = np.column_stack((np.round(peaks_a[:,0], MZ_DECIMALS), np.round(peaks_a[:,1], INTENSITY_DECIMALS)))
+    h = hashlib.sha1()
+    h.update(repr((CACHE_VERSION, sorted(params_d.items()))).encode('utf-8'))
+    h.update(np.ascontiguousarray(rounded_a).tobytes())
+    return h.hexdigest()
+
+# a cache of deconvolution results, held in memory and optionally in a directory
+class DeconvolutionCache:
+    def __init__(self, cache_dir=None, maximum_entries=MAXIMUM_ENTRIES_IN_MEMORY):
+        self.cache_dir = cache_dir
+        self.maximum_entries = maximum_entries
+        self.entries_d = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if (cache_dir is not None) and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    # the location of a result in the cache directory; it's split by the key's prefix so no directory gets too large
+    def entry_path(self, key):
+        return '{}/{}/{}.pkl'.format(self.cache_dir, key[:2], key)
+
+    # return the cached result for the key, or None if it's not in the cache
+    def get(self, key):
+        if key in self.entries_d:
+            self.entries_d.move_to_end(key)
+            self.hits += 1
+            return self.entries_d[key]
+        if self.cache_dir is not None:
+            try:
+                with open(self.entry_path(key), 'rb') as handle:
+                    result = pickle.load(handle)
+                self.remember(key, result)
+                self.hits += 1
+                return result
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+        self.misses += 1
+        return None
+
+    # add a result to the cache
+    def put(self, key, result):
+        self.remember(key, result)
+        if self.cache_dir is not None:
+            # write it to a temporary name and rename it, so a reader never sees a partial file
+            file_name = self.entry_path(key)
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            temp_file_name = '{}-tmp-{}'.format(file_name, os.getpid())
+            with open(temp_file_name, 'wb') as handle:
+                pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_file_name, file_name)
+
+    # hold the result in memory, discarding the least recently used when the cache is full
+    def remember(self, key, result):
+        self.entries_d[key] = result
+        self.entries_d.move_to_end(key)
+        while len(self.entries_d) > self.maximum_entries:
+            self.entries_d.popitem(last=False)
+
+    # the hit and miss counts so far
+    def counts(self):
+        return {'hits':self.hits, 'misses':self.misses}
+
+# open the cache for the directory, or the in-memory cache if the directory is None. The same cache is returned for
+# each call in a process, so the results are kept between the tasks a worker runs.
+def open_cache(cache_dir=None):
+    if cache_dir not in _caches_d:
+        _caches_d[cache_dir] = DeconvolutionCache(cache_dir)
+    return _caches_d[cache_dir]
+
+# look up the result of deconvolving the peak list, calling deconvolve(peaks_a) to compute it on a miss
+def cached_deconvolution(cache, peaks_a, params_d, deconvolve):
+    key = fingerprint(peaks_a, params_d)
+    result = cache.get(key)
+    if result is None:
+        result = deconvolve(peaks_a)
+        cache.put(key, result)
+    return result
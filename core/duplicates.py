@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+# find the features to keep, taking them in order and treating as duplicates the features within the tolerances of each kept feature
+# features_df must have the dup_* columns, and be sorted in order of preference; if verbose, the duplicates found are printed
+def find_features_to_keep(features_df, mz_tolerance_percent, verbose=False):
+    charge_a = features_df.charge.to_numpy()
+    mz_a = features_df.dup_mz.to_numpy()
+    mz_lower_a = features_df.dup_mz_lower.to_numpy()
+    mz_upper_a = features_df.dup_mz_upper.to_numpy()
+    scan_a = features_df.scan_apex.to_numpy()
+    scan_lower_a = features_df.dup_scan_lower.to_numpy()
+    scan_upper_a = features_df.dup_scan_upper.to_numpy()
+    rt_a = features_df.rt_apex.to_numpy()
+    rt_lower_a = features_df.dup_rt_lower.to_numpy()
+    rt_upper_a = features_df.dup_rt_upper.to_numpy()
+    feature_id_a = features_df.feature_id.to_numpy()
+    feature_codes_a,_ = pd.factorize(features_df.feature_id)
+
+    # index the features by charge and then m/z, so the candidate duplicates of every feature can be found with a binary search
+    index_order_a = np.lexsort((mz_a, charge_a))
+    index_charge_a = charge_a[index_order_a]
+    index_mz_a = mz_a[index_order_a]
+    # the tolerance is relative to each candidate's m/z, so widen the search and apply the exact tolerances to the candidates
+    search_tolerance = 2 * mz_tolerance_percent / 100
+    candidates_lower_a = np.zeros(len(features_df), dtype=np.int64)
+    candidates_upper_a = np.zeros(len(features_df), dtype=np.int64)
+    for charge in np.unique(charge_a):
+        charge_lower = np.searchsorted(index_charge_a, charge, side='left')
+        charge_upper = np.searchsorted(index_charge_a, charge, side='right')
+        charge_idxs = np.where(charge_a == charge)[0]
+        candidates_lower_a[charge_idxs] = charge_lower + np.searchsorted(index_mz_a[charge_lower:charge_upper], mz_a[charge_idxs] * (1 - search_tolerance), side='left')
+        candidates_upper_a[charge_idxs] = charge_lower + np.searchsorted(index_mz_a[charge_lower:charge_upper], mz_a[charge_idxs] * (1 + search_tolerance), side='right')
+
+    keep_l = []
+    features_processed_a = np.zeros(len(features_df), dtype=bool)
+    for idx in range(len(features_df)):
+        if not features_processed_a[feature_codes_a[idx]]:
+            candidates_a = index_order_a[candidates_lower_a[idx]:candidates_upper_a[idx]]
+            duplicates_a = np.sort(candidates_a[(mz_a[idx] >= mz_lower_a[candidates_a]) & (mz_a[idx] <= mz_upper_a[candidates_a]) & (scan_a[idx] >= scan_lower_a[candidates_a]) & (scan_a[idx] <= scan_upper_a[candidates_a]) & (rt_a[idx] >= rt_lower_a[candidates_a]) & (rt_a[idx] <= rt_upper_a[candidates_a])])
+            if (len(duplicates_a) > 1) and verbose:
+                print('{} are duplicates'.format(feature_id_a[duplicates_a].tolist()))
+            keep_l.append(feature_id_a[idx])
+            # record the features that have been processed
+            features_processed_a[feature_codes_a[duplicates_a]] = True
+    return keep_l
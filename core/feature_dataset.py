@@ -0,0 +1,238 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import shutil
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+import pyarrow.compute as pc
+
+# A run's detected features are stored in a single Parquet file. The features are written incrementally as they're
+# detected, in row groups of about ROW_GROUP_SIZE features, so the whole run never has to be held in memory. The
+# row groups are in the order of the precursor cuboids, so their statistics let a reader skip the row groups
+# outside an RT range.
+
+# While the features are being detected, each batch of completed work is also written to a checkpoint directory as a
+# part file for each table, and recorded in the checkpoint's manifest with the precursor cuboids it covers. If the
+# detection is interrupted, it can be resumed from the checkpoint, skipping the cuboids that were finished.
+
+# The features' fragment ions are stored in a separate long-format table with a row for each ion, keyed by the
+# feature ID, so they can be stored and read as columns rather than as a nested structure in each feature.
+
+ROW_GROUP_SIZE = 10000
+FRAGMENT_IONS_ROW_GROUP_SIZE = 500000
+FRAGMENT_ION_COLUMNS = ['feature_id','singly_protonated_mass','neutral_mass','intensity']
+
+# the location of the run's features
+def features_path(features_dir, experiment_name, run_name, precursor_definition_method):
+    return '{}/exp-{}-run-{}-features-{}.parquet'.format(features_dir, experiment_name, run_name, precursor_definition_method)
+
+# the location of the fragment ions for the run's features
+def fragment_ions_path(features_dir, experiment_name, run_name, precursor_definition_method):
+    return '{}/exp-{}-run-{}-features-{}-fragment-ions.parquet'.format(features_dir, experiment_name, run_name, precursor_definition_method)
+
+# the location of the stage timings traced while detecting the run's features
+def stage_timings_path(features_dir, experiment_name, run_name, precursor_definition_method):
+    return '{}/exp-{}-run-{}-features-{}-stage-timings.parquet'.format(features_dir, experiment_name, run_name, precursor_definition_method)
+
+# the location of the checkpoint written while detecting the run's features
+def checkpoint_path(features_dir, experiment_name, run_name, precursor_definition_method):
+    return '{}/exp-{}-run-{}-features-{}-checkpoint'.format(features_dir, experiment_name, run_name, precursor_definition_method)
+
+# the file schema, derived from the first features written. The detection downcasts the numeric columns to the
+# smallest type that holds each batch, so they're widened here to a type that will hold every batch.
+def file_schema(features_df):
+    fields_l = []
+    for field in pa.Schema.from_pandas(features_df, preserve_index=False):
+        if pa.types.is_integer(field.type):
+            field_type = pa.int64()
+        elif pa.types.is_floating(field.type):
+            field_type = pa.float64()
+        elif pa.types.is_null(field.type):
+            field_type = pa.string()
+        else:
+            field_type = field.type
+        fields_l.append(pa.field(field.name, field_type))
+    return pa.schema(fields_l)
+
+# writes the features to the file as they are detected. The file is written to a temporary name and renamed when
+# it's closed, so an interrupted detection doesn't leave a partial file behind.
+class FeatureDatasetWriter:
+    def __init__(self, file_name, row_group_size=ROW_GROUP_SIZE):
+        self.file_name = file_name
+        self.temp_file_name = '{}-tmp-{}'.format(file_name, os.getpid())
+        self.row_group_size = row_group_size
+        self.schema = None
+        self.writer = None
+        self.buffer_l = []
+        self.buffered_rows = 0
+        self.number_of_rows = 0
+        self.number_of_row_groups = 0
+
+    # add a batch of features, writing a row group when enough have been buffered
+    def write(self, features_df):
+        if len(features_df) > 0:
+            if self.schema is None:
+                self.schema = file_schema(features_df)
+            self.buffer_l.append(pa.Table.from_pandas(features_df, schema=self.schema, preserve_index=False))
+            self.buffered_rows += len(features_df)
+            self.number_of_rows += len(features_df)
+            if self.buffered_rows >= self.row_group_size:
+                self.flush()
+
+    # write the buffered features as a row group
+    def flush(self):
+        if self.buffered_rows > 0:
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.temp_file_name, self.schema)
+            self.writer.write_table(pa.concat_tables(self.buffer_l), row_group_size=self.buffered_rows)
+            self.number_of_row_groups += 1
+            self.buffer_l = []
+            self.buffered_rows = 0
+
+    # write the remaining features and move the file into place
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.temp_file_name, self.file_name)
+
+# the checkpoint of a detection in progress. The manifest has a line for each part, written after the part's files,
+# so a part is only recorded once it's complete; files left by a part that wasn't recorded are overwritten when the
+# detection is resumed. The settings are the detection's parameters, and a checkpoint written with different settings
+# isn't resumed.
+class DetectionCheckpoint:
+    MANIFEST_FILE = 'manifest.jsonl'
+    SETTINGS_FILE = 'settings.json'
+
+    def __init__(self, checkpoint_dir, settings_d, resume):
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_l = []
+        if resume and os.path.isdir(checkpoint_dir):
+            if self.read_settings() == settings_d:
+                self.manifest_l = self.read_manifest()
+                self.rewrite_manifest()
+            else:
+                print('the checkpoint in {} was written with different settings, so the detection will start again'.format(checkpoint_dir))
+        if len(self.manifest_l) == 0:
+            # start a new checkpoint
+            if os.path.isdir(checkpoint_dir):
+                shutil.rmtree(checkpoint_dir)
+            os.makedirs(checkpoint_dir)
+            with open('{}/{}'.format(checkpoint_dir, self.SETTINGS_FILE), 'w') as handle:
+                json.dump(settings_d, handle)
+        self.processed_ids = set(i for part_d in self.manifest_l for i in part_d['precursor_cuboid_ids'])
+
+    def read_settings(self):
+        try:
+            with open('{}/{}'.format(self.checkpoint_dir, self.SETTINGS_FILE), 'r') as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    # the parts recorded in the manifest; a line cut short by an interruption is ignored
+    def read_manifest(self):
+        manifest_l = []
+        manifest_file_name = '{}/{}'.format(self.checkpoint_dir, self.MANIFEST_FILE)
+        if os.path.isfile(manifest_file_name):
+            with open(manifest_file_name, 'r') as handle:
+                for line in handle:
+                    try:
+                        manifest_l.append(json.loads(line))
+                    except ValueError:
+                        break
+        return manifest_l
+
+    # rewrite the manifest with just the parts that were recorded, so a line cut short doesn't run into the next one
+    def rewrite_manifest(self):
+        manifest_file_name = '{}/{}'.format(self.checkpoint_dir, self.MANIFEST_FILE)
+        temp_file_name = '{}-tmp-{}'.format(manifest_file_name, os.getpid())
+        with open(temp_file_name, 'w') as handle:
+            for part_d in self.manifest_l:
+                handle.write(json.dumps(part_d) + '\n')
+        os.replace(temp_file_name, manifest_file_name)
+
+    def part_path(self, part_number, table_name):
+        return '{}/part-{:05d}-{}.parquet'.format(self.checkpoint_dir, part_number, table_name)
+
+    # write a part with a DataFrame for each of the named tables, covering the specified precursor cuboids. The
+    # counts are totals, like the number of cuboids skipped, that are summed over the parts.
+    def write_part(self, tables_d, precursor_cuboid_ids, counts_d):
+        part_number = len(self.manifest_l)
+        table_names_l = []
+        for table_name,df in tables_d.items():
+            if (df is not None) and (len(df) > 0):
+                file_name = self.part_path(part_number, table_name)
+                temp_file_name = '{}-tmp-{}'.format(file_name, os.getpid())
+                df.to_parquet(temp_file_name, index=False)
+                os.replace(temp_file_name, file_name)
+                table_names_l.append(table_name)
+        part_d = {'part':part_number, 'tables':table_names_l, 'precursor_cuboid_ids':[int(i) for i in precursor_cuboid_ids], 'counts':counts_d}
+        with open('{}/{}'.format(self.checkpoint_dir, self.MANIFEST_FILE), 'a') as handle:
+            handle.write(json.dumps(part_d) + '\n')
+            handle.flush()
+            os.fsync(handle.fileno())
+        self.manifest_l.append(part_d)
+        self.processed_ids.update(part_d['precursor_cuboid_ids'])
+
+    # read the named table from each of the parts, in the order they were written
+    def read_parts(self, table_name):
+        for part_d in self.manifest_l:
+            if table_name in part_d['tables']:
+                yield pd.read_parquet(self.part_path(part_d['part'], table_name))
+
+    # the sum of each count over the parts
+    def counts(self):
+        counts_d = {}
+        for part_d in self.manifest_l:
+            for k,v in part_d['counts'].items():
+                counts_d[k] = counts_d.get(k, 0) + v
+        return counts_d
+
+    # remove the checkpoint once the detection's output has been written
+    def remove(self):
+        shutil.rmtree(self.checkpoint_dir)
+
+# find the fragment ions of each of the features, returning the ions sorted by feature and m/z, and the start and end
+# of each feature's ions. The features with no ions have an empty range.
+def group_fragment_ions(fragment_ions_df, feature_ids):
+    feature_id_a = fragment_ions_df.feature_id.to_numpy()
+    mass_a = fragment_ions_df.singly_protonated_mass.to_numpy()
+    ions_order_a = np.lexsort((mass_a, feature_id_a))
+    sorted_ions_df = fragment_ions_df.iloc[ions_order_a].reset_index(drop=True)
+    sorted_feature_id_a = feature_id_a[ions_order_a]
+    feature_id_a = np.asarray(feature_ids)
+    starts_a = np.searchsorted(sorted_feature_id_a, feature_id_a, 'left')
+    ends_a = np.searchsorted(sorted_feature_id_a, feature_id_a, 'right')
+    return sorted_ions_df, starts_a, ends_a
+
+# read the features, optionally only the specified columns and the rows that match the filters, for example
+# [('rt_apex','>=',1650), ('charge','==',2)]. The filters are checked against the row group statistics, so row
+# groups that can't match aren't read.
+def read_features(file_name, columns=None, filters=None):
+    return pq.read_table(file_name, columns=columns, filters=filters).to_pandas()
+
+# read the features of several runs that were identified, from the runs' feather files, optionally only the specified
+# columns. identified_df has the run_name and feature_id of the identified features. Each file is filtered to its
+# run's identified features before it's converted to pandas, so only those rows are materialised. The files are read
+# whole rather than scanned as a pyarrow dataset with a filter expression; feather files have no statistics to skip
+# batches with, and the scan was slower and had a higher peak memory than reading and filtering each file in turn.
+def read_identified_features(file_names_l, identified_df, columns=None):
+    feature_ids_d = {run_name:group_df.feature_id.unique() for run_name,group_df in identified_df.groupby('run_name')}
+    # the run and feature ID are needed to filter the rows
+    if columns is not None:
+        columns = list(columns) + [c for c in ['run_name','feature_id'] if c not in columns]
+    df_l = []
+    for file_name in file_names_l:
+        table = feather.read_table(file_name, columns=columns)
+        if table.num_rows == 0:
+            continue
+        run_name = table.column('run_name')[0].as_py()
+        if run_name in feature_ids_d:
+            feature_ids_a = pa.array(feature_ids_d[run_name], type=table.schema.field('feature_id').type)
+            df_l.append(table.filter(pc.is_in(table.column('feature_id'), value_set=feature_ids_a)).to_pandas())
+        del table
+    if len(df_l) == 0:
+        return pd.DataFrame(columns=['run_name','feature_id'])
+    return pd.concat(df_l, axis=0, sort=False, ignore_index=True)
@@ -0,0 +1,82 @@
+import numpy as np
+
+# The ratio of the height of each isotopic peak to the peak before it, predicted from the monoisotopic mass and the
+# number of sulphur atoms in the molecule. Peak number 0 refers to the monoisotopic peak, so there are ratios for
+# peak numbers 1 to 6.
+#
+# source: Valkenborg et al, "A Model-Based Method for the Prediction of the Isotopic Distribution of Peptides", https://core.ac.uk/download/pdf/82021511.pdf
+#
+# The model's coefficients are held in a single array indexed by the number of sulphur atoms and the peak number, so
+# the ratios for many peaks are evaluated together rather than rebuilding the model for each one.
+
+MAX_NUMBER_OF_SULPHUR_ATOMS = 3
+MAX_NUMBER_OF_PREDICTED_RATIOS = 6
+
+# the coefficients beta0..beta4 of the polynomial in mass/1000, indexed by [number of sulphur][peak number]. There
+# is no ratio for the monoisotopic peak, so its coefficients are NaN.
+MODEL_PARAMS = np.array([
+    [
+        [np.nan]*5,
+        [-0.00142320578040, 0.53158267080224, 0.00572776591574, -0.00040226083326, -0.00007968737684],
+        [0.06258138406507, 0.24252967352808, 0.01729736525102, -0.00427641490976, 0.00038011211412],
+        [0.03092092306220, 0.22353930450345, -0.02630395501009, 0.00728183023772, -0.00073155573939],
+        [-0.02490747037406, 0.26363266501679, -0.07330346656184, 0.01876886839392, -0.00176688757979],
+        [-0.19423148776489, 0.45952477474223, -0.18163820209523, 0.04173579115885, -0.00355426505742],
+        [0.04574408690798, -0.05092121193598, 0.13874539944789, -0.04344815868749, 0.00449747222180]
+    ],
+    [
+        [np.nan]*5,
+        [-0.01040584267474, 0.53121149663696, 0.00576913817747, -0.00039325152252, -0.00007954180489],
+        [0.37339166598255, -0.15814640001919, 0.24085046064819, -0.06068695741919, 0.00563606634601],
+        [0.06969331604484, 0.28154425636993, -0.08121643989151, 0.02372741957255, -0.00238998426027],
+        [0.04462649178239, 0.23204790123388, -0.06083969521863, 0.01564282892512, -0.00145145206815],
+        [-0.20727547407753, 0.53536509500863, -0.22521649838170, 0.05180965157326, -0.00439750995163],
+        [0.27169670700251, -0.37192045082925, 0.31939855191976, -0.08668833166842, 0.00822975581940]
+    ],
+    [
+        [np.nan]*5,
+        [-0.01937823810470, 0.53084210514216, 0.00580573751882, -0.00038281138203, -0.00007958217070],
+        [0.68496829280011, -0.54558176102022, 0.44926662609767, -0.11154849560657, 0.01023294598884],
+        [0.04215807391059, 0.40434195078925, -0.15884974959493, 0.04319968814535, -0.00413693825139],
+        [0.14015578207913, 0.14407679007180, -0.01310480312503, 0.00362292256563, -0.00034189078786],
+        [-0.02549241716294, 0.32153542852101, -0.11409513283836, 0.02617210469576, -0.00221816103608],
+        [-0.14490868030324, 0.33629928307361, -0.08223564735018, 0.01023410734015, -0.00027717589598]
+    ]
+])
+
+# the monoisotopic mass range in which the model is valid, indexed by [number of sulphur][peak number]
+MODEL_MASS_LOWER = np.array([
+    [np.nan, 498, 498, 498, 907, 1219, 1559],
+    [np.nan, 530, 530, 530, 939, 1251, 1591],
+    [np.nan, 562, 562, 562, 971, 1283, 1623]
+])
+MODEL_MASS_UPPER = np.array([3915, 3947, 3978])
+
+# the model as lists, for evaluating a single ratio without the overhead of array operations
+MODEL_PARAMS_L = MODEL_PARAMS.tolist()
+MODEL_MASS_LOWER_L = MODEL_MASS_LOWER.tolist()
+MODEL_MASS_UPPER_L = MODEL_MASS_UPPER.tolist()
+
+# predict the ratio H(peak_number)/H(peak_number-1) for each element of the arrays, which are broadcast together.
+# The ratio is NaN where the model doesn't cover the mass, peak number, or number of sulphur atoms.
+def peak_ratios(masses, peak_numbers, sulphurs):
+    masses, peak_numbers, sulphurs = np.broadcast_arrays(np.asarray(masses, dtype=float), np.asarray(peak_numbers), np.asarray(sulphurs))
+    modelled = (peak_numbers >= 1) & (peak_numbers <= MAX_NUMBER_OF_PREDICTED_RATIOS) & (sulphurs >= 0) & (sulphurs < MAX_NUMBER_OF_SULPHUR_ATOMS)
+    # look up the coefficients with in-range indices, and discard the ratios that aren't modelled afterwards
+    peak_idxs = np.where(modelled, peak_numbers, 1)
+    sulphur_idxs = np.where(modelled, sulphurs, 0)
+    valid = modelled & (MODEL_MASS_LOWER[sulphur_idxs, peak_idxs] <= masses) & (masses <= MODEL_MASS_UPPER[sulphur_idxs])
+    beta = MODEL_PARAMS[sulphur_idxs, peak_idxs]
+    scaled_m = masses / 1000.0
+    ratios = beta[...,0] + (beta[...,1]*scaled_m) + beta[...,2]*(scaled_m**2) + beta[...,3]*(scaled_m**3) + beta[...,4]*(scaled_m**4)
+    return np.where(valid, ratios, np.nan)
+
+# predict the ratio H(peak_number)/H(peak_number-1) for a single peak, or None if the model doesn't cover it
+def peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur):
+    ratio = None
+    if ((1 <= peak_number <= MAX_NUMBER_OF_PREDICTED_RATIOS) and (0 <= number_of_sulphur < MAX_NUMBER_OF_SULPHUR_ATOMS) and
+        (MODEL_MASS_LOWER_L[number_of_sulphur][peak_number] <= monoisotopic_mass <= MODEL_MASS_UPPER_L[number_of_sulphur])):
+        beta0, beta1, beta2, beta3, beta4 = MODEL_PARAMS_L[number_of_sulphur][peak_number]
+        scaled_m = monoisotopic_mass / 1000.0
+        ratio = beta0 + (beta1*scaled_m) + beta2*(scaled_m**2) + beta3*(scaled_m**3) + beta4*(scaled_m**4)
+    return ratio
@@ -0,0 +1,26 @@
+import numpy as np
+
+# Peptide masses cluster around each nominal mass, so fragment ions whose mass falls outside the window around its
+# nominal mass are unlikely to be real (see https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3184890/). The windows are
+# represented as a sorted array of their edges, lower and upper interleaved, so testing whether masses fall in a
+# window is a single binary search over the edges.
+
+# create the edges of the mass defect windows in Da space, one window for each nominal mass in the range
+def generate_mass_defect_windows(mass_defect_window_da_min, mass_defect_window_da_max):
+    nominal_mass_a = np.arange(mass_defect_window_da_min, mass_defect_window_da_max)
+    mass_centre_a = nominal_mass_a * 1.00048
+    width_a = 0.19 + (0.0001 * nominal_mass_a)
+    # the windows are narrower than the spacing between nominal masses, so the edges are in order
+    window_edges_a = np.empty(2 * len(nominal_mass_a))
+    window_edges_a[0::2] = mass_centre_a - (width_a / 2)
+    window_edges_a[1::2] = mass_centre_a + (width_a / 2)
+    return window_edges_a
+
+# the index of the window edge above each mass; it's odd for a mass inside a window. The windows are closed on the
+# right (lower < mass <= upper) unless closed_right is False, when they're closed on the left (lower <= mass < upper).
+def window_edge_index(masses, window_edges_a, closed_right=True):
+    return np.searchsorted(window_edges_a, masses, side=('left' if closed_right else 'right'))
+
+# determine which masses fall in a mass defect window
+def in_mass_defect_window(masses, window_edges_a, closed_right=True):
+    return (window_edge_index(masses, window_edges_a, closed_right) % 2) == 1
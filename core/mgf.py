@@ -0,0 +1,67 @@
+import numpy as np
+
+# The features are searched as an MGF with a spectrum for each feature that has fragment ions. The spectra are
+# rendered directly as text a batch of features at a time, in the same format pyteomics' mgf.write produced for them,
+# so a run's MGF can be written without holding a dictionary for every spectrum in memory.
+
+INSTRUMENT = 'ESI-QUAD-TOF'
+
+# the columns of the features needed to render their spectra, apart from the monoisotopic m/z column
+FEATURE_COLUMNS = ['feature_id','charge','feature_intensity','rt_apex','precursor_cuboid_id']
+
+# render the spectrum of a feature; the fragment ions are lists of the m/z and intensity, sorted by increasing m/z
+def render_spectrum(feature_id, charge, feature_intensity, rt_apex, precursor_cuboid_id, monoisotopic_mz, fragment_ions_mz_l, fragment_ions_intensity_l, run_name):
+    lines_l = ['BEGIN IONS']
+    lines_l.append('TITLE=RawFile: {} Charge: {} FeatureIntensity: {} Feature#: {} RtApex: {} Precursor: {}'.format(run_name, int(charge), int(feature_intensity), int(feature_id), round(rt_apex,2), int(precursor_cuboid_id)))
+    lines_l.append('INSTRUMENT={}'.format(INSTRUMENT))
+    lines_l.append('PEPMASS={} {}'.format(round(monoisotopic_mz,6), int(feature_intensity)))
+    lines_l.append('CHARGE={}+'.format(int(charge)))
+    lines_l.append('RTINSECONDS={}'.format(round(rt_apex,2)))
+    lines_l.append('SCANS={}'.format(int(feature_id)))
+    lines_l += list(map('{} {} '.format, fragment_ions_mz_l, fragment_ions_intensity_l))
+    lines_l.append('END IONS\n\n')
+    return '\n'.join(lines_l)
+
+# render the spectra of a batch of features as a single string. The features' attributes are lists, and their
+# fragment ions are the slices [ions_start,ions_end) of the ion arrays. The features without fragment ions have no
+# spectrum. Returns the text and the number of spectra.
+def render_spectra(features_d, monoisotopic_mz_l, ions_start_a, ions_end_a, fragment_ions_mz_a, fragment_ions_intensity_a, run_name):
+    blocks_l = []
+    for idx in np.flatnonzero(ions_end_a > ions_start_a):
+        start, end = ions_start_a[idx], ions_end_a[idx]
+        blocks_l.append(render_spectrum(features_d['feature_id'][idx], features_d['charge'][idx], features_d['feature_intensity'][idx], features_d['rt_apex'][idx], features_d['precursor_cuboid_id'][idx], monoisotopic_mz_l[idx], fragment_ions_mz_a[start:end].tolist(), fragment_ions_intensity_a[start:end].tolist(), run_name))
+    return ''.join(blocks_l), len(blocks_l)
+
+# count the spectra in an MGF file
+def count_spectra(mgf_file):
+    number_of_spectra = 0
+    with open(mgf_file, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'BEGIN IONS'):
+                number_of_spectra += 1
+    return number_of_spectra
+
+# split an MGF file into contiguous shards of about the same number of spectra, one for each of the shard files, so
+# the shards joined in order have the spectra in their original order. Returns the number of spectra in each shard.
+def split_mgf(mgf_file, shard_files_l):
+    number_of_spectra = count_spectra(mgf_file)
+    shard_boundaries_a = np.linspace(0, number_of_spectra, len(shard_files_l)+1).astype(int)
+    spectra_per_shard_l = np.diff(shard_boundaries_a).tolist()
+    shard_idx = -1
+    spectrum_idx = 0
+    shard_handle = None
+    with open(mgf_file, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'BEGIN IONS'):
+                # move on to the next shard when this one has its share of the spectra
+                while spectrum_idx == shard_boundaries_a[shard_idx+1]:
+                    if shard_handle is not None:
+                        shard_handle.close()
+                    shard_idx += 1
+                    shard_handle = open(shard_files_l[shard_idx], 'wb', buffering=1024*1024)
+                spectrum_idx += 1
+            if shard_handle is not None:
+                shard_handle.write(line)
+    if shard_handle is not None:
+        shard_handle.close()
+    return spectra_per_shard_l
@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+from core import peaks
+from core import isotope_model
+
+# peak and valley detection parameters
+PEAKS_THRESHOLD_RT = 0.5    # only consider peaks that are higher than this proportion of the normalised maximum
+PEAKS_THRESHOLD_SCAN = 0.5
+PEAKS_MIN_DIST_RT = 2.0     # seconds
+PEAKS_MIN_DIST_SCAN = 10.0  # scans
+
+VALLEYS_THRESHOLD_RT = 0.5    # only consider valleys that drop more than this proportion of the normalised maximum
+VALLEYS_THRESHOLD_SCAN = 0.5
+VALLEYS_MIN_DIST_RT = 2.0     # seconds
+VALLEYS_MIN_DIST_SCAN = 10.0  # scans
+
+# filter parameters
+SCAN_FILTER_POLY_ORDER = 5
+RT_FILTER_POLY_ORDER = 3
+
+# the cuboid's raw points as arrays for determining the mono characteristics of its features. The scans and frames
+# are offset to bin indices, so the points' intensities can be summed along either dimension with np.bincount.
+def cuboid_point_arrays(cuboid_points_df):
+    scan_a = cuboid_points_df.scan.to_numpy().astype(np.int64)
+    frame_a = cuboid_points_df.frame_id.to_numpy().astype(np.int64)
+    rt_a = cuboid_points_df.retention_time_secs.to_numpy()
+    scan_offset = scan_a.min() if len(scan_a) > 0 else 0
+    frame_offset = frame_a.min() if len(frame_a) > 0 else 0
+    number_of_frame_bins = frame_a.max() - frame_offset + 1 if len(frame_a) > 0 else 0
+    # the retention time of each frame bin
+    frame_rt_a = np.zeros(number_of_frame_bins, dtype=rt_a.dtype)
+    frame_rt_a[frame_a - frame_offset] = rt_a
+    return {
+        'mz':cuboid_points_df.mz.to_numpy(),
+        'scan':scan_a,
+        'retention_time_secs':rt_a,
+        'intensity':cuboid_points_df.intensity.to_numpy().astype(np.int64),
+        'scan_bin':scan_a - scan_offset,
+        'frame_bin':frame_a - frame_offset,
+        'scan_offset':scan_offset,
+        'frame_offset':frame_offset,
+        'number_of_scan_bins':scan_a.max() - scan_offset + 1 if len(scan_a) > 0 else 0,
+        'number_of_frame_bins':number_of_frame_bins,
+        'frame_rt':frame_rt_a
+    }
+
+# sum the intensity of the points in each bin, returning the number of points and the summed intensity of every bin
+def bin_intensity(bin_a, intensity_a, number_of_bins):
+    counts_a = np.bincount(bin_a, minlength=number_of_bins)
+    # the weighted sum is a float, but it's exact for integer intensities
+    summed_intensity_a = np.bincount(bin_a, weights=intensity_a, minlength=number_of_bins).astype(np.int64)
+    return counts_a, summed_intensity_a
+
+# calculate the cosine similarity of two isotopes' intensity profiles over the bins they have in common
+def measure_peak_similarity(previous_counts_a, previous_intensity_a, counts_a, intensity_a):
+    common_a = (previous_counts_a > 0) & (counts_a > 0)
+    if not common_a.any():
+        return None
+    a = previous_intensity_a[common_a].astype(float)
+    b = intensity_a[common_a].astype(float)
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+# determine the mono peak apex and extent in CCS and RT and calculate isotopic peak intensities. cuboid_points_d is
+# the cuboid's raw points from cuboid_point_arrays().
+def determine_mono_characteristics(envelope, mono_mz_lower, mono_mz_upper, monoisotopic_mass, cuboid_points_d, instrument_resolution, saturation_intensity):
+    mz_a = cuboid_points_d['mz']
+    scan_a = cuboid_points_d['scan']
+    rt_a = cuboid_points_d['retention_time_secs']
+    intensity_a = cuboid_points_d['intensity']
+    scan_bin_a = cuboid_points_d['scan_bin']
+    frame_bin_a = cuboid_points_d['frame_bin']
+    number_of_scan_bins = cuboid_points_d['number_of_scan_bins']
+    number_of_frame_bins = cuboid_points_d['number_of_frame_bins']
+
+    # determine the raw points that belong to the mono peak
+    # we use the wider cuboid points because we want to discover the apex and extent in CCS and RT
+    mono_idxs = np.flatnonzero((mz_a >= mono_mz_lower) & (mz_a <= mono_mz_upper))
+
+    # determine the peak's extent in CCS and RT
+    if len(mono_idxs) > 0:
+        # collapsing the monoisotopic's summed points onto the mobility dimension
+        counts_a, summed_intensity_a = bin_intensity(scan_bin_a[mono_idxs], intensity_a[mono_idxs], number_of_scan_bins)
+        scan_bins = np.flatnonzero(counts_a)
+        scan_x_a = scan_bins + cuboid_points_d['scan_offset']
+        scan_intensity_a = summed_intensity_a[scan_bins]
+        scan_filtered_intensity_a, scan_apex, scan_lower, scan_upper = peaks.find_apex_and_valleys(scan_x_a, scan_intensity_a, SCAN_FILTER_POLY_ORDER, PEAKS_THRESHOLD_SCAN, PEAKS_MIN_DIST_SCAN, VALLEYS_THRESHOLD_SCAN, VALLEYS_MIN_DIST_SCAN)
+        scan_apex = np.float64(scan_apex)
+        # if there's no valley, the peak extends to the edge of the cuboid
+        scan_lower = scan_x_a[0] if scan_lower is None else scan_lower
+        scan_upper = scan_x_a[-1] if scan_upper is None else scan_upper
+
+        # constrain the mono points to the CCS extent
+        mono_idxs = mono_idxs[(scan_a[mono_idxs] >= scan_lower) & (scan_a[mono_idxs] <= scan_upper)]
+
+        # in the RT dimension, look wider to find the apex
+        counts_a, summed_intensity_a = bin_intensity(frame_bin_a[mono_idxs], intensity_a[mono_idxs], number_of_frame_bins)
+        frame_bins = np.flatnonzero(counts_a)
+        rt_x_a = cuboid_points_d['frame_rt'][frame_bins]
+        rt_intensity_a = summed_intensity_a[frame_bins]
+        rt_filtered_intensity_a, rt_apex, rt_lower, rt_upper = peaks.find_apex_and_valleys(rt_x_a, rt_intensity_a, RT_FILTER_POLY_ORDER, PEAKS_THRESHOLD_RT, PEAKS_MIN_DIST_RT, VALLEYS_THRESHOLD_RT, VALLEYS_MIN_DIST_RT)
+        rt_apex = np.float64(rt_apex)
+        rt_lower = rt_x_a[0] if rt_lower is None else rt_lower
+        rt_upper = rt_x_a[-1] if rt_upper is None else rt_upper
+
+        # for the whole feature, constrain the raw points to the CCS and RT extent of the monoisotopic peak
+        extent_idxs = np.flatnonzero((scan_a >= scan_lower) & (scan_a <= scan_upper) & (rt_a >= rt_lower) & (rt_a <= rt_upper))
+
+        # assign the constrained raw points to the isotopes; the points are sorted by m/z so each isotope's points
+        # are a contiguous range
+        iso_mz_a = np.array([isotope[0] for isotope in envelope])
+        iso_mz_delta_a = peaks.calculate_peak_delta(iso_mz_a, instrument_resolution=instrument_resolution)
+        iso_mz_lower_a = iso_mz_a - iso_mz_delta_a
+        iso_mz_upper_a = iso_mz_a + iso_mz_delta_a
+        extent_idxs = extent_idxs[np.argsort(mz_a[extent_idxs], kind='stable')]
+        extent_mz_a = mz_a[extent_idxs]
+        iso_starts_a = np.searchsorted(extent_mz_a, iso_mz_lower_a, 'left')
+        iso_ends_a = np.searchsorted(extent_mz_a, iso_mz_upper_a, 'right')
+        iso_lengths_a = np.clip(iso_ends_a - iso_starts_a, 0, None)
+        iso_point_idxs = extent_idxs[np.repeat(iso_starts_a - (np.cumsum(iso_lengths_a) - iso_lengths_a), iso_lengths_a) + np.arange(iso_lengths_a.sum())]
+        iso_number_a = np.repeat(np.arange(len(iso_mz_a)), iso_lengths_a)
+
+        # bin all the isotopes' points together in RT and CCS, giving a profile for each isotope in each dimension
+        iso_intensity_a = intensity_a[iso_point_idxs]
+        rt_counts_a, rt_summed_a = bin_intensity(iso_number_a*number_of_frame_bins + frame_bin_a[iso_point_idxs], iso_intensity_a, len(iso_mz_a)*number_of_frame_bins)
+        rt_counts_a = rt_counts_a.reshape(len(iso_mz_a), number_of_frame_bins)
+        rt_summed_a = rt_summed_a.reshape(len(iso_mz_a), number_of_frame_bins)
+        scan_counts_a, scan_summed_a = bin_intensity(iso_number_a*number_of_scan_bins + scan_bin_a[iso_point_idxs], iso_intensity_a, len(iso_mz_a)*number_of_scan_bins)
+        scan_counts_a = scan_counts_a.reshape(len(iso_mz_a), number_of_scan_bins)
+        scan_summed_a = scan_summed_a.reshape(len(iso_mz_a), number_of_scan_bins)
+        # the maximum point of each isotope in each frame
+        frame_maximums_a = np.zeros(len(iso_mz_a)*number_of_frame_bins, dtype=np.int64)
+        np.maximum.at(frame_maximums_a, iso_number_a*number_of_frame_bins + frame_bin_a[iso_point_idxs], iso_intensity_a)
+        frame_maximums_a = frame_maximums_a.reshape(len(iso_mz_a), number_of_frame_bins)
+
+        # calculate the isotope intensities from the constrained raw points
+        isotopes_l = []
+        for idx in range(len(iso_mz_a)):
+            if iso_lengths_a[idx] > 0:
+                # find the intensity by summing the maximum point in the frame closest to the RT apex, and the frame maximums either side
+                iso_frame_bins = np.flatnonzero(rt_counts_a[idx])
+                iso_rt_a = cuboid_points_d['frame_rt'][iso_frame_bins]
+                nearest_frames = np.argsort(abs(iso_rt_a - rt_apex))[:3]
+                nearest_frame_maximums_a = frame_maximums_a[idx][iso_frame_bins[nearest_frames]]
+                # sum the maximum intensity and the max intensity of the frame either side in RT
+                summed_intensity = nearest_frame_maximums_a.sum()
+                # are any of the three points in saturation?
+                isotope_in_saturation = (nearest_frame_maximums_a.max() > saturation_intensity)
+                # determine the isotope's profile in retention time, and measure its elution similarity with the previous isotope
+                iso_rt_df = pd.DataFrame({'retention_time_secs':iso_rt_a, 'intensity':rt_summed_a[idx][iso_frame_bins]})
+                similarity_rt = measure_peak_similarity(rt_counts_a[idx-1], rt_summed_a[idx-1], rt_counts_a[idx], rt_summed_a[idx]) if idx > 0 else None
+                # determine the isotope's profile in mobility, and measure its elution similarity with the previous isotope
+                iso_scan_bins = np.flatnonzero(scan_counts_a[idx])
+                iso_scan_df = pd.DataFrame({'scan':iso_scan_bins + cuboid_points_d['scan_offset'], 'intensity':scan_summed_a[idx][iso_scan_bins]})
+                similarity_scan = measure_peak_similarity(scan_counts_a[idx-1], scan_summed_a[idx-1], scan_counts_a[idx], scan_summed_a[idx]) if idx > 0 else None
+                # add the isotope to the list
+                isotopes_l.append({'mz':iso_mz_a[idx], 'mz_lower':iso_mz_lower_a[idx], 'mz_upper':iso_mz_upper_a[idx], 'intensity':summed_intensity, 'saturated':isotope_in_saturation, 'rt_df':iso_rt_df.to_json(orient='records'), 'scan_df':iso_scan_df.to_json(orient='records'), 'similarity_rt':similarity_rt, 'similarity_scan':similarity_scan})
+            else:
+                break
+        isotopes_df = pd.DataFrame(isotopes_l)
+
+        # calculate the coelution coefficient for the isotopic peak series
+        coelution_coefficient = isotopes_df.similarity_rt.mean()
+        mobility_coefficient = isotopes_df.similarity_scan.mean()
+
+        # set the summed intensity and m/z to be the default adjusted intensity for all isotopes
+        isotopes_df['inferred_intensity'] = isotopes_df.intensity
+        isotopes_df['inferred'] = False
+
+        # if the mono is saturated and there are non-saturated isotopes to use as a reference...
+        outcome = ''
+        if (isotopes_df.iloc[0].saturated == True):
+            outcome = 'monoisotopic_saturated_adjusted'
+            if (len(isotopes_df[isotopes_df.saturated == False]) > 0):
+                # find the first unsaturated isotope
+                unsaturated_idx = isotopes_df[(isotopes_df.saturated == False)].iloc[0].name
+
+                # using as a reference the most intense isotope that is not in saturation, derive the isotope intensities back to the monoisotopic
+                Hpn = isotopes_df.iloc[unsaturated_idx].intensity
+                for peak_number in reversed(range(1,unsaturated_idx+1)):
+                    # calculate the phr for the next-lower peak
+                    phr = isotope_model.peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
+                    if phr is not None:
+                        Hpn_minus_1 = Hpn / phr
+                        isotopes_df.at[peak_number-1, 'inferred_intensity'] = int(Hpn_minus_1)
+                        isotopes_df.at[peak_number-1, 'inferred'] = True
+                        Hpn = Hpn_minus_1
+                    else:
+                        outcome = 'could_not_calculate_phr'
+                        break
+            else:
+                outcome = 'no_nonsaturated_isotopes'
+        else:
+            outcome = 'monoisotopic_not_saturated'
+
+        # package the result
+        result_d = {}
+        result_d['scan_apex'] = scan_apex
+        result_d['scan_lower'] = scan_lower
+        result_d['scan_upper'] = scan_upper
+        result_d['rt_apex'] = rt_apex
+        result_d['rt_lower'] = rt_lower
+        result_d['rt_upper'] = rt_upper
+        result_d['intensity_without_saturation_correction'] = isotopes_df.iloc[:3].intensity.sum()  # only take the first three isotopes for intensity, as the number of isotopes varies
+        result_d['intensity_with_saturation_correction'] = isotopes_df.iloc[:3].inferred_intensity.sum()
+        result_d['mono_intensity_adjustment_outcome'] = outcome
+        result_d['isotopic_peaks'] = isotopes_df.to_json(orient='records')
+        result_d['coelution_coefficient'] = coelution_coefficient
+        result_d['mobility_coefficient'] = mobility_coefficient
+        result_d['scan_df'] = pd.DataFrame({'scan':scan_x_a, 'intensity':scan_intensity_a, 'filtered_intensity':scan_filtered_intensity_a}).to_json(orient='records')
+        result_d['rt_df'] = pd.DataFrame({'frame_id':frame_bins + cuboid_points_d['frame_offset'], 'retention_time_secs':rt_x_a, 'intensity':rt_intensity_a, 'filtered_intensity':rt_filtered_intensity_a}).to_json(orient='records')
+    else:
+        print('found no raw points where the mono peak should be')
+        result_d = None
+    return result_d
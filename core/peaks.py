@@ -0,0 +1,143 @@
+import numpy as np
+import peakutils
+from scipy import signal
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional; it's only needed for the compiled intensity descent kernel
+    NUMBA_AVAILABLE = False
+    def njit(f):
+        return f
+
+# Functions for resolving and characterising peaks in the raw data. They take everything they depend on as parameters
+# rather than reading the scripts' configuration, so they can be imported by the Ray workers and compiled.
+
+# determine the maximum filter length for the number of points
+def find_filter_length(number_of_points):
+    filter_lengths = [51,11,5]  # must be a positive odd number, greater than the polynomial order, and less than the number of points to be filtered
+    return filter_lengths[next(x[0] for x in enumerate(filter_lengths) if x[1] < number_of_points)]
+
+# calculate the intensity-weighted centroid
+# takes a numpy array of intensity, and another of mz
+def intensity_weighted_centroid(_int_f, _x_f):
+    return ((_int_f/_int_f.sum()) * _x_f).sum()
+
+# find 3sigma for a specified m/z
+def calculate_peak_delta(mz, instrument_resolution):
+    delta_m = mz / instrument_resolution  # FWHM of the peak
+    sigma = delta_m / 2.35482  # std dev is FWHM / 2.35482. See https://mathworld.wolfram.com/GaussianFunction.html
+    peak_delta = 3 * sigma  # 99.7% of values fall within +/- 3 sigma
+    return peak_delta
+
+# calculate the monoisotopic mass
+def calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge, proton_mass):
+    monoisotopic_mass = (monoisotopic_mz * charge) - (proton_mass * charge)
+    return monoisotopic_mass
+
+# peaks_a is a numpy array of [mz,intensity]
+# returns a numpy array of [intensity_weighted_centroid,summed_intensity]
+def intensity_descent(peaks_a, instrument_resolution, peak_delta=None, use_numba=False):
+    if len(peaks_a) == 0:
+        return np.array([])
+    # the peak delta is determined from the most intense point and used for all the peaks
+    if peak_delta == None:
+        peak_delta = calculate_peak_delta(mz=peaks_a[np.argmax(peaks_a[:,1]),0], instrument_resolution=instrument_resolution)
+    if use_numba:
+        return intensity_descent_kernel(peaks_a[:,0].astype(np.float64), peaks_a[:,1].astype(np.float64), peak_delta)
+
+    # sort the points by m/z once so each peak's region can be found with a binary search
+    mz_order = np.argsort(peaks_a[:,0], kind='stable')
+    sorted_mz = peaks_a[mz_order,0]
+    sorted_position = np.empty(len(peaks_a), dtype=np.int64)
+    sorted_position[mz_order] = np.arange(len(peaks_a))
+    # visit the points in decreasing intensity; ties are resolved by position, the same as np.argmax
+    intensity_order = np.argsort(-peaks_a[:,1], kind='stable')
+    # points assigned to a peak are marked as taken, rather than deleted from the array
+    taken = np.zeros(len(peaks_a), dtype=bool)
+
+    # intensity descent
+    peaks_l = []
+    for max_intensity_index in intensity_order:
+        # skip the points already assigned to a more intense peak
+        if taken[sorted_position[max_intensity_index]]:
+            continue
+        peak_mz = peaks_a[max_intensity_index,0]
+        lower = np.searchsorted(sorted_mz, peak_mz - peak_delta, side='left')
+        upper = np.searchsorted(sorted_mz, peak_mz + peak_delta, side='right')
+
+        # get all the untaken raw points within this m/z region, in their original order
+        peak_indexes = np.sort(mz_order[lower:upper][~taken[lower:upper]])
+        mz_cent = intensity_weighted_centroid(peaks_a[peak_indexes,1], peaks_a[peak_indexes,0])
+        summed_intensity = peaks_a[peak_indexes,1].sum()
+        peaks_l.append((mz_cent, summed_intensity))
+        # claim the raw points assigned to this peak
+        taken[lower:upper] = True
+    return np.array(peaks_l)
+
+# the intensity descent above, compiled with numba; the sums are accumulated sequentially, so the result
+# agrees with the NumPy implementation to within floating point rounding
+@njit
+def intensity_descent_kernel(mz_a, intensity_a, peak_delta):
+    mz_order = np.argsort(mz_a, kind='mergesort')
+    sorted_mz = mz_a[mz_order]
+    sorted_position = np.empty(len(mz_a), dtype=np.int64)
+    for i in range(len(mz_a)):
+        sorted_position[mz_order[i]] = i
+    intensity_order = np.argsort(-intensity_a, kind='mergesort')
+    taken = np.zeros(len(mz_a), dtype=np.bool_)
+
+    peaks_a = np.empty((len(mz_a), 2), dtype=np.float64)
+    number_of_peaks = 0
+    for max_intensity_index in intensity_order:
+        if taken[sorted_position[max_intensity_index]]:
+            continue
+        peak_mz = mz_a[max_intensity_index]
+        lower = np.searchsorted(sorted_mz, peak_mz - peak_delta, side='left')
+        upper = np.searchsorted(sorted_mz, peak_mz + peak_delta, side='right')
+        summed_intensity = 0.0
+        weighted_mz = 0.0
+        for i in range(lower, upper):
+            if not taken[i]:
+                taken[i] = True
+                summed_intensity += intensity_a[mz_order[i]]
+                weighted_mz += intensity_a[mz_order[i]] * sorted_mz[i]
+        peaks_a[number_of_peaks,0] = weighted_mz / summed_intensity
+        peaks_a[number_of_peaks,1] = summed_intensity
+        number_of_peaks += 1
+    return peaks_a[:number_of_peaks]
+
+# find the peak in an intensity profile nearest the reference point, and the valleys either side of it. x_a is the
+# profile's sorted x-axis values, and the reference point defaults to the profile's midpoint. Returns the filtered
+# intensity, the apex, and the nearest valley below and above the apex, which are None if there isn't one.
+def find_apex_and_valleys(x_a, intensity_a, filter_poly_order, peaks_threshold, peaks_min_dist, valleys_threshold, valleys_min_dist, reference_x=None):
+    # apply a smoothing filter to the points
+    filtered_intensity_a = intensity_a  # set the default
+    try:
+        filtered_intensity_a = signal.savgol_filter(intensity_a, window_length=find_filter_length(number_of_points=len(intensity_a)), polyorder=filter_poly_order)
+    except:
+        pass
+
+    # find the peak(s)
+    peak_idxs = []
+    try:
+        peak_idxs = peakutils.indexes(filtered_intensity_a.astype(int), thres=peaks_threshold, min_dist=peaks_min_dist, thres_abs=False)
+    except:
+        pass
+    if len(peak_idxs) == 0:
+        # if we couldn't find any peaks, take the maximum intensity point
+        peak_idxs = [np.argmax(filtered_intensity_a)]
+    peak_idxs = np.asarray(peak_idxs)
+
+    # find the closest peak to the reference point
+    if reference_x is None:
+        reference_x = x_a[0] + ((x_a[-1] - x_a[0]) / 2)
+    apex_idx = peak_idxs[np.argmin(abs(x_a[peak_idxs] - reference_x))]
+
+    # find the valleys nearest the apex
+    valley_idxs = peakutils.indexes(-filtered_intensity_a.astype(int), thres=valleys_threshold, min_dist=valleys_min_dist, thres_abs=False)
+    upper_valley_idxs = valley_idxs[valley_idxs > apex_idx]
+    upper_valley_x = x_a[upper_valley_idxs.min()] if len(upper_valley_idxs) > 0 else None
+    lower_valley_idxs = valley_idxs[valley_idxs < apex_idx]
+    lower_valley_x = x_a[lower_valley_idxs.max()] if len(lower_valley_idxs) > 0 else None
+    return filtered_intensity_a, x_a[apex_idx], lower_valley_x, upper_valley_x
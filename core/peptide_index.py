@@ -0,0 +1,183 @@
+import os
+import shutil
+import hashlib
+import fcntl
+import json
+import time
+import re
+import subprocess
+import tempfile
+
+# Comet can search a peptide index of the sequence database rather than digesting the FASTA for every search. The
+# index depends only on the FASTA and the parameters that determine the digestion, so it's built once for each
+# combination of them and kept in a cache directory, where the searches of all the runs, and of the recalibrated
+# features, find it.
+#
+# The index is built with a standalone Comet, which only reads parameter files in its own format with its own version
+# in them, so the build is given a native parameter file made from the Comet settings of the Crux parameter file. The
+# index's format depends on the Comet that built it, so its version is part of the key, and the searches check before
+# they start that the Comet bundled with Crux is the same version.
+
+INDEX_VERSION = 1
+
+# the parameters that only affect how the spectra are matched, not which peptides are in the index; they're left out
+# of the key so the initial and recalibration parameter files share an index
+SEARCH_ONLY_PARAMETERS = ['peptide_mass_tolerance', 'peptide_mass_units', 'precursor_tolerance_type', 'isotope_error', 'num_threads', 'spectrum_batch_size', 'verbosity', 'output-dir', 'fileroot', 'parameter-file']
+
+# the line of Comet's usage, and of a parameter file, that gives its version
+COMET_USAGE_VERSION_PATTERN = re.compile(r'Comet version\s+"([^"]+)"')
+PARAMS_VERSION_PATTERN = re.compile(r'^#\s*comet_version\s+(.+?)\s*$')
+
+# the line of a Crux parameter file that precedes its Comet settings, and the section that ends a Comet parameter file
+CRUX_COMET_PARAMETERS_HEADING = '# Comet Parameters #'
+COMET_ENZYME_INFO_SECTION = '[COMET_ENZYME_INFO]'
+
+# how long to wait for Comet to print its usage
+COMET_VERSION_TIMEOUT_SECS = 60
+
+# Crux doesn't report the version of its Comet other than in the parameters a search writes, so it's found by searching
+# a single spectrum against a single protein, and recorded in the cache directory for each Crux executable
+CRUX_COMET_VERSIONS_FILE = 'crux-comet-versions.json'
+CRUX_COMET_PROBE_TIMEOUT_SECS = 300
+CRUX_COMET_PROBE_MGF = 'BEGIN IONS\nTITLE=probe\nPEPMASS=500.0\nCHARGE=2+\nSCANS=1\n200.0 100\n300.0 100\n400.0 100\nEND IONS\n'
+CRUX_COMET_PROBE_FASTA = '>probe\nMKAAAAAAAKAAAAAAAKAAAAAAAK\n'
+
+# the hash of a file's contents
+def file_hash(file_name):
+    h = hashlib.sha1()
+    with open(file_name, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# the parameter file's settings that determine the digestion, as a sorted list of (name,value)
+def digestion_parameters(param_file):
+    params_l = []
+    with open(param_file, 'r') as handle:
+        for line in handle:
+            line = line.split('#', 1)[0].strip()
+            if '=' not in line:
+                continue
+            name, value = [s.strip() for s in line.split('=', 1)]
+            if name not in SEARCH_ONLY_PARAMETERS:
+                params_l.append((name, value))
+    return sorted(params_l)
+
+# the version of the Comet executable, from the usage it prints when it's run without arguments, or None if it can't
+# be run or doesn't say
+def comet_version(comet_executable):
+    try:
+        completed = subprocess.run([comet_executable], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=COMET_VERSION_TIMEOUT_SECS)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    match = COMET_USAGE_VERSION_PATTERN.search(completed.stdout.decode('utf-8', errors='replace'))
+    return match.group(1).strip() if match is not None else None
+
+# the Comet version recorded in a parameter file, such as the one a search writes to its output, or None if there
+# isn't one
+def params_comet_version(param_file):
+    with open(param_file, 'r') as handle:
+        for line in handle:
+            match = PARAMS_VERSION_PATTERN.match(line)
+            if match is not None:
+                return match.group(1)
+    return None
+
+# the version of the Comet bundled with the Crux executable, or None if the probe search doesn't record it. It's
+# recorded in the cache directory, keyed by the executable's path, size, and modification time, so the probe search is
+# only run the first time each Crux executable is used.
+def crux_comet_version(crux_executable, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    executable = shutil.which(crux_executable)
+    if executable is None:
+        return None
+    stat = os.stat(executable)
+    key = '{}:{}:{}'.format(os.path.realpath(executable), stat.st_size, int(stat.st_mtime))
+    versions_file = '{}/{}'.format(cache_dir, CRUX_COMET_VERSIONS_FILE)
+    with open('{}.lock'.format(versions_file), 'w') as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        versions_d = {}
+        if os.path.isfile(versions_file):
+            with open(versions_file, 'r') as handle:
+                versions_d = json.load(handle)
+        if key in versions_d:
+            return versions_d[key]
+
+        # search the probe spectrum and read the version from the parameters the search writes
+        probe_dir = tempfile.mkdtemp(prefix='crux-comet-probe-', dir=cache_dir)
+        try:
+            with open('{}/probe.mgf'.format(probe_dir), 'w') as handle:
+                handle.write(CRUX_COMET_PROBE_MGF)
+            with open('{}/probe.fasta'.format(probe_dir), 'w') as handle:
+                handle.write(CRUX_COMET_PROBE_FASTA)
+            try:
+                subprocess.run([executable, 'comet', '--output-dir', '{}/output'.format(probe_dir), '--fileroot', 'probe', '{}/probe.mgf'.format(probe_dir), '{}/probe.fasta'.format(probe_dir)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=CRUX_COMET_PROBE_TIMEOUT_SECS)
+            except (OSError, subprocess.TimeoutExpired):
+                return None
+            params_file = '{}/output/probe.comet.params.txt'.format(probe_dir)
+            version = params_comet_version(params_file) if os.path.isfile(params_file) else None
+        finally:
+            shutil.rmtree(probe_dir)
+        if version is not None:
+            versions_d[key] = version
+            with open(versions_file, 'w') as handle:
+                json.dump(versions_d, handle, indent=2)
+        return version
+
+# write a parameter file for the standalone Comet of the given version, with the Comet settings of the Crux parameter
+# file and its enzyme table. A file without Crux's heading for the Comet settings is taken to be all Comet settings.
+def write_comet_params(param_file, version, output_file):
+    with open(param_file, 'r') as handle:
+        lines_l = handle.read().splitlines()
+    heading_idxs_l = [idx for idx,line in enumerate(lines_l) if line.strip() == CRUX_COMET_PARAMETERS_HEADING]
+    first_idx = heading_idxs_l[0] + 1 if len(heading_idxs_l) > 0 else 0
+    with open(output_file, 'w') as handle:
+        handle.write('# comet_version {}\n'.format(version))
+        handle.write('# the Comet settings of {}\n'.format(os.path.abspath(param_file)))
+        in_enzyme_info = False
+        for line in lines_l[first_idx:]:
+            in_enzyme_info = in_enzyme_info or (line.strip() == COMET_ENZYME_INFO_SECTION)
+            if in_enzyme_info or (('=' in line) and not line.lstrip().startswith('#')):
+                handle.write('{}\n'.format(line))
+
+# the key of the index for the FASTA, the parameter file, and the version of Comet that builds it
+def index_key(fasta_file, param_file, version):
+    h = hashlib.sha1()
+    h.update(repr((INDEX_VERSION, file_hash(fasta_file), digestion_parameters(param_file), version)).encode('utf-8'))
+    return h.hexdigest()
+
+# return the index for the FASTA and parameter file, built by the given version of Comet, from the cache, building it
+# if it's not there. build_index(fasta, params) indexes the FASTA as fasta+'.idx' and returns the exit status; it's
+# given the native parameter file, which is kept with the index. Builds of the same index by concurrent searches are
+# serialised with a lock, so it's built once. Returns the index file and whether it was built, or None for the index
+# if it couldn't be built.
+def cached_index(fasta_file, param_file, version, cache_dir, build_index):
+    os.makedirs(cache_dir, exist_ok=True)
+    key = index_key(fasta_file, param_file, version)
+    index_dir = '{}/{}'.format(cache_dir, key)
+    index_file = '{}/{}.idx'.format(index_dir, os.path.basename(fasta_file))
+    with open('{}/{}.lock'.format(cache_dir, key), 'w') as lock_handle:
+        fcntl.flock(lock_handle, fcntl.LOCK_EX)
+        if os.path.isfile(index_file):
+            return index_file, False
+
+        # build the index in a temporary directory and rename it when it's complete, so an interrupted build is
+        # never mistaken for an index
+        temp_index_dir = '{}-tmp-{}'.format(index_dir, os.getpid())
+        if os.path.exists(temp_index_dir):
+            shutil.rmtree(temp_index_dir)
+        os.makedirs(temp_index_dir)
+        temp_fasta_file = '{}/{}'.format(temp_index_dir, os.path.basename(fasta_file))
+        shutil.copyfile(fasta_file, temp_fasta_file)
+        temp_param_file = '{}/comet.params'.format(temp_index_dir)
+        write_comet_params(param_file, version, temp_param_file)
+        exit_status = build_index(temp_fasta_file, temp_param_file)
+        if (exit_status != 0) or not os.path.isfile('{}.idx'.format(temp_fasta_file)):
+            shutil.rmtree(temp_index_dir)
+            return None, False
+        with open('{}/index.json'.format(temp_index_dir), 'w') as handle:
+            json.dump({'fasta_file':os.path.abspath(fasta_file), 'param_file':os.path.abspath(param_file), 'comet_version':version, 'key':key, 'built':time.ctime()}, handle)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+        os.replace(temp_index_dir, index_dir)
+    return index_file, True
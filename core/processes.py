@@ -0,0 +1,128 @@
+import asyncio
+import os
+import subprocess
+import time
+import signal
+import json
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+
+# Runs the external tools the pipeline depends on, such as crux and the per-run scripts. The commands are run as
+# argument lists rather than through a shell, at most a given number at a time, with their output written to log
+# files. Each invocation's wall time, CPU time, and peak resident memory are recorded, and an invocation can be
+# killed if it runs for too long. Each command is started in its own session, so when it's killed its whole process
+# group goes with it, including any processes it started itself, such as the Comet that crux runs.
+#
+# The commands are scheduled with asyncio, and each one is waited on in a worker thread with os.wait4, so its CPU time
+# is its own rather than that of all the children of the process. The peak memory os.wait4 reports for a child
+# includes what the parent had when it forked, so instead the child's high-water mark is read from /proc while it
+# runs.
+
+# the crux executable; it can be pointed elsewhere, for example at a stub for testing, with the environment variable
+CRUX_EXECUTABLE_VARIABLE = 'TFDE_CRUX_EXECUTABLE'
+DEFAULT_CRUX_EXECUTABLE = '~/crux-4.0.Linux.x86_64/bin/crux'
+
+# the exit status recorded for a command that couldn't be started
+EXIT_STATUS_NOT_STARTED = 127
+
+# how often a running command is checked for having finished, timed out, and its memory
+POLL_INTERVAL_SECS = 0.1
+
+# the crux executable to run
+def crux_executable():
+    return os.path.expanduser(os.environ.get(CRUX_EXECUTABLE_VARIABLE, DEFAULT_CRUX_EXECUTABLE))
+
+# describe a command to run. The standard error goes to the same log as the standard output if there's no file
+# for it. The command is killed if it runs for longer than the timeout in seconds.
+def command(args_l, stdout_file, stderr_file=None, timeout=None, cwd=None):
+    return {'args':[str(a) for a in args_l], 'stdout_file':stdout_file, 'stderr_file':stderr_file, 'timeout':timeout, 'cwd':cwd}
+
+# the peak resident memory of a running process in KB, or 0 if it can't be read
+def high_water_rss_kb(pid):
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as handle:
+            for line in handle:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+# the command as it would be typed in a shell, for the log
+def command_line(cmd):
+    return ' '.join(shlex.quote(a) for a in cmd['args'])
+
+# run the command and wait for it to finish, returning its exit status and resource usage
+def run_command_blocking(cmd):
+    print("Executing: {}".format(command_line(cmd)))
+    result = {'command':command_line(cmd), 'stdout_file':cmd['stdout_file'], 'stderr_file':cmd['stderr_file'], 'timed_out':False}
+    start_time = time.perf_counter()
+    stdout_handle = open(cmd['stdout_file'], 'w')
+    stderr_handle = open(cmd['stderr_file'], 'w') if cmd['stderr_file'] is not None else None
+    try:
+        try:
+            process = subprocess.Popen(cmd['args'], stdout=stdout_handle, stderr=stderr_handle if stderr_handle is not None else subprocess.STDOUT, cwd=cmd['cwd'], start_new_session=True)
+        except OSError as e:
+            (stderr_handle if stderr_handle is not None else stdout_handle).write('{}\n'.format(e))
+            result.update({'exit_status':EXIT_STATUS_NOT_STARTED, 'wall_secs':0.0, 'user_cpu_secs':0.0, 'system_cpu_secs':0.0, 'peak_rss_mb':0.0})
+            print('command could not be started: {}'.format(e))
+            return result
+
+        # wait for the process to finish, killing it if it runs for too long
+        peak_rss_kb = 0
+        while True:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            peak_rss_kb = max(peak_rss_kb, high_water_rss_kb(process.pid))
+            if (cmd['timeout'] is not None) and (not result['timed_out']) and (time.perf_counter()-start_time > cmd['timeout']):
+                result['timed_out'] = True
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+            time.sleep(POLL_INTERVAL_SECS)
+    finally:
+        stdout_handle.close()
+        if stderr_handle is not None:
+            stderr_handle.close()
+
+    # if the process finished before its memory could be read, fall back to what os.wait4 reported
+    if peak_rss_kb == 0:
+        peak_rss_kb = rusage.ru_maxrss
+    # a process killed by a signal has the negative of the signal as its exit status, as in subprocess
+    exit_status = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    process.returncode = exit_status
+    result.update({'exit_status':exit_status, 'wall_secs':round(time.perf_counter()-start_time,3), 'user_cpu_secs':round(rusage.ru_utime,3), 'system_cpu_secs':round(rusage.ru_stime,3), 'peak_rss_mb':round(peak_rss_kb/1024,1)})
+    print('command finished in {} seconds with an exit status of {} (cpu {} seconds, peak RSS {} MB)'.format(result['wall_secs'], exit_status, round(result['user_cpu_secs']+result['system_cpu_secs'],1), result['peak_rss_mb']))
+    if result['timed_out']:
+        print('command was killed after {} seconds: {}'.format(cmd['timeout'], result['command']))
+    return result
+
+# append the command's result to the resources file as a line of JSON
+def record_result(resources_file, result):
+    with open(resources_file, 'a') as handle:
+        handle.write('{}\n'.format(json.dumps(dict(result, finished=time.ctime()))))
+
+# run the commands, at most maximum_concurrent at a time, and return their results in the same order. Each result is
+# recorded as soon as its command finishes, so the record is complete up to the commands that are still running.
+async def run_commands_async(commands_l, maximum_concurrent, resources_file):
+    semaphore = asyncio.Semaphore(maximum_concurrent)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=maximum_concurrent) as executor:
+        async def run_when_allowed(cmd):
+            async with semaphore:
+                result = await loop.run_in_executor(executor, run_command_blocking, cmd)
+            if resources_file is not None:
+                record_result(resources_file, result)
+            return result
+        return await asyncio.gather(*[run_when_allowed(cmd) for cmd in commands_l])
+
+# run the commands, at most maximum_concurrent at a time, and return their results in the same order. If a resources
+# file is given, each invocation's result is appended to it as a line of JSON when it finishes.
+def run_commands(commands_l, maximum_concurrent=1, resources_file=None):
+    return asyncio.run(run_commands_async(commands_l, max(maximum_concurrent, 1), resources_file))
+
+# run a single command and return its result
+def run_command(cmd, resources_file=None):
+    return run_commands([cmd], maximum_concurrent=1, resources_file=resources_file)[0]
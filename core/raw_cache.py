@@ -0,0 +1,160 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import shutil
+import alphatims.bruker
+from filelock import FileLock
+
+# A run's raw points are cached next to its HDF as a directory of .npy files, one for each array needed to slice the
+# points. The cache is created once for the run and memory-mapped by each step that needs it, so opening it takes a
+# fraction of a second and concurrent steps share the same pages.
+
+CACHE_VERSION = 1
+CACHE_ARRAYS = ['push_indptr','tof_indices','intensity_values','mz_values','rt_values','frame_types']
+CACHE_METADATA_FILE = 'metadata.json'
+
+# the location of the run's raw data cache
+def cache_path(raw_database_base_dir, run_name):
+    return '{}/{}.cache'.format(raw_database_base_dir, run_name)
+
+# the lock held while the run's raw data is being converted
+def lock_path(raw_database_base_dir, run_name):
+    return '{}/{}.lock'.format(raw_database_base_dir, run_name)
+
+# gather the arrays from the TimsTOF object that are needed to slice raw points
+def raw_data_arrays(data):
+    # the frame type of each frame index; the frame indices are the frame IDs
+    frame_types_a = np.full(data.frame_max_index, -1, dtype=np.int16)
+    frame_types_a[data.frames.Id.values] = data.frames.MsMsType.values
+    return {
+        'push_indptr':data.push_indptr,
+        'tof_indices':data.tof_indices,
+        'intensity_values':data.intensity_values,
+        'mz_values':data.mz_values,
+        'rt_values':data.rt_values,
+        'frame_types':frame_types_a,
+        'scan_max_index':data.scan_max_index
+    }
+
+# check whether the run's cache exists and was written by this version
+def cache_is_valid(cache_dir):
+    metadata_file = '{}/{}'.format(cache_dir, CACHE_METADATA_FILE)
+    if not os.path.isfile(metadata_file):
+        return False
+    with open(metadata_file) as handle:
+        metadata_d = json.load(handle)
+    return metadata_d.get('version') == CACHE_VERSION
+
+# write the raw data arrays to the cache. The arrays are written to a temporary directory that's renamed when
+# it's complete, so a reader never sees a partial cache.
+def write_cache(raw_d, cache_dir):
+    temp_dir = '{}-tmp-{}'.format(cache_dir, os.getpid())
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    for name in CACHE_ARRAYS:
+        np.save('{}/{}.npy'.format(temp_dir, name), np.ascontiguousarray(raw_d[name]))
+    # the metadata is written last; its presence marks the cache as complete
+    with open('{}/{}'.format(temp_dir, CACHE_METADATA_FILE), 'w') as handle:
+        json.dump({'version':CACHE_VERSION, 'scan_max_index':int(raw_d['scan_max_index'])}, handle)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.rename(temp_dir, cache_dir)
+
+# open the run's cache, memory-mapping the arrays. Only the pages touched by a slice are read from disk.
+def open_cache(cache_dir):
+    with open('{}/{}'.format(cache_dir, CACHE_METADATA_FILE)) as handle:
+        metadata_d = json.load(handle)
+    raw_d = {name:np.load('{}/{}.npy'.format(cache_dir, name), mmap_mode='r') for name in CACHE_ARRAYS}
+    raw_d['scan_max_index'] = metadata_d['scan_max_index']
+    return raw_d
+
+# load the run's raw data from the HDF, converting the raw database first if necessary
+def load_timstof(raw_database_base_dir, run_name):
+    raw_database_name = '{}/{}.d'.format(raw_database_base_dir, run_name)
+    raw_hdf_file = '{}.hdf'.format(run_name)
+    raw_hdf_path = '{}/{}'.format(raw_database_base_dir, raw_hdf_file)
+    if not os.path.isfile(raw_hdf_path):
+        print('{} doesn\'t exist so loading the raw data from {}'.format(raw_hdf_path, raw_database_name))
+        data = alphatims.bruker.TimsTOF(raw_database_name)
+        # save to a temporary file and rename it when it's complete, so a reader never sees a partial HDF
+        temp_hdf_file = '{}-tmp-{}.hdf'.format(run_name, os.getpid())
+        print('saving to {}'.format(raw_hdf_path))
+        _ = data.save_as_hdf(
+            directory=raw_database_base_dir,
+            file_name=temp_hdf_file,
+            overwrite=True
+        )
+        os.replace('{}/{}'.format(raw_database_base_dir, temp_hdf_file), raw_hdf_path)
+    else:
+        print('loading raw data from {}'.format(raw_hdf_path))
+        data = alphatims.bruker.TimsTOF(raw_hdf_path)
+    return data
+
+# convert the run's raw database to the HDF and the raw data cache if they don't exist, and return the cache's
+# location. The conversion holds a lock on the run, so when several steps start at once only one of them converts
+# it and the others wait and use the result.
+def convert_raw(raw_database_base_dir, run_name):
+    cache_dir = cache_path(raw_database_base_dir, run_name)
+    if not cache_is_valid(cache_dir):
+        with FileLock(lock_path(raw_database_base_dir, run_name)):
+            # check again, in case another process converted the run while we were waiting for the lock
+            if not cache_is_valid(cache_dir):
+                data = load_timstof(raw_database_base_dir, run_name)
+                print('writing the raw data cache to {}'.format(cache_dir))
+                write_cache(raw_data_arrays(data), cache_dir)
+                del data
+    return cache_dir
+
+# open the run's raw data cache, converting the raw database if it hasn't been
+def load_raw_data(raw_database_base_dir, run_name):
+    cache_dir = convert_raw(raw_database_base_dir, run_name)
+    print('opening the raw data cache {}'.format(cache_dir))
+    return open_cache(cache_dir)
+
+# find the indices of the frames of the specified type in the RT range, lower-inclusive like a TimsTOF query
+def frames_in_rt_range(raw_d, rt_lower, rt_upper, frame_type):
+    frame_indices = np.arange(np.searchsorted(raw_d['rt_values'], rt_lower, 'left'), np.searchsorted(raw_d['rt_values'], rt_upper, 'left'))
+    return frame_indices[raw_d['frame_types'][frame_indices] == frame_type]
+
+# find the indices of the frames of the specified type in the frame range (inclusive)
+def frames_in_frame_range(raw_d, frame_lower, frame_upper, frame_type):
+    frame_indices = np.arange(max(int(frame_lower), 0), min(int(frame_upper)+1, len(raw_d['frame_types'])))
+    return frame_indices[raw_d['frame_types'][frame_indices] == frame_type]
+
+# slice the raw points in the specified frames, scan range (inclusive), and m/z range (lower-inclusive) from the
+# raw data arrays; only the selected points are copied
+def slice_raw_points(raw_d, frame_indices, scan_lower, scan_upper, mz_lower=None, mz_upper=None):
+    push_indptr = raw_d['push_indptr']
+    scan_max_index = raw_d['scan_max_index']
+    scan_lower = max(int(scan_lower), 0)
+    scan_upper = min(int(scan_upper), scan_max_index-1)
+    # a frame's points within a scan range are contiguous, so there is one range of raw indices for each frame
+    starts = push_indptr[frame_indices*scan_max_index + scan_lower]
+    ends = push_indptr[frame_indices*scan_max_index + scan_upper + 1]
+    lengths = np.clip(ends - starts, 0, None)
+    raw_indices = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+    tof_indices = raw_d['tof_indices'][raw_indices]
+    # the m/z values are ordered by tof index, so the m/z range is a tof index range
+    if mz_lower is not None:
+        tof_lower = np.searchsorted(raw_d['mz_values'], mz_lower, 'left')
+        tof_upper = np.searchsorted(raw_d['mz_values'], mz_upper, 'left')
+        selected = (tof_indices >= tof_lower) & (tof_indices < tof_upper)
+        raw_indices = raw_indices[selected]
+        tof_indices = tof_indices[selected]
+    push_indices = np.searchsorted(push_indptr, raw_indices, 'right') - 1
+    frame_ids = push_indices // scan_max_index
+    points_df = pd.DataFrame({'mz':raw_d['mz_values'][tof_indices], 'scan':push_indices % scan_max_index, 'frame_id':frame_ids, 'retention_time_secs':raw_d['rt_values'][frame_ids], 'intensity':raw_d['intensity_values'][raw_indices]})
+    # downcast the data types to minimise the memory used
+    int_columns = ['frame_id','scan','intensity']
+    points_df[int_columns] = points_df[int_columns].apply(pd.to_numeric, downcast="unsigned")
+    float_columns = ['retention_time_secs']
+    points_df[float_columns] = points_df[float_columns].apply(pd.to_numeric, downcast="float")
+    return points_df
+
+# slice the raw points of the specified frame type in an RT range (lower-inclusive), scan range (inclusive), and
+# m/z range (lower-inclusive)
+def slice_points(raw_d, rt_lower, rt_upper, scan_lower, scan_upper, frame_type, mz_lower=None, mz_upper=None):
+    frame_indices = frames_in_rt_range(raw_d, rt_lower=rt_lower, rt_upper=rt_upper, frame_type=frame_type)
+    return slice_raw_points(raw_d, frame_indices, scan_lower=scan_lower, scan_upper=scan_upper, mz_lower=mz_lower, mz_upper=mz_upper)
@@ -0,0 +1,100 @@
+import pandas as pd
+import numpy as np
+import sys
+import os
+import argparse
+import time
+import configparser
+from configparser import ExtendedInterpolation
+
+# Compare finding the features to keep for remove-duplicate-features.py, which looks up each feature's candidate
+# duplicates with a binary search on charge and m/z, against the way it used to be done, filtering the whole feature
+# list for each feature in an itertuples loop. The keep lists must be the same; the previous implementation is only
+# run at the smallest size because its cost grows with the square of the number of features.
+
+# the library code shared between the scripts is in the repository's base directory
+TFDE_BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(1, TFDE_BASE_DIR)
+from core import duplicates
+
+DEFAULT_INI_FILE = '{}/pipeline/pasef-process-short-gradient.ini'.format(TFDE_BASE_DIR)
+
+# the proportion of the features that are a detection of another feature, and how far they're displaced from it
+DUPLICATE_PROPORTION = 0.3
+DUPLICATE_MZ_SPREAD_PPM = 8
+DUPLICATE_SCAN_SPREAD = 15
+DUPLICATE_RT_SPREAD = 4
+
+# the previous implementation, frozen as it was
+def find_features_to_keep_itertuples(features_df):
+    keep_l = []
+    features_processed = set()
+    for row in features_df.itertuples():
+        if row.feature_id not in features_processed:
+            df = features_df[(row.charge == features_df.charge) & (row.dup_mz >= features_df.dup_mz_lower) & (row.dup_mz <= features_df.dup_mz_upper) & (row.scan_apex >= features_df.dup_scan_lower) & (row.scan_apex <= features_df.dup_scan_upper) & (row.rt_apex >= features_df.dup_rt_lower) & (row.rt_apex <= features_df.dup_rt_upper)]
+            keep_l.append(row.feature_id)
+            # record the features that have been processed
+            features_processed.update(set(df.feature_id.tolist()))
+    return keep_l
+
+# random features over a run's m/z, mobility, and retention time ranges, some of them near-duplicates of others, with
+# the dup_* columns set up and sorted as the script does for the PASEF features
+def synthetic_features(rng, number_of_features, mz_tolerance_percent, scan_tolerance, rt_tolerance):
+    number_of_originals = number_of_features - int(number_of_features * DUPLICATE_PROPORTION)
+    mz_a = rng.uniform(300, 1700, number_of_originals)
+    scan_a = rng.uniform(50, 900, number_of_originals)
+    rt_a = rng.uniform(1650, 2200, number_of_originals)
+    charge_a = rng.integers(1, 5, number_of_originals)
+    duplicate_of_a = rng.integers(0, number_of_originals, number_of_features - number_of_originals)
+    features_df = pd.DataFrame({
+        'feature_id':np.arange(number_of_features) + 1,
+        'charge':np.concatenate((charge_a, charge_a[duplicate_of_a])),
+        'monoisotopic_mz':np.concatenate((mz_a, mz_a[duplicate_of_a] * (1 + rng.uniform(-DUPLICATE_MZ_SPREAD_PPM, DUPLICATE_MZ_SPREAD_PPM, len(duplicate_of_a)) * 1e-6))),
+        'scan_apex':np.concatenate((scan_a, scan_a[duplicate_of_a] + rng.uniform(-DUPLICATE_SCAN_SPREAD, DUPLICATE_SCAN_SPREAD, len(duplicate_of_a)))),
+        'rt_apex':np.concatenate((rt_a, rt_a[duplicate_of_a] + rng.uniform(-DUPLICATE_RT_SPREAD, DUPLICATE_RT_SPREAD, len(duplicate_of_a)))),
+        'deconvolution_score':rng.uniform(0, 1000, number_of_features)})
+    features_df['dup_mz'] = features_df['monoisotopic_mz']
+    features_df['dup_mz_ppm_tolerance'] = features_df.dup_mz * mz_tolerance_percent / 100
+    features_df['dup_mz_lower'] = features_df.dup_mz - features_df.dup_mz_ppm_tolerance
+    features_df['dup_mz_upper'] = features_df.dup_mz + features_df.dup_mz_ppm_tolerance
+    features_df['dup_scan_lower'] = features_df.scan_apex - scan_tolerance
+    features_df['dup_scan_upper'] = features_df.scan_apex + scan_tolerance
+    features_df['dup_rt_lower'] = features_df.rt_apex - rt_tolerance
+    features_df['dup_rt_upper'] = features_df.rt_apex + rt_tolerance
+    features_df.sort_values(by=['deconvolution_score'], ascending=False, ignore_index=True, inplace=True)
+    return features_df
+
+parser = argparse.ArgumentParser(description='Benchmark finding the duplicate features.')
+parser.add_argument('-cn','--compare_number_of_features', type=int, default=10000, help='Number of features to compare with the previous implementation.', required=False)
+parser.add_argument('-tn','--time_number_of_features', type=int, nargs='+', default=[100000,1000000], help='Numbers of features to time the binary search at.', required=False)
+parser.add_argument('-s','--seed', type=int, default=0, help='Seed for the synthetic features.', required=False)
+parser.add_argument('-ini','--ini_file', type=str, default=DEFAULT_INI_FILE, help='Path to the config file.', required=False)
+args = parser.parse_args()
+
+# the tolerances the PASEF features are de-duplicated with
+cfg = configparser.ConfigParser(interpolation=ExtendedInterpolation())
+cfg.read(args.ini_file)
+MZ_TOLERANCE_PERCENT = cfg.getint('ms1', 'DUP_MZ_TOLERANCE_PPM') * 10**-4
+DUP_SCAN_TOLERANCE = cfg.getint('ms1', 'DUP_SCAN_TOLERANCE')
+DUP_RT_TOLERANCE = cfg.getint('ms1', 'DUP_RT_TOLERANCE')
+
+rng = np.random.default_rng(args.seed)
+
+# check the keep lists are the same
+features_df = synthetic_features(rng, args.compare_number_of_features, MZ_TOLERANCE_PERCENT, DUP_SCAN_TOLERANCE, DUP_RT_TOLERANCE)
+start_time = time.perf_counter()
+previous_keep_l = find_features_to_keep_itertuples(features_df)
+previous_secs = time.perf_counter() - start_time
+start_time = time.perf_counter()
+keep_l = duplicates.find_features_to_keep(features_df, mz_tolerance_percent=MZ_TOLERANCE_PERCENT)
+binary_search_secs = time.perf_counter() - start_time
+assert previous_keep_l == keep_l, 'the keep list differs from the previous implementation for {} features'.format(len(features_df))
+print('keep list matches the previous implementation for {} features ({} kept)'.format(len(features_df), len(keep_l)))
+print('{} features: previous implementation {} seconds, binary search {} seconds ({}x)'.format(len(features_df), round(previous_secs,2), round(binary_search_secs,3), round(previous_secs / binary_search_secs)))
+
+# time the binary search at the larger sizes
+for number_of_features in args.time_number_of_features:
+    features_df = synthetic_features(rng, number_of_features, MZ_TOLERANCE_PERCENT, DUP_SCAN_TOLERANCE, DUP_RT_TOLERANCE)
+    start_time = time.perf_counter()
+    keep_l = duplicates.find_features_to_keep(features_df, mz_tolerance_percent=MZ_TOLERANCE_PERCENT)
+    print('{} features: binary search {} seconds ({} kept)'.format(number_of_features, round(time.perf_counter() - start_time,2), len(keep_l)))
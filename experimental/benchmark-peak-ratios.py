@@ -0,0 +1,60 @@
+import numpy as np
+import sys
+import os
+import argparse
+import timeit
+
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import isotope_model
+
+# Compare the cost of predicting isotopic peak height ratios with the shared model against the way the scripts used
+# to do it, rebuilding the model's object arrays on every call.
+
+# the previous implementation; it builds the model for each ratio it predicts
+def peak_ratio_rebuilding_model(monoisotopic_mass, peak_number, number_of_sulphur):
+    model_params = np.empty(isotope_model.MAX_NUMBER_OF_SULPHUR_ATOMS, dtype=np.ndarray)
+    for sulphurs in range(isotope_model.MAX_NUMBER_OF_SULPHUR_ATOMS):
+        S_r = np.empty(isotope_model.MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
+        for peak in range(1,isotope_model.MAX_NUMBER_OF_PREDICTED_RATIOS+1):
+            S_r[peak] = np.array(isotope_model.MODEL_PARAMS_L[sulphurs][peak])
+        model_params[sulphurs] = S_r
+
+    ratio = None
+    if ((1 <= peak_number <= isotope_model.MAX_NUMBER_OF_PREDICTED_RATIOS) and (0 <= number_of_sulphur < isotope_model.MAX_NUMBER_OF_SULPHUR_ATOMS) and
+        (isotope_model.MODEL_MASS_LOWER_L[number_of_sulphur][peak_number] <= monoisotopic_mass <= isotope_model.MODEL_MASS_UPPER_L[number_of_sulphur])):
+        beta0 = model_params[number_of_sulphur][peak_number][0]
+        beta1 = model_params[number_of_sulphur][peak_number][1]
+        beta2 = model_params[number_of_sulphur][peak_number][2]
+        beta3 = model_params[number_of_sulphur][peak_number][3]
+        beta4 = model_params[number_of_sulphur][peak_number][4]
+        scaled_m = monoisotopic_mass / 1000.0
+        ratio = beta0 + (beta1*scaled_m) + beta2*(scaled_m**2) + beta3*(scaled_m**3) + beta4*(scaled_m**4)
+    return ratio
+
+parser = argparse.ArgumentParser(description='Benchmark the prediction of isotopic peak height ratios.')
+parser.add_argument('-n','--number_of_ratios', type=int, default=100000, help='Number of ratios to predict.', required=False)
+parser.add_argument('-r','--repeats', type=int, default=3, help='Number of times to repeat each measurement; the fastest is reported.', required=False)
+args = parser.parse_args()
+
+# random masses, peaks, and sulphur counts, some of them outside the model's range
+rng = np.random.default_rng(0)
+masses_a = rng.uniform(400, 4500, args.number_of_ratios)
+peak_numbers_a = rng.integers(1, isotope_model.MAX_NUMBER_OF_PREDICTED_RATIOS+1, args.number_of_ratios)
+sulphurs_a = rng.integers(0, isotope_model.MAX_NUMBER_OF_SULPHUR_ATOMS, args.number_of_ratios)
+coords_l = list(zip(masses_a.tolist(), peak_numbers_a.tolist(), sulphurs_a.tolist()))
+
+# check the implementations agree
+rebuilt_a = np.array([peak_ratio_rebuilding_model(m, p, s) for m,p,s in coords_l], dtype=float)
+scalar_a = np.array([isotope_model.peak_ratio(m, p, s) for m,p,s in coords_l], dtype=float)
+vector_a = isotope_model.peak_ratios(masses_a, peak_numbers_a, sulphurs_a)
+print('scalar matches the previous implementation: {}'.format(np.array_equal(rebuilt_a, scalar_a, equal_nan=True)))
+print('vectorised maximum difference from the previous implementation: {}'.format(np.nanmax(np.abs(rebuilt_a - vector_a))))
+
+# time each implementation
+timings_l = []
+timings_l.append(('rebuilding the model for each ratio', min(timeit.repeat(lambda: [peak_ratio_rebuilding_model(m, p, s) for m,p,s in coords_l], number=1, repeat=args.repeats))))
+timings_l.append(('shared model, one ratio at a time', min(timeit.repeat(lambda: [isotope_model.peak_ratio(m, p, s) for m,p,s in coords_l], number=1, repeat=args.repeats))))
+timings_l.append(('shared model, vectorised', min(timeit.repeat(lambda: isotope_model.peak_ratios(masses_a, peak_numbers_a, sulphurs_a), number=1, repeat=args.repeats))))
+for name,seconds in timings_l:
+    print('{}: {} us per ratio ({}x)'.format(name, round(seconds / args.number_of_ratios * 1e6, 4), round(timings_l[0][1] / seconds, 1)))
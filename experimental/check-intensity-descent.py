@@ -0,0 +1,78 @@
+import numpy as np
+import sys
+import os
+import argparse
+import timeit
+
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import peaks
+
+# Check the single-pass intensity descent in core.peaks against the way the scripts used to do it, finding the most
+# intense remaining point with argmax and deleting each peak's points from the array. The NumPy implementation must
+# give exactly the same peaks, and the numba kernel, when numba is available, the same to within rounding.
+
+INSTRUMENT_RESOLUTION = 40000.0
+KERNEL_RELATIVE_TOLERANCE = 1e-12
+
+# the previous implementation, frozen as it was
+def intensity_descent_deleting_points(peaks_a, peak_delta=None):
+    peaks_l = []
+    while len(peaks_a) > 0:
+        # find the most intense point
+        max_intensity_index = np.argmax(peaks_a[:,1])
+        peak_mz = peaks_a[max_intensity_index,0]
+        if peak_delta == None:
+            peak_delta = peaks.calculate_peak_delta(mz=peak_mz, instrument_resolution=INSTRUMENT_RESOLUTION)
+        peak_mz_lower = peak_mz - peak_delta
+        peak_mz_upper = peak_mz + peak_delta
+
+        # get all the raw points within this m/z region
+        peak_indexes = np.where((peaks_a[:,0] >= peak_mz_lower) & (peaks_a[:,0] <= peak_mz_upper))[0]
+        if len(peak_indexes) > 0:
+            mz_cent = peaks.intensity_weighted_centroid(peaks_a[peak_indexes,1], peaks_a[peak_indexes,0])
+            summed_intensity = peaks_a[peak_indexes,1].sum()
+            peaks_l.append((mz_cent, summed_intensity))
+            # remove the raw points assigned to this peak
+            peaks_a = np.delete(peaks_a, peak_indexes, axis=0)
+    return np.array(peaks_l)
+
+# a random point set: clusters of points around isotope-like peaks, with integer intensities so there are ties
+def random_points(rng, number_of_points):
+    centres_a = rng.uniform(400, 1600, max(number_of_points // 20, 1))
+    mz_a = rng.choice(centres_a, number_of_points) + rng.normal(0, 0.01, number_of_points)
+    intensity_a = rng.integers(1, 500, number_of_points).astype(float)
+    return np.column_stack((mz_a, intensity_a))
+
+parser = argparse.ArgumentParser(description='Check the single-pass intensity descent against the previous implementation.')
+parser.add_argument('-n','--number_of_point_sets', type=int, default=200, help='Number of random point sets to check.', required=False)
+parser.add_argument('-p','--maximum_points', type=int, default=2000, help='Maximum number of points in a point set.', required=False)
+parser.add_argument('-s','--seed', type=int, default=0, help='Seed for the random point sets.', required=False)
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+point_sets_l = [random_points(rng, int(rng.integers(1, args.maximum_points))) for _ in range(args.number_of_point_sets)]
+point_sets_l.append(np.array([[500.0, 10.0], [500.0, 10.0], [500.001, 10.0]]))  # equal intensities and m/z
+
+# the NumPy implementation must be identical
+for idx,peaks_a in enumerate(point_sets_l):
+    previous_a = intensity_descent_deleting_points(peaks_a)
+    single_pass_a = peaks.intensity_descent(peaks_a, instrument_resolution=INSTRUMENT_RESOLUTION)
+    assert np.array_equal(previous_a, single_pass_a), 'point set {} differs from the previous implementation'.format(idx)
+print('single pass matches the previous implementation exactly for {} point sets'.format(len(point_sets_l)))
+
+# the numba kernel sums in a different order, so it only has to agree to within rounding
+if peaks.NUMBA_AVAILABLE:
+    for idx,peaks_a in enumerate(point_sets_l):
+        previous_a = intensity_descent_deleting_points(peaks_a)
+        kernel_a = peaks.intensity_descent(peaks_a, instrument_resolution=INSTRUMENT_RESOLUTION, use_numba=True)
+        assert previous_a.shape == kernel_a.shape, 'point set {} has a different number of peaks with the kernel'.format(idx)
+        assert np.allclose(previous_a, kernel_a, rtol=KERNEL_RELATIVE_TOLERANCE, atol=0), 'point set {} differs with the kernel'.format(idx)
+    print('numba kernel matches the previous implementation to {} relative for {} point sets'.format(KERNEL_RELATIVE_TOLERANCE, len(point_sets_l)))
+else:
+    print('numba is not available, so the kernel was not checked')
+
+# time each implementation on the largest point set
+largest_a = max(point_sets_l, key=len)
+print('previous implementation: {} ms for {} points'.format(round(min(timeit.repeat(lambda: intensity_descent_deleting_points(largest_a), number=1, repeat=3))*1000, 2), len(largest_a)))
+print('single pass: {} ms'.format(round(min(timeit.repeat(lambda: peaks.intensity_descent(largest_a, instrument_resolution=INSTRUMENT_RESOLUTION), number=1, repeat=3))*1000, 2)))
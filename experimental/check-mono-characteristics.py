@@ -0,0 +1,432 @@
+import pandas as pd
+import numpy as np
+import sys
+import os
+import io
+import math
+import json
+import time
+import argparse
+import configparser
+from configparser import ExtendedInterpolation
+import peakutils
+from scipy import signal
+from sklearn.metrics.pairwise import cosine_similarity
+
+# the library code shared between the scripts is in the repository's base directory
+TFDE_BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(1, TFDE_BASE_DIR)
+from core import peaks
+from core import isotope_model
+from core import mono_characteristics
+
+# Check determine_mono_characteristics, which works on the cuboid's points as arrays, against
+# the way it used to be done with DataFrame group-bys and merges, on synthetic cuboids. The previous implementation
+# measured the similarity of adjacent isotopes by joining their profiles on int(x * scale), and the retention times
+# are float32, so two isotopes' points in the same frame could be scaled to different integers and not be joined.
+# The arrays implementation aligns the profiles by frame, so it's compared with the previous implementation using an
+# exact join, where the outputs must be the same. With the original float32 join, only the retention time similarities
+# and the coelution coefficient can differ, and only within a tolerance; the cuboids where they differ are reported.
+
+DEFAULT_INI_FILE = '{}/pipeline/pasef-process-short-gradient.ini'.format(TFDE_BASE_DIR)
+
+# the outputs holding records as JSON, and the columns of the records that are themselves JSON
+JSON_OUTPUTS = ['isotopic_peaks','scan_df','rt_df']
+JSON_RECORD_COLUMNS = ['rt_df','scan_df']
+RELATIVE_TOLERANCE = 1e-9
+
+# the outputs that can differ with the original float32 join, and how far they can be from the arrays implementation.
+# An isotope can have only a few frames, so a frame the join drops can move its similarity a long way; over 1800
+# cuboids the largest differences were 0.35 in an isotope's similarity and 0.09 in the coelution coefficient.
+FLOAT32_JOIN_OUTPUTS = ['coelution_coefficient','isotopic_peaks.similarity_rt']
+FLOAT32_JOIN_SIMILARITY_RT_TOLERANCE = 0.5
+FLOAT32_JOIN_COELUTION_COEFFICIENT_TOLERANCE = 0.15
+
+# the previous implementation's similarity measure, frozen as it was
+def measure_peak_similarity_float32_join(isotopeA_df, isotopeB_df, x_label, scale):
+    # scale the x axis so we can join them
+    isotopeA_df['x_scaled'] = (isotopeA_df[x_label] * scale).astype(int)
+    isotopeB_df['x_scaled'] = (isotopeB_df[x_label] * scale).astype(int)
+    # combine the isotopes by aligning the x-dimension points they have in common
+    combined_df = pd.merge(isotopeA_df, isotopeB_df, on='x_scaled', how='inner', suffixes=('_A', '_B')).sort_values(by='x_scaled')
+    combined_df = combined_df[['x_scaled','intensity_A','intensity_B']]
+    # calculate the similarity
+    return float(cosine_similarity([combined_df.intensity_A.values], [combined_df.intensity_B.values])[0,0]) if len(combined_df) > 0 else None
+
+# the previous similarity measure with the join on the rounded x values, so points in the same frame are joined
+def measure_peak_similarity_exact_join(isotopeA_df, isotopeB_df, x_label, scale):
+    isotopeA_df['x_scaled'] = np.round(isotopeA_df[x_label].astype(np.float64) * scale).astype(int)
+    isotopeB_df['x_scaled'] = np.round(isotopeB_df[x_label].astype(np.float64) * scale).astype(int)
+    combined_df = pd.merge(isotopeA_df, isotopeB_df, on='x_scaled', how='inner', suffixes=('_A', '_B')).sort_values(by='x_scaled')
+    combined_df = combined_df[['x_scaled','intensity_A','intensity_B']]
+    return float(cosine_similarity([combined_df.intensity_A.values], [combined_df.intensity_B.values])[0,0]) if len(combined_df) > 0 else None
+
+# the previous implementation, frozen as it was apart from taking the similarity measure as an argument and using the
+# peak functions that have since moved to core
+def determine_mono_characteristics_with_dataframes(envelope, mono_mz_lower, mono_mz_upper, monoisotopic_mass, cuboid_points_df, measure_peak_similarity, instrument_resolution, saturation_intensity):
+    INSTRUMENT_RESOLUTION = instrument_resolution
+    SATURATION_INTENSITY = saturation_intensity
+    SCAN_FILTER_POLY_ORDER = mono_characteristics.SCAN_FILTER_POLY_ORDER
+    RT_FILTER_POLY_ORDER = mono_characteristics.RT_FILTER_POLY_ORDER
+    PEAKS_THRESHOLD_SCAN, PEAKS_MIN_DIST_SCAN = mono_characteristics.PEAKS_THRESHOLD_SCAN, mono_characteristics.PEAKS_MIN_DIST_SCAN
+    PEAKS_THRESHOLD_RT, PEAKS_MIN_DIST_RT = mono_characteristics.PEAKS_THRESHOLD_RT, mono_characteristics.PEAKS_MIN_DIST_RT
+    VALLEYS_THRESHOLD_SCAN, VALLEYS_MIN_DIST_SCAN = mono_characteristics.VALLEYS_THRESHOLD_SCAN, mono_characteristics.VALLEYS_MIN_DIST_SCAN
+    VALLEYS_THRESHOLD_RT, VALLEYS_MIN_DIST_RT = mono_characteristics.VALLEYS_THRESHOLD_RT, mono_characteristics.VALLEYS_MIN_DIST_RT
+
+    # determine the raw points that belong to the mono peak
+    # we use the wider cuboid points because we want to discover the apex and extent in CCS and RT
+    mono_points_df = cuboid_points_df[(cuboid_points_df.mz >= mono_mz_lower) & (cuboid_points_df.mz <= mono_mz_upper)]
+
+    # determine the peak's extent in CCS and RT
+    if len(mono_points_df) > 0:
+        # collapsing the monoisotopic's summed points onto the mobility dimension
+        scan_df = mono_points_df.groupby(['scan'], as_index=False).intensity.sum()
+        scan_df.sort_values(by=['scan'], ascending=True, inplace=True)
+
+        # apply a smoothing filter to the points
+        scan_df['filtered_intensity'] = scan_df.intensity  # set the default
+        try:
+            scan_df['filtered_intensity'] = signal.savgol_filter(scan_df.intensity, window_length=peaks.find_filter_length(number_of_points=len(scan_df)), polyorder=SCAN_FILTER_POLY_ORDER)
+        except:
+            pass
+
+        # find the peak(s)
+        peak_x_l = []
+        try:
+            peak_idxs = peakutils.indexes(scan_df.filtered_intensity.values.astype(int), thres=PEAKS_THRESHOLD_SCAN, min_dist=PEAKS_MIN_DIST_SCAN, thres_abs=False)
+            peak_x_l = scan_df.iloc[peak_idxs].scan.to_list()
+        except:
+            pass
+        if len(peak_x_l) == 0:
+            # if we couldn't find any peaks, take the maximum intensity point
+            peak_x_l = [scan_df.loc[scan_df.filtered_intensity.idxmax()].scan]
+        # peaks_df should now contain the rows from flattened_points_df that represent the peaks
+        peaks_df = scan_df[scan_df.scan.isin(peak_x_l)].copy()
+
+        # find the closest peak to the cuboid midpoint
+        cuboid_midpoint_scan = scan_df.scan.min() + ((scan_df.scan.max() - scan_df.scan.min()) / 2)
+        peaks_df['delta'] = abs(peaks_df.scan - cuboid_midpoint_scan)
+        peaks_df.sort_values(by=['delta'], ascending=True, inplace=True)
+        scan_apex = peaks_df.iloc[0].scan
+
+        # find the valleys nearest the scan apex
+        valley_idxs = peakutils.indexes(-scan_df.filtered_intensity.values.astype(int), thres=VALLEYS_THRESHOLD_SCAN, min_dist=VALLEYS_MIN_DIST_SCAN, thres_abs=False)
+        valley_x_l = scan_df.iloc[valley_idxs].scan.to_list()
+        valleys_df = scan_df[scan_df.scan.isin(valley_x_l)]
+
+        upper_x = valleys_df[valleys_df.scan > scan_apex].scan.min()
+        if math.isnan(upper_x):
+            upper_x = scan_df.scan.max()
+        lower_x = valleys_df[valleys_df.scan < scan_apex].scan.max()
+        if math.isnan(lower_x):
+            lower_x = scan_df.scan.min()
+
+        scan_lower = lower_x
+        scan_upper = upper_x
+
+        # constrain the mono points to the CCS extent
+        mono_points_df = mono_points_df[(mono_points_df.scan >= scan_lower) & (mono_points_df.scan <= scan_upper)]
+
+        # in the RT dimension, look wider to find the apex
+        rt_df = mono_points_df.groupby(['frame_id','retention_time_secs'], as_index=False).intensity.sum()
+        rt_df.sort_values(by=['retention_time_secs'], ascending=True, inplace=True)
+
+        # filter the points
+        rt_df['filtered_intensity'] = rt_df.intensity  # set the default
+        try:
+            rt_df['filtered_intensity'] = signal.savgol_filter(rt_df.intensity, window_length=peaks.find_filter_length(number_of_points=len(rt_df)), polyorder=RT_FILTER_POLY_ORDER)
+        except:
+            pass
+
+        # find the peak(s)
+        peak_x_l = []
+        try:
+            peak_idxs = peakutils.indexes(rt_df.filtered_intensity.values.astype(int), thres=PEAKS_THRESHOLD_RT, min_dist=PEAKS_MIN_DIST_RT, thres_abs=False)
+            peak_x_l = rt_df.iloc[peak_idxs].retention_time_secs.to_list()
+        except:
+            pass
+        if len(peak_x_l) == 0:
+            # if we couldn't find any peaks, take the maximum intensity point
+            peak_x_l = [rt_df.loc[rt_df.filtered_intensity.idxmax()].retention_time_secs]
+        # peaks_df should now contain the rows from flattened_points_df that represent the peaks
+        peaks_df = rt_df[rt_df.retention_time_secs.isin(peak_x_l)].copy()
+
+        # find the closest peak to the cuboid midpoint
+        cuboid_midpoint_rt = rt_df.retention_time_secs.min() + ((rt_df.retention_time_secs.max() - rt_df.retention_time_secs.min()) / 2)
+        peaks_df['delta'] = abs(peaks_df.retention_time_secs - cuboid_midpoint_rt)
+        peaks_df.sort_values(by=['delta'], ascending=True, inplace=True)
+        rt_apex = peaks_df.iloc[0].retention_time_secs
+
+        # find the valleys nearest the RT apex
+        valley_idxs = peakutils.indexes(-rt_df.filtered_intensity.values.astype(int), thres=VALLEYS_THRESHOLD_RT, min_dist=VALLEYS_MIN_DIST_RT, thres_abs=False)
+        valley_x_l = rt_df.iloc[valley_idxs].retention_time_secs.to_list()
+        valleys_df = rt_df[rt_df.retention_time_secs.isin(valley_x_l)]
+
+        upper_x = valleys_df[valleys_df.retention_time_secs > rt_apex].retention_time_secs.min()
+        if math.isnan(upper_x):
+            upper_x = rt_df.retention_time_secs.max()
+        lower_x = valleys_df[valleys_df.retention_time_secs < rt_apex].retention_time_secs.max()
+        if math.isnan(lower_x):
+            lower_x = rt_df.retention_time_secs.min()
+
+        rt_lower = lower_x
+        rt_upper = upper_x
+
+        # constrain the mono points to the RT extent
+        mono_points_df = mono_points_df[(mono_points_df.retention_time_secs >= rt_lower) & (mono_points_df.retention_time_secs <= rt_upper)]
+
+        # for the whole feature, constrain the raw points to the CCS and RT extent of the monoisotopic peak
+        mono_ccs_rt_extent_df = cuboid_points_df[(cuboid_points_df.scan >= scan_lower) & (cuboid_points_df.scan <= scan_upper) & (cuboid_points_df.retention_time_secs >= rt_lower) & (cuboid_points_df.retention_time_secs <= rt_upper)]
+
+        # calculate the isotope intensities from the constrained raw points
+        isotopes_l = []
+        for idx,isotope in enumerate(envelope):
+            # gather the points that belong to this isotope
+            iso_mz = isotope[0]
+            iso_intensity = isotope[1]
+            iso_mz_delta = peaks.calculate_peak_delta(iso_mz, instrument_resolution=INSTRUMENT_RESOLUTION)
+            iso_mz_lower = iso_mz - iso_mz_delta
+            iso_mz_upper = iso_mz + iso_mz_delta
+            isotope_df = mono_ccs_rt_extent_df[(mono_ccs_rt_extent_df.mz >= iso_mz_lower) & (mono_ccs_rt_extent_df.mz <= iso_mz_upper)]
+            if len(isotope_df) > 0:
+                # find the intensity by summing the maximum point in the frame closest to the RT apex, and the frame maximums either side
+                frame_maximums_df = isotope_df.groupby(['retention_time_secs'], as_index=False, sort=False).intensity.agg(['max']).reset_index()
+                frame_maximums_df['rt_delta'] = np.abs(frame_maximums_df.retention_time_secs - rt_apex)
+                frame_maximums_df.sort_values(by=['rt_delta'], ascending=True, inplace=True)
+                # sum the maximum intensity and the max intensity of the frame either side in RT
+                summed_intensity = frame_maximums_df[:3]['max'].sum()
+                # are any of the three points in saturation?
+                isotope_in_saturation = (frame_maximums_df[:3]['max'].max() > SATURATION_INTENSITY)
+                # determine the isotope's profile in retention time
+                iso_rt_df = isotope_df.groupby(['retention_time_secs'], as_index=False).intensity.sum()
+                iso_rt_df.sort_values(by=['retention_time_secs'], ascending=True, inplace=True)
+                # measure it's elution similarity with the previous isotope
+                similarity_rt = measure_peak_similarity(pd.read_json(io.StringIO(isotopes_l[idx-1]['rt_df'])), iso_rt_df, x_label='retention_time_secs', scale=100) if idx > 0 else None
+                # determine the isotope's profile in mobility
+                iso_scan_df = isotope_df.groupby(['scan'], as_index=False).intensity.sum()
+                iso_scan_df.sort_values(by=['scan'], ascending=True, inplace=True)
+                # measure it's elution similarity with the previous isotope
+                similarity_scan = measure_peak_similarity(pd.read_json(io.StringIO(isotopes_l[idx-1]['scan_df'])), iso_scan_df, x_label='scan', scale=1) if idx > 0 else None
+                # add the isotope to the list
+                isotopes_l.append({'mz':iso_mz, 'mz_lower':iso_mz_lower, 'mz_upper':iso_mz_upper, 'intensity':summed_intensity, 'saturated':isotope_in_saturation, 'rt_df':iso_rt_df.to_json(orient='records'), 'scan_df':iso_scan_df.to_json(orient='records'), 'similarity_rt':similarity_rt, 'similarity_scan':similarity_scan})
+            else:
+                break
+        isotopes_df = pd.DataFrame(isotopes_l)
+
+        # calculate the coelution coefficient for the isotopic peak series
+        coelution_coefficient = isotopes_df.similarity_rt.mean()
+        mobility_coefficient = isotopes_df.similarity_scan.mean()
+
+        # set the summed intensity and m/z to be the default adjusted intensity for all isotopes
+        isotopes_df['inferred_intensity'] = isotopes_df.intensity
+        isotopes_df['inferred'] = False
+
+        # if the mono is saturated and there are non-saturated isotopes to use as a reference...
+        outcome = ''
+        if (isotopes_df.iloc[0].saturated == True):
+            outcome = 'monoisotopic_saturated_adjusted'
+            if (len(isotopes_df[isotopes_df.saturated == False]) > 0):
+                # find the first unsaturated isotope
+                unsaturated_idx = isotopes_df[(isotopes_df.saturated == False)].iloc[0].name
+
+                # using as a reference the most intense isotope that is not in saturation, derive the isotope intensities back to the monoisotopic
+                Hpn = isotopes_df.iloc[unsaturated_idx].intensity
+                for peak_number in reversed(range(1,unsaturated_idx+1)):
+                    # calculate the phr for the next-lower peak
+                    phr = isotope_model.peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
+                    if phr is not None:
+                        Hpn_minus_1 = Hpn / phr
+                        isotopes_df.at[peak_number-1, 'inferred_intensity'] = int(Hpn_minus_1)
+                        isotopes_df.at[peak_number-1, 'inferred'] = True
+                        Hpn = Hpn_minus_1
+                    else:
+                        outcome = 'could_not_calculate_phr'
+                        break
+            else:
+                outcome = 'no_nonsaturated_isotopes'
+        else:
+            outcome = 'monoisotopic_not_saturated'
+
+        # package the result
+        result_d = {}
+        result_d['scan_apex'] = scan_apex
+        result_d['scan_lower'] = scan_lower
+        result_d['scan_upper'] = scan_upper
+        result_d['rt_apex'] = rt_apex
+        result_d['rt_lower'] = rt_lower
+        result_d['rt_upper'] = rt_upper
+        result_d['intensity_without_saturation_correction'] = isotopes_df.iloc[:3].intensity.sum()  # only take the first three isotopes for intensity, as the number of isotopes varies
+        result_d['intensity_with_saturation_correction'] = isotopes_df.iloc[:3].inferred_intensity.sum()
+        result_d['mono_intensity_adjustment_outcome'] = outcome
+        result_d['isotopic_peaks'] = isotopes_df.to_json(orient='records')
+        result_d['coelution_coefficient'] = coelution_coefficient
+        result_d['mobility_coefficient'] = mobility_coefficient
+        result_d['scan_df'] = scan_df.to_json(orient='records')
+        result_d['rt_df'] = rt_df.to_json(orient='records')
+    else:
+        result_d = None
+    return result_d
+
+# a synthetic cuboid: one or two features with an isotopic series each, spread in frame and scan, with noise. The
+# points are ordered and typed as they are when they're read from the raw data, with float32 retention times.
+def synthetic_cuboid(rng, proton_mass, carbon_mass_difference, instrument_resolution):
+    charge = int(rng.integers(1, 4))
+    mono_mz = rng.uniform(400, 1200)
+    number_of_isotopes = int(rng.integers(2, 7))
+    frames_a = np.arange(1000, 1000 + int(rng.integers(3, 60))*2, 2)  # ms1 frames
+    first_scan = int(rng.integers(300, 400))
+    last_scan = int(rng.integers(420, 600))
+    points_l = []
+    for _ in range(int(rng.integers(1, 3))):
+        frame_centre = rng.uniform(frames_a[0], frames_a[-1])
+        scan_centre = rng.uniform(first_scan, last_scan)
+        frame_width = rng.uniform(2, 15)
+        scan_width = rng.uniform(3, 25)
+        amplitude = rng.uniform(200, 6000)
+        for isotope_idx,ratio in enumerate([1,0.9,0.5,0.25,0.1,0.05][:number_of_isotopes]):
+            if (isotope_idx > 1) and (rng.random() < 0.1):
+                break
+            number_of_points = int(rng.integers(50, 2000))
+            isotope_mz = mono_mz + (isotope_idx * carbon_mass_difference / charge)
+            points_l.append(pd.DataFrame({
+                'mz':rng.normal(isotope_mz, isotope_mz / instrument_resolution / 2.35482, number_of_points),
+                'scan':np.clip(np.rint(rng.normal(scan_centre, scan_width, number_of_points)), first_scan, last_scan).astype(int),
+                'frame_id':np.clip(np.rint(rng.normal(frame_centre, frame_width, number_of_points) / 2) * 2, frames_a[0], frames_a[-1]).astype(int),
+                'intensity':np.maximum(1, amplitude * ratio * rng.uniform(0.1, 1, number_of_points)).astype(int)}))
+    number_of_noise_points = int(rng.integers(100, 3000))
+    points_l.append(pd.DataFrame({
+        'mz':rng.uniform(mono_mz-1, mono_mz+number_of_isotopes, number_of_noise_points),
+        'scan':rng.integers(first_scan, last_scan+1, number_of_noise_points),
+        'frame_id':frames_a[rng.integers(0, len(frames_a), number_of_noise_points)],
+        'intensity':rng.integers(1, 300, number_of_noise_points)}))
+    cuboid_points_df = pd.concat(points_l, ignore_index=True).sort_values(by=['frame_id','scan','mz']).reset_index(drop=True)
+    cuboid_points_df['retention_time_secs'] = ((cuboid_points_df.frame_id * 0.1095) + 1650).astype(np.float32)
+    cuboid_points_df = cuboid_points_df[['mz','scan','frame_id','retention_time_secs','intensity']]
+    cuboid_points_df[['frame_id','scan','intensity']] = cuboid_points_df[['frame_id','scan','intensity']].apply(pd.to_numeric, downcast='unsigned')
+    envelope = [(mono_mz + (i * carbon_mass_difference / charge), 1000.0) for i in range(number_of_isotopes)]
+    monoisotopic_mass = (mono_mz - proton_mass) * charge
+    return cuboid_points_df, envelope, monoisotopic_mass
+
+# whether two values are the same, allowing for rounding in floats
+def same_value(a, b):
+    if isinstance(a, (float, np.floating)) and isinstance(b, (float, np.floating)):
+        if math.isnan(a) or math.isnan(b):
+            return math.isnan(a) and math.isnan(b)
+        return abs(a - b) <= RELATIVE_TOLERANCE * max(1, abs(a))
+    return a == b
+
+# the outputs of the two results that differ, as a list of names; the previous implementation's isotopes had its
+# join column in their profiles, which is ignored
+def differing_outputs(previous_d, current_d):
+    if (previous_d is None) or (current_d is None):
+        return [] if (previous_d is None) and (current_d is None) else ['result']
+    differing_l = []
+    for name in previous_d:
+        if name in JSON_OUTPUTS:
+            previous_records_l = json.loads(previous_d[name])
+            current_records_l = json.loads(current_d[name])
+            if len(previous_records_l) != len(current_records_l):
+                differing_l.append(name)
+                continue
+            for previous_record,current_record in zip(previous_records_l, current_records_l):
+                for column in previous_record:
+                    if column in JSON_RECORD_COLUMNS:
+                        same = [{k:v for k,v in r.items() if k != 'x_scaled'} for r in json.loads(previous_record[column])] == json.loads(current_record[column])
+                    else:
+                        same = same_value(previous_record[column], current_record.get(column))
+                    if not same:
+                        differing_l.append('{}.{}'.format(name, column))
+        elif not same_value(previous_d[name], current_d[name]):
+            differing_l.append(name)
+    return sorted(set(differing_l))
+
+# the absolute difference between two similarities, with the number of them only the current implementation measured
+# because the previous join found no frames in common; one only the previous implementation measured is an infinite
+# difference
+def similarity_difference(previous, current):
+    previous_missing = (previous is None) or math.isnan(previous)
+    current_missing = (current is None) or math.isnan(current)
+    if previous_missing and current_missing:
+        return 0.0, 0
+    if previous_missing:
+        return 0.0, 1
+    if current_missing:
+        return math.inf, 0
+    return abs(previous - current), 0
+
+# the largest absolute difference between the two results' isotope retention time similarities, the difference between
+# their coelution coefficients, and the number of similarities the previous join found no frames in common for
+def similarity_rt_differences(previous_d, current_d):
+    similarity_difference_l = [similarity_difference(p['similarity_rt'], c['similarity_rt']) for p,c in zip(json.loads(previous_d['isotopic_peaks']), json.loads(current_d['isotopic_peaks']))]
+    coelution_coefficient_difference,_ = similarity_difference(previous_d['coelution_coefficient'], current_d['coelution_coefficient'])
+    return max([d for d,_ in similarity_difference_l], default=0.0), coelution_coefficient_difference, sum(n for _,n in similarity_difference_l)
+
+parser = argparse.ArgumentParser(description='Check the mono characteristics of the features against the previous implementation on synthetic cuboids.')
+parser.add_argument('-n','--number_of_cuboids', type=int, default=300, help='Number of synthetic cuboids to check.', required=False)
+parser.add_argument('-s','--seed', type=int, default=0, help='Seed for the synthetic cuboids.', required=False)
+parser.add_argument('-ini','--ini_file', type=str, default=DEFAULT_INI_FILE, help='Path to the config file.', required=False)
+args = parser.parse_args()
+
+cfg = configparser.ConfigParser(interpolation=ExtendedInterpolation())
+cfg.read(args.ini_file)
+PROTON_MASS = cfg.getfloat('common', 'PROTON_MASS')
+INSTRUMENT_RESOLUTION = cfg.getfloat('common', 'INSTRUMENT_RESOLUTION')
+SATURATION_INTENSITY = cfg.getint('common', 'SATURATION_INTENSITY')
+CARBON_MASS_DIFFERENCE = cfg.getfloat('common', 'CARBON_MASS_DIFFERENCE')
+
+rng = np.random.default_rng(args.seed)
+
+previous_secs = 0.0
+current_secs = 0.0
+outcomes_d = {}
+float32_join_differs_d = {}
+float32_join_maximum_similarity_difference = 0.0
+float32_join_maximum_coelution_difference = 0.0
+float32_join_unjoined = 0
+for cuboid_idx in range(args.number_of_cuboids):
+    cuboid_points_df, envelope, monoisotopic_mass = synthetic_cuboid(rng, PROTON_MASS, CARBON_MASS_DIFFERENCE, INSTRUMENT_RESOLUTION)
+    mono_mz_delta = peaks.calculate_peak_delta(envelope[0][0], instrument_resolution=INSTRUMENT_RESOLUTION)
+    mono_mz_lower = envelope[0][0] - mono_mz_delta
+    mono_mz_upper = envelope[0][0] + mono_mz_delta
+
+    start_time = time.perf_counter()
+    previous_result_d = determine_mono_characteristics_with_dataframes(envelope, mono_mz_lower, mono_mz_upper, monoisotopic_mass, cuboid_points_df, measure_peak_similarity_exact_join, INSTRUMENT_RESOLUTION, SATURATION_INTENSITY)
+    previous_secs += time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    current_result_d = mono_characteristics.determine_mono_characteristics(envelope, mono_mz_lower, mono_mz_upper, monoisotopic_mass, mono_characteristics.cuboid_point_arrays(cuboid_points_df), INSTRUMENT_RESOLUTION, SATURATION_INTENSITY)
+    current_secs += time.perf_counter() - start_time
+
+    # with the exact join, the outputs must be the same
+    differing_l = differing_outputs(previous_result_d, current_result_d)
+    assert len(differing_l) == 0, 'cuboid {} differs from the previous implementation: {}'.format(cuboid_idx, differing_l)
+    if previous_result_d is not None:
+        outcome = previous_result_d['mono_intensity_adjustment_outcome']
+        outcomes_d[outcome] = outcomes_d.get(outcome, 0) + 1
+
+    # with the original join, the differences are those the retention time alignment fixed, so they must be in the
+    # retention time similarities and within the tolerance
+    original_result_d = determine_mono_characteristics_with_dataframes(envelope, mono_mz_lower, mono_mz_upper, monoisotopic_mass, cuboid_points_df, measure_peak_similarity_float32_join, INSTRUMENT_RESOLUTION, SATURATION_INTENSITY)
+    differing_l = differing_outputs(original_result_d, current_result_d)
+    assert set(differing_l) <= set(FLOAT32_JOIN_OUTPUTS), 'cuboid {} differs from the previous implementation with the float32 join in more than the retention time similarities: {}'.format(cuboid_idx, differing_l)
+    if len(differing_l) > 0:
+        similarity_rt_difference, coelution_difference, number_unjoined = similarity_rt_differences(original_result_d, current_result_d)
+        assert similarity_rt_difference <= FLOAT32_JOIN_SIMILARITY_RT_TOLERANCE, 'cuboid {} retention time similarity differs from the previous implementation with the float32 join by {}, more than the tolerance of {}'.format(cuboid_idx, similarity_rt_difference, FLOAT32_JOIN_SIMILARITY_RT_TOLERANCE)
+        assert coelution_difference <= FLOAT32_JOIN_COELUTION_COEFFICIENT_TOLERANCE, 'cuboid {} coelution coefficient differs from the previous implementation with the float32 join by {}, more than the tolerance of {}'.format(cuboid_idx, coelution_difference, FLOAT32_JOIN_COELUTION_COEFFICIENT_TOLERANCE)
+        float32_join_maximum_similarity_difference = max(float32_join_maximum_similarity_difference, similarity_rt_difference)
+        float32_join_maximum_coelution_difference = max(float32_join_maximum_coelution_difference, coelution_difference)
+        float32_join_unjoined += number_unjoined
+    for name in differing_l:
+        float32_join_differs_d.setdefault(name, []).append(cuboid_idx)
+
+print('matches the previous implementation with an exact retention time join for {} cuboids {}'.format(args.number_of_cuboids, outcomes_d))
+if len(float32_join_differs_d) > 0:
+    number_of_cuboids_differing = len(set(idx for idxs_l in float32_join_differs_d.values() for idx in idxs_l))
+    print('with the original float32 retention time join, {} cuboids differ within the tolerances:'.format(number_of_cuboids_differing))
+    print('  largest isotope retention time similarity difference {} (tolerance {}), {} similarities where it joined no frames'.format(round(float32_join_maximum_similarity_difference, 6), FLOAT32_JOIN_SIMILARITY_RT_TOLERANCE, float32_join_unjoined))
+    print('  largest coelution coefficient difference {} (tolerance {})'.format(round(float32_join_maximum_coelution_difference, 6), FLOAT32_JOIN_COELUTION_COEFFICIENT_TOLERANCE))
+    for name in sorted(float32_join_differs_d):
+        print('  {}: {} cuboids'.format(name, len(float32_join_differs_d[name])))
+else:
+    print('with the original float32 retention time join, no cuboids differ')
+print('previous implementation: {} ms per cuboid'.format(round(previous_secs / args.number_of_cuboids * 1000, 2)))
+print('arrays: {} ms per cuboid'.format(round(current_secs / args.number_of_cuboids * 1000, 2)))
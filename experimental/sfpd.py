@@ -8,6 +8,10 @@ import os.path
 from pyteomics import mgf
 import time
 
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import mass_defect
+
 # for reading the de-dup pickle
 from ms_deisotope import deconvolute_peaks, averagine, scoring
 from ms_deisotope.deconvolution import peak_retention_strategy
@@ -78,16 +82,7 @@ def collate_spectra_for_feature(feature_df, ms2_deconvoluted_df):
     return spectrum
 
 def generate_mass_defect_windows():
-    bin_edges_l = []
-    for nominal_mass in range(DA_MIN, DA_MAX):
-        mass_centre = nominal_mass * 1.00048  # from https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3184890/
-        width = 0.19 + (0.0001 * nominal_mass)
-        lower_mass = mass_centre - (width / 2)
-        upper_mass = mass_centre + (width / 2)
-        bin_edges_l.append(lower_mass)
-        bin_edges_l.append(upper_mass)
-    bins = np.asarray(bin_edges_l)
-    return bins
+    return mass_defect.generate_mass_defect_windows(DA_MIN, DA_MAX)
 
 def deconvolute_ms2(mass_defect_window_bins, feature_raw_ms2_df):
     mz_a = feature_raw_ms2_df.mz.to_numpy()
@@ -99,7 +94,7 @@ def deconvolute_ms2(mass_defect_window_bins, feature_raw_ms2_df):
     for charge in charge_states_to_consider[::-1]:
         decharged_mass_a = ((feature_raw_ms2_df.mz * charge) - (PROTON_MASS * charge)).to_numpy()
 
-        digitised_mass = np.digitize(decharged_mass_a[available_a == True], mass_defect_window_bins)  # an odd index means the point is inside a mass defect window
+        digitised_mass = mass_defect.window_edge_index(decharged_mass_a[available_a == True], mass_defect_window_bins, closed_right=False)  # an odd index means the point is inside a mass defect window
 
         # remove all the even indexes - the odd indexes are the mass defect windows
         mass_defect_window_indexes = digitised_mass[(digitised_mass % 2) == 1]
@@ -8,11 +8,10 @@ import pandas as pd
 import numpy as np
 import sqlite3
 import json
-from multiprocessing import Pool
 
-def run_process(process):
-    print("Executing: {}".format(process))
-    os.system(process)
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import processes
 
 class NpEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -36,6 +35,7 @@ parser.add_argument('-ssms','--small_set_mode_size', type=int, default='100', he
 parser.add_argument('-mpwrt','--max_peak_width_rt', type=int, default=10, help='Maximum peak width tolerance for the extraction from the estimated coordinate in RT.', required=False)
 parser.add_argument('-mpwccs','--max_peak_width_ccs', type=int, default=20, help='Maximum peak width tolerance for the extraction from the estimated coordinate in CCS.', required=False)
 parser.add_argument('-ini','--ini_file', type=str, default='./tfde/pipeline/pasef-process-short-gradient.ini', help='Path to the config file.', required=False)
+parser.add_argument('-pto','--process_timeout', type=int, help='Number of seconds after which a run\'s extraction is killed.', required=False)
 args = parser.parse_args()
 
 # print the arguments for the log
@@ -70,12 +70,12 @@ if os.path.isfile(METRICS_DB_NAME):
     os.remove(METRICS_DB_NAME)
 
 if args.small_set_mode:
-    small_set_flags = "-ssm -ssms {}".format(args.small_set_mode_size)
+    small_set_flags_l = ['-ssm', '-ssms', args.small_set_mode_size]
 else:
-    small_set_flags = ""
+    small_set_flags_l = []
 
-# set up the processing pool
-pool = Pool(processes=4)
+# the number of runs to extract at a time
+NUMBER_OF_CONCURRENT_EXTRACTIONS = 4
 
 run_names_l = args.run_names.split(',')
 print("{} runs to process: {}".format(len(run_names_l), run_names_l))
@@ -84,9 +84,12 @@ for run_name in run_names_l:
     print("processing {}".format(run_name))
     LOG_FILE_NAME = "{}/extract-library-sequence-features-for-run-{}.log".format(LOG_DIR, run_name)
     current_directory = os.path.abspath(os.path.dirname(__file__))
-    cmd = "python -u {}/extract-library-sequence-features-for-run.py -eb {} -en {} -rn {} -ini {} -mpwrt {} -mpwccs {} {} > {} 2>&1".format(current_directory, args.experiment_base_dir, args.experiment_name, run_name, args.ini_file, args.max_peak_width_rt, args.max_peak_width_ccs, small_set_flags, LOG_FILE_NAME)
-    extract_cmd_l.append(cmd)
-pool.map(run_process, extract_cmd_l)
+    args_l = [sys.executable, '-u', '{}/extract-library-sequence-features-for-run.py'.format(current_directory), '-eb', args.experiment_base_dir, '-en', args.experiment_name, '-rn', run_name, '-ini', args.ini_file, '-mpwrt', args.max_peak_width_rt, '-mpwccs', args.max_peak_width_ccs] + small_set_flags_l
+    extract_cmd_l.append(processes.command(args_l, LOG_FILE_NAME, timeout=args.process_timeout))
+results_l = processes.run_commands(extract_cmd_l, maximum_concurrent=NUMBER_OF_CONCURRENT_EXTRACTIONS, resources_file='{}/processes.jsonl'.format(LOG_DIR))
+failed_l = [result for result in results_l if result['exit_status'] != 0]
+if len(failed_l) > 0:
+    print('the extraction failed for {} runs; see their logs: {}'.format(len(failed_l), [result['stdout_file'] for result in failed_l]))
 
 # load the run-based metrics into a single experiment-based dataframe
 run_sequence_files = glob.glob('{}/library-sequences-in-run-*.pkl'.format(TARGET_DECOY_MODEL_DIR))
@@ -0,0 +1,57 @@
+import os
+import time
+import argparse
+import sys
+from multiprocessing import Pool
+
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import raw_cache
+
+
+# convert a run's raw database to the HDF and raw data cache used by the downstream steps
+def convert_run(run_name):
+    start_time = time.time()
+    cache_dir = raw_cache.convert_raw(RAW_DATABASE_BASE_DIR, run_name)
+    print("converted {} to {} in {} seconds".format(run_name, cache_dir, round(time.time()-start_time,1)))
+    return cache_dir
+
+
+parser = argparse.ArgumentParser(description='Convert the runs\' raw databases up front, so the downstream steps never need to.')
+parser.add_argument('-eb','--experiment_base_dir', type=str, default='./experiments', help='Path to the experiments directory.', required=False)
+parser.add_argument('-en','--experiment_name', type=str, help='Name of the experiment.', required=True)
+parser.add_argument('-rn','--run_names', type=str, help='Comma-separated names of runs to process.', required=True)
+parser.add_argument('-np','--number_of_processes', type=int, default=4, help='Number of runs to convert at a time.', required=False)
+args = parser.parse_args()
+
+# print the arguments for the log
+info = []
+for arg in vars(args):
+    info.append((arg, getattr(args, arg)))
+print(info)
+
+start_run = time.time()
+
+# check the experiment directory exists
+EXPERIMENT_DIR = "{}/{}".format(args.experiment_base_dir, args.experiment_name)
+if not os.path.exists(EXPERIMENT_DIR):
+    print("The experiment directory is required but doesn't exist: {}".format(EXPERIMENT_DIR))
+    sys.exit(1)
+
+# check the raw databases exist
+RAW_DATABASE_BASE_DIR = "{}/raw-databases".format(EXPERIMENT_DIR)
+run_names_l = args.run_names.split(',')
+for run_name in run_names_l:
+    RAW_DATABASE_NAME = "{}/{}.d".format(RAW_DATABASE_BASE_DIR, run_name)
+    if not os.path.exists(RAW_DATABASE_NAME):
+        print("The raw database is required but doesn't exist: {}".format(RAW_DATABASE_NAME))
+        sys.exit(1)
+
+# convert the runs in parallel
+print("{} runs to convert: {}".format(len(run_names_l), run_names_l))
+pool = Pool(processes=min(args.number_of_processes, len(run_names_l)))
+pool.map(convert_run, run_names_l)
+pool.close()
+
+stop_run = time.time()
+print("total running time ({}): {} seconds".format(parser.prog, round(stop_run-start_run,1)))
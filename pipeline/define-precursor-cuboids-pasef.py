@@ -1,21 +1,14 @@
 import os
 import pandas as pd
+import numpy as np
 import sqlite3
 import argparse
 import time
 import json
 import configparser
 from configparser import ExtendedInterpolation
-import multiprocessing as mp
-import ray
 import sys
 
-# determine the number of workers based on the number of available cores and the proportion of the machine to be used
-def number_of_workers():
-    number_of_cores = mp.cpu_count()
-    number_of_workers = int(args.proportion_of_cores_to_use * number_of_cores)
-    return number_of_workers
-
 # returns a dataframe with the prepared isolation windows
 def load_isolation_windows():
     # get all the isolation windows
@@ -45,85 +38,111 @@ def load_frame_properties():
     print("loaded {} frame_properties from {}".format(len(frames_properties_df), RAW_DATABASE_NAME))
     return frames_properties_df
 
-def metadata_for_frame(frame_properties_df, frame_id):
-    r = frame_properties_df[(frame_properties_df.Id == frame_id)].iloc[0]
-    result = {}
-    result['retention_time_secs'] = r.Time
-    result['frame_type'] = r.MsMsType
-    return result
-
-# find the closest lower ms1 frame_id, and the closest upper ms1 frame_id
+# find the closest ms1 frame_id below, and the closest ms1 frame_id above, each of the retention times
 # number_of_ms1_frames_padding is the number of ms1 frames to extend
-def find_closest_ms1_frame_to_rt(frames_properties_df, retention_time_secs, number_of_ms1_frames_padding=0):
-    ms1_frame_props_df = frames_properties_df[(frames_properties_df.MsMsType == FRAME_TYPE_MS1)]
-    # find the closest ms1 frame above
-    df = ms1_frame_props_df[(ms1_frame_props_df.Time > retention_time_secs)]
-    if len(df) > (number_of_ms1_frames_padding+1):
-        closest_ms1_frame_above_rt = df.iloc[number_of_ms1_frames_padding].Id
-    else:
-        # couldn't find an ms1 frame above this RT, so just use the last one
-        closest_ms1_frame_above_rt = ms1_frame_props_df.Id.max()
-    # find the closest ms1 frame below
-    df = ms1_frame_props_df[(ms1_frame_props_df.Time < retention_time_secs)]
-    if len(df) > (number_of_ms1_frames_padding+1):
-        closest_ms1_frame_below_rt = df.iloc[-(number_of_ms1_frames_padding+1)].Id
-    else:
-        # couldn't find an ms1 frame below this RT, so just use the first one
-        closest_ms1_frame_below_rt = ms1_frame_props_df.Id.min()
+# ms1_frame_props_df must be sorted by time; returns a tuple of numpy arrays
+def find_closest_ms1_frames_to_rts(ms1_frame_props_df, retention_times_secs, number_of_ms1_frames_padding=0):
+    ms1_times_a = ms1_frame_props_df.Time.to_numpy()
+    ms1_ids_a = ms1_frame_props_df.Id.to_numpy()
+    # the number of ms1 frames strictly below each RT, and the index of the first ms1 frame strictly above it
+    number_below_a = np.searchsorted(ms1_times_a, retention_times_secs, side='left')
+    first_above_idx_a = np.searchsorted(ms1_times_a, retention_times_secs, side='right')
+    number_above_a = len(ms1_times_a) - first_above_idx_a
+    # if there are not enough ms1 frames above this RT, just use the last one
+    closest_ms1_frame_above_rt = np.where(number_above_a > (number_of_ms1_frames_padding+1), ms1_ids_a[np.minimum(first_above_idx_a + number_of_ms1_frames_padding, len(ms1_ids_a)-1)], ms1_ids_a.max())
+    # if there are not enough ms1 frames below this RT, just use the first one
+    closest_ms1_frame_below_rt = np.where(number_below_a > (number_of_ms1_frames_padding+1), ms1_ids_a[np.maximum(number_below_a - (number_of_ms1_frames_padding+1), 0)], ms1_ids_a.min())
     return (closest_ms1_frame_below_rt, closest_ms1_frame_above_rt)
 
-# find the closest lower ms1 frame_id, and the closest upper ms1 frame_id
-def find_closest_ms1_frame_to_ms2_frame(frames_properties_df, ms2_frame_id):
-    # get the ms2 frame's RT
-    ms2_frame_rt = frames_properties_df[frames_properties_df.Id == ms2_frame_id].iloc[0].Time
-    # get the closest ms1 frames
-    return find_closest_ms1_frame_to_rt(frames_properties_df, ms2_frame_rt, RT_FRAGMENT_EVENT_DELTA_FRAMES)
-
-@ray.remote
-def process_precursor(frame_properties_df, precursor_id, precursor_group_df):
-    # calculate the coordinates
-    window = precursor_group_df.iloc[0]
-    window_mz_lower = window.mz_lower                                             # the isolation window's m/z range
-    window_mz_upper = window.mz_upper
+# determine the cuboid coordinates for all the precursors at once
+def define_precursor_cuboids(frame_properties_df, isolation_window_df):
+    frame_times_s = frame_properties_df.set_index('Id').Time
+    ms1_frame_props_df = frame_properties_df[(frame_properties_df.MsMsType == FRAME_TYPE_MS1)].sort_values(by=['Time'], kind='stable')
+
+    # the first isolation window describes the precursor's m/z and scan range, and all its windows give the ms2 frames
+    window_df = isolation_window_df.drop_duplicates(subset=['Precursor'], keep='first').set_index('Precursor').sort_index()
+    frames_df = isolation_window_df.groupby('Precursor').Frame.agg(['min','max','count'])
+
+    window_mz_lower = window_df.mz_lower.to_numpy()                               # the isolation window's m/z range
+    window_mz_upper = window_df.mz_upper.to_numpy()
     wide_mz_lower = window_mz_lower - (CARBON_MASS_DIFFERENCE / 1)                # get more points in case we need to look for a missed monoisotopic peak - assume charge 1+ to allow for maximum distance to the left
     wide_mz_upper = window_mz_upper
-    scan_width = int(window.ScanNumEnd - window.ScanNumBegin)                     # the isolation window's scan range
-    fe_scan_lower = int(window.ScanNumBegin)                                      # fragmentation event scan range
-    fe_scan_upper = int(window.ScanNumEnd)
-    wide_scan_lower = int(window.ScanNumBegin - scan_width)                       # get more points to make sure we get the apex of the peak in drift
-    wide_scan_upper = int(window.ScanNumEnd + scan_width)
+    scan_width = (window_df.ScanNumEnd - window_df.ScanNumBegin).astype(int).to_numpy()  # the isolation window's scan range
+    fe_scan_lower = window_df.ScanNumBegin.astype(int).to_numpy()                 # fragmentation event scan range
+    fe_scan_upper = window_df.ScanNumEnd.astype(int).to_numpy()
+    wide_scan_lower = (window_df.ScanNumBegin - scan_width).astype(int).to_numpy() # get more points to make sure we get the apex of the peak in drift
+    wide_scan_upper = (window_df.ScanNumEnd + scan_width).astype(int).to_numpy()
 
-    fe_ms2_frame_lower = precursor_group_df.Frame.astype(int).min()               # only the ms2 frames associated with the precursor
-    fe_ms2_frame_upper = precursor_group_df.Frame.astype(int).max()
+    fe_ms2_frame_lower = frames_df['min'].astype(int).to_numpy()                  # only the ms2 frames associated with the precursor
+    fe_ms2_frame_upper = frames_df['max'].astype(int).to_numpy()
 
-    fe_ms1_frame_lower,_ = find_closest_ms1_frame_to_ms2_frame(frame_properties_df,fe_ms2_frame_lower)
-    _,fe_ms1_frame_upper = find_closest_ms1_frame_to_ms2_frame(frame_properties_df,fe_ms2_frame_upper)
-    fe_ms1_rt_lower = metadata_for_frame(frame_properties_df, fe_ms1_frame_lower)['retention_time_secs']
-    fe_ms1_rt_upper = metadata_for_frame(frame_properties_df, fe_ms1_frame_upper)['retention_time_secs']
+    fe_ms1_frame_lower,_ = find_closest_ms1_frames_to_rts(ms1_frame_props_df, frame_times_s.loc[fe_ms2_frame_lower].to_numpy(), RT_FRAGMENT_EVENT_DELTA_FRAMES)
+    _,fe_ms1_frame_upper = find_closest_ms1_frames_to_rts(ms1_frame_props_df, frame_times_s.loc[fe_ms2_frame_upper].to_numpy(), RT_FRAGMENT_EVENT_DELTA_FRAMES)
+    fe_ms1_rt_lower = frame_times_s.loc[fe_ms1_frame_lower].to_numpy()
+    fe_ms1_rt_upper = frame_times_s.loc[fe_ms1_frame_upper].to_numpy()
 
     wide_ms1_rt_lower = fe_ms1_rt_lower - RT_BASE_PEAK_WIDTH_SECS  # get more points to make sure we get the apex of the peak in retention time
     wide_ms1_rt_upper = fe_ms1_rt_upper + RT_BASE_PEAK_WIDTH_SECS
 
-    # collect the coordinates for the precursor cuboid
-    precursor_coordinates_d = {
-        'precursor_cuboid_id': int(precursor_id),
+    # collect the coordinates for the precursor cuboids
+    coords_df = pd.DataFrame({
+        'precursor_cuboid_id': window_df.index.astype(int),
         'window_mz_lower': window_mz_lower,
         'window_mz_upper': window_mz_upper,
         'wide_mz_lower': wide_mz_lower,
         'wide_mz_upper': wide_mz_upper,
-        'fe_scan_lower': int(fe_scan_lower),
-        'fe_scan_upper': int(fe_scan_upper),
-        'wide_scan_lower': int(wide_scan_lower),
-        'wide_scan_upper': int(wide_scan_upper),
+        'fe_scan_lower': fe_scan_lower,
+        'fe_scan_upper': fe_scan_upper,
+        'wide_scan_lower': wide_scan_lower,
+        'wide_scan_upper': wide_scan_upper,
         'fe_ms1_rt_lower': fe_ms1_rt_lower,
         'fe_ms1_rt_upper': fe_ms1_rt_upper,
         'fe_ms2_frame_lower': fe_ms2_frame_lower,
         'fe_ms2_frame_upper': fe_ms2_frame_upper,
         'wide_ms1_rt_lower': wide_ms1_rt_lower,
         'wide_ms1_rt_upper': wide_ms1_rt_upper,
-        'number_of_windows': len(precursor_group_df)
-    }
-    return precursor_coordinates_d
+        'number_of_windows': frames_df['count'].to_numpy()
+    })
+    return coords_df
+
+# group the cuboids that overlap in m/z, scan, and RT into ms1 work units, so the ms1 region they share is only
+# deconvolved once. The cuboids are taken in RT order, and each joins the first open unit whose extent it overlaps in
+# all three dimensions, extending the unit's extent. A unit is closed when the cuboids have moved past it in RT, or
+# when it has maximum_cuboids_per_unit cuboids. Returns the unit ID of each cuboid, which is the lowest precursor
+# cuboid ID in the unit.
+def merge_overlapping_cuboids(coords_df, maximum_cuboids_per_unit):
+    mz_lower_a = coords_df.window_mz_lower.to_numpy()
+    mz_upper_a = coords_df.window_mz_upper.to_numpy()
+    scan_lower_a = coords_df.fe_scan_lower.to_numpy()
+    scan_upper_a = coords_df.fe_scan_upper.to_numpy()
+    rt_lower_a = coords_df.fe_ms1_rt_lower.to_numpy()
+    rt_upper_a = coords_df.fe_ms1_rt_upper.to_numpy()
+
+    unit_idx_a = np.empty(len(coords_df), dtype=np.int64)
+    # the extent and size of each unit; the open units are those still in reach of the cuboids to come
+    unit_extents_l = []
+    unit_sizes_l = []
+    open_units_l = []
+    for idx in np.argsort(rt_lower_a, kind='stable'):
+        # the cuboids are in RT order, so a cuboid overlaps a unit in RT if it starts before the unit ends
+        open_units_l = [u for u in open_units_l if (unit_extents_l[u][5] >= rt_lower_a[idx]) and (unit_sizes_l[u] < maximum_cuboids_per_unit)]
+        unit = next((u for u in open_units_l if (mz_lower_a[idx] <= unit_extents_l[u][1]) and (mz_upper_a[idx] >= unit_extents_l[u][0]) and (scan_lower_a[idx] <= unit_extents_l[u][3]) and (scan_upper_a[idx] >= unit_extents_l[u][2])), None)
+        if unit is None:
+            # start a new unit
+            unit = len(unit_extents_l)
+            unit_extents_l.append([mz_lower_a[idx], mz_upper_a[idx], scan_lower_a[idx], scan_upper_a[idx], rt_lower_a[idx], rt_upper_a[idx]])
+            unit_sizes_l.append(1)
+            open_units_l.append(unit)
+        else:
+            # extend the unit's extent to take in the cuboid
+            e = unit_extents_l[unit]
+            unit_extents_l[unit] = [min(e[0], mz_lower_a[idx]), max(e[1], mz_upper_a[idx]), min(e[2], scan_lower_a[idx]), max(e[3], scan_upper_a[idx]), min(e[4], rt_lower_a[idx]), max(e[5], rt_upper_a[idx])]
+            unit_sizes_l[unit] += 1
+        unit_idx_a[idx] = unit
+
+    # identify each unit by its lowest precursor cuboid ID
+    unit_ids_a = pd.Series(coords_df.precursor_cuboid_id.to_numpy()).groupby(unit_idx_a).transform('min').to_numpy()
+    return unit_ids_a
 
 ##############################################
 parser = argparse.ArgumentParser(description='Extract the precursor cuboids from the Bruker instrument database to work units based on the precursors.')
@@ -136,9 +155,8 @@ parser.add_argument('-rl','--rt_lower', type=int, default='1650', help='Lower li
 parser.add_argument('-ru','--rt_upper', type=int, default='2200', help='Upper limit for retention time.', required=False)
 parser.add_argument('-ini','--ini_file', type=str, default='./tfde/pipeline/pasef-process-short-gradient.ini', help='Path to the config file.', required=False)
 parser.add_argument('-ssm','--small_set_mode', action='store_true', help='A small subset of the data for testing purposes.')
-parser.add_argument('-rm','--ray_mode', type=str, choices=['cluster','join','local'], help='The Ray mode to use.', required=True)
-parser.add_argument('-ra','--redis_address', type=str, help='Address of the cluster to join.', required=False)
-parser.add_argument('-pc','--proportion_of_cores_to_use', type=float, default=0.9, help='Proportion of the machine\'s cores to use for this program.', required=False)
+parser.add_argument('-mc','--merge_cuboids', action='store_true', help='Group the cuboids that overlap in m/z, scan, and RT into ms1 work units, so their ms1 region is only deconvolved once.')
+parser.add_argument('-mcu','--maximum_cuboids_per_unit', type=int, default=20, help='Maximum number of cuboids in an ms1 work unit when merging them.', required=False)
 args = parser.parse_args()
 
 # Print the arguments for the log
@@ -179,8 +197,7 @@ RT_BASE_PEAK_WIDTH_SECS = cfg.getfloat('common','RT_BASE_PEAK_WIDTH_SECS')
 
 # set up the precursor cuboids
 CUBOIDS_DIR = '{}/precursor-cuboids-pasef'.format(EXPERIMENT_DIR)
-if not os.path.exists(CUBOIDS_DIR):
-    os.makedirs(CUBOIDS_DIR)
+os.makedirs(CUBOIDS_DIR, exist_ok=True)
 
 CUBOIDS_FILE = '{}/exp-{}-run-{}-precursor-cuboids-pasef.feather'.format(CUBOIDS_DIR, args.experiment_name, args.run_name)
 
@@ -192,21 +209,20 @@ frame_properties_df = load_frame_properties()
 print("loading the isolation windows")
 isolation_window_df = load_isolation_windows()
 
-print("Setting up Ray")
-if not ray.is_initialized():
-    if args.ray_mode == "cluster":
-        ray.init(num_cpus=number_of_workers())
-    else:
-        ray.init(local_mode=True)
-
 # determine the coordinates of each precursor's cuboid
 print("defining the cuboids for {} precursors".format(len(isolation_window_df.Precursor.unique())))
-coords_l = ray.get([process_precursor.remote(frame_properties_df=frame_properties_df, precursor_id=group_name, precursor_group_df=group_df) for group_name,group_df in isolation_window_df.groupby('Precursor')])
-coords_df = pd.DataFrame(coords_l)
+coords_df = define_precursor_cuboids(frame_properties_df, isolation_window_df)
 
 # trim those we don't want
 coords_df = coords_df[(coords_df['fe_ms1_rt_lower'] >= args.rt_lower) & (coords_df['fe_ms1_rt_upper'] <= args.rt_upper)]
 
+# group the overlapping cuboids into ms1 work units; the detection processes each unit's cuboids together
+if args.merge_cuboids:
+    coords_df = coords_df.assign(ms1_unit_id=merge_overlapping_cuboids(coords_df, args.maximum_cuboids_per_unit))
+    number_of_units = coords_df.ms1_unit_id.nunique()
+    print('merged {} cuboids into {} ms1 work units'.format(len(coords_df), number_of_units))
+    info.append(('number_of_ms1_units', number_of_units))
+
 # write them out
 print('writing {} cuboid definitions to {}'.format(len(coords_df), CUBOIDS_FILE))
 coords_df.reset_index(drop=True, inplace=True)
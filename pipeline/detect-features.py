@@ -5,6 +5,7 @@ import os.path
 import argparse
 import time
 import json
+import hashlib
 import multiprocessing as mp
 import ray
 from ms_deisotope import deconvolute_peaks, averagine, scoring
@@ -13,363 +14,46 @@ import pickle
 import configparser
 from configparser import ExtendedInterpolation
 from os.path import expanduser
-import peakutils
-from scipy import signal
 import math
-from sklearn.metrics.pairwise import cosine_similarity
-import alphatims.bruker
-import glob
-
-
-# peak and valley detection parameters
-PEAKS_THRESHOLD_RT = 0.5    # only consider peaks that are higher than this proportion of the normalised maximum
-PEAKS_THRESHOLD_SCAN = 0.5
-PEAKS_MIN_DIST_RT = 2.0     # seconds
-PEAKS_MIN_DIST_SCAN = 10.0  # scans
-
-VALLEYS_THRESHOLD_RT = 0.5    # only consider valleys that drop more than this proportion of the normalised maximum
-VALLEYS_THRESHOLD_SCAN = 0.5
-VALLEYS_MIN_DIST_RT = 2.0     # seconds
-VALLEYS_MIN_DIST_SCAN = 10.0  # scans
-
-# filter parameters
-SCAN_FILTER_POLY_ORDER = 5
-RT_FILTER_POLY_ORDER = 3
-
-# determine the maximum filter length for the number of points
-def find_filter_length(number_of_points):
-    filter_lengths = [51,11,5]  # must be a positive odd number, greater than the polynomial order, and less than the number of points to be filtered
-    return filter_lengths[next(x[0] for x in enumerate(filter_lengths) if x[1] < number_of_points)]
-
-# calculate the intensity-weighted centroid
-# takes a numpy array of intensity, and another of mz
-def intensity_weighted_centroid(_int_f, _x_f):
-    return ((_int_f/_int_f.sum()) * _x_f).sum()
-
-# peaks_a is a numpy array of [mz,intensity]
-# returns a numpy array of [intensity_weighted_centroid,summed_intensity]
-def intensity_descent(peaks_a, peak_delta=None):
-    # intensity descent
-    peaks_l = []
-    while len(peaks_a) > 0:
-        # find the most intense point
-        max_intensity_index = np.argmax(peaks_a[:,1])
-        peak_mz = peaks_a[max_intensity_index,0]
-        if peak_delta == None:
-            peak_delta = calculate_peak_delta(mz=peak_mz)
-        peak_mz_lower = peak_mz - peak_delta
-        peak_mz_upper = peak_mz + peak_delta
-
-        # get all the raw points within this m/z region
-        peak_indexes = np.where((peaks_a[:,0] >= peak_mz_lower) & (peaks_a[:,0] <= peak_mz_upper))[0]
-        if len(peak_indexes) > 0:
-            mz_cent = intensity_weighted_centroid(peaks_a[peak_indexes,1], peaks_a[peak_indexes,0])
-            summed_intensity = peaks_a[peak_indexes,1].sum()
-            peaks_l.append((mz_cent, summed_intensity))
-            # remove the raw points assigned to this peak
-            peaks_a = np.delete(peaks_a, peak_indexes, axis=0)
-    return np.array(peaks_l)
-
-# find 3sigma for a specified m/z
-def calculate_peak_delta(mz):
-    delta_m = mz / INSTRUMENT_RESOLUTION  # FWHM of the peak
-    sigma = delta_m / 2.35482  # std dev is FWHM / 2.35482. See https://mathworld.wolfram.com/GaussianFunction.html
-    peak_delta = 3 * sigma  # 99.7% of values fall within +/- 3 sigma
-    return peak_delta
-
-# calculate the monoisotopic mass    
-def calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge):
-    monoisotopic_mass = (monoisotopic_mz * charge) - (PROTON_MASS * charge)
-    return monoisotopic_mass
-
-# Find the ratio of H(peak_number)/H(peak_number-1) for peak_number=1..6
-# peak_number = 0 refers to the monoisotopic peak
-# number_of_sulphur = number of sulphur atoms in the molecule
-#
-# source: Valkenborg et al, "A Model-Based Method for the Prediction of the Isotopic Distribution of Peptides", https://core.ac.uk/download/pdf/82021511.pdf
-def peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur):
-    MAX_NUMBER_OF_SULPHUR_ATOMS = 3
-    MAX_NUMBER_OF_PREDICTED_RATIOS = 6
-
-    S0_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S0_r[1] = np.array([-0.00142320578040, 0.53158267080224, 0.00572776591574, -0.00040226083326, -0.00007968737684])
-    S0_r[2] = np.array([0.06258138406507, 0.24252967352808, 0.01729736525102, -0.00427641490976, 0.00038011211412])
-    S0_r[3] = np.array([0.03092092306220, 0.22353930450345, -0.02630395501009, 0.00728183023772, -0.00073155573939])
-    S0_r[4] = np.array([-0.02490747037406, 0.26363266501679, -0.07330346656184, 0.01876886839392, -0.00176688757979])
-    S0_r[5] = np.array([-0.19423148776489, 0.45952477474223, -0.18163820209523, 0.04173579115885, -0.00355426505742])
-    S0_r[6] = np.array([0.04574408690798, -0.05092121193598, 0.13874539944789, -0.04344815868749, 0.00449747222180])
-
-    S1_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S1_r[1] = np.array([-0.01040584267474, 0.53121149663696, 0.00576913817747, -0.00039325152252, -0.00007954180489])
-    S1_r[2] = np.array([0.37339166598255, -0.15814640001919, 0.24085046064819, -0.06068695741919, 0.00563606634601])
-    S1_r[3] = np.array([0.06969331604484, 0.28154425636993, -0.08121643989151, 0.02372741957255, -0.00238998426027])
-    S1_r[4] = np.array([0.04462649178239, 0.23204790123388, -0.06083969521863, 0.01564282892512, -0.00145145206815])
-    S1_r[5] = np.array([-0.20727547407753, 0.53536509500863, -0.22521649838170, 0.05180965157326, -0.00439750995163])
-    S1_r[6] = np.array([0.27169670700251, -0.37192045082925, 0.31939855191976, -0.08668833166842, 0.00822975581940])
-
-    S2_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S2_r[1] = np.array([-0.01937823810470, 0.53084210514216, 0.00580573751882, -0.00038281138203, -0.00007958217070])
-    S2_r[2] = np.array([0.68496829280011, -0.54558176102022, 0.44926662609767, -0.11154849560657, 0.01023294598884])
-    S2_r[3] = np.array([0.04215807391059, 0.40434195078925, -0.15884974959493, 0.04319968814535, -0.00413693825139])
-    S2_r[4] = np.array([0.14015578207913, 0.14407679007180, -0.01310480312503, 0.00362292256563, -0.00034189078786])
-    S2_r[5] = np.array([-0.02549241716294, 0.32153542852101, -0.11409513283836, 0.02617210469576, -0.00221816103608])
-    S2_r[6] = np.array([-0.14490868030324, 0.33629928307361, -0.08223564735018, 0.01023410734015, -0.00027717589598])
-
-    model_params = np.empty(MAX_NUMBER_OF_SULPHUR_ATOMS, dtype=np.ndarray)
-    model_params[0] = S0_r
-    model_params[1] = S1_r
-    model_params[2] = S2_r
-
-    ratio = None
-    if (((1 <= peak_number <= 3) & (((number_of_sulphur == 0) & (498 <= monoisotopic_mass <= 3915)) |
-                                    ((number_of_sulphur == 1) & (530 <= monoisotopic_mass <= 3947)) |
-                                    ((number_of_sulphur == 2) & (562 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 4) & (((number_of_sulphur == 0) & (907 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (939 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (971 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 5) & (((number_of_sulphur == 0) & (1219 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (1251 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (1283 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 6) & (((number_of_sulphur == 0) & (1559 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (1591 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (1623 <= monoisotopic_mass <= 3978))))):
-        beta0 = model_params[number_of_sulphur][peak_number][0]
-        beta1 = model_params[number_of_sulphur][peak_number][1]
-        beta2 = model_params[number_of_sulphur][peak_number][2]
-        beta3 = model_params[number_of_sulphur][peak_number][3]
-        beta4 = model_params[number_of_sulphur][peak_number][4]
-        scaled_m = monoisotopic_mass / 1000.0
-        ratio = beta0 + (beta1*scaled_m) + beta2*(scaled_m**2) + beta3*(scaled_m**3) + beta4*(scaled_m**4)
-    return ratio
-
-# calculate the cosine similarity of two peaks; each DF is assumed to have an 'x' column that reflects the x-axis values, and an 'intensity' column
-def measure_peak_similarity(isotopeA_df, isotopeB_df, x_label, scale):
-    # scale the x axis so we can join them
-    isotopeA_df['x_scaled'] = (isotopeA_df[x_label] * scale).astype(int)
-    isotopeB_df['x_scaled'] = (isotopeB_df[x_label] * scale).astype(int)
-    # combine the isotopes by aligning the x-dimension points they have in common
-    combined_df = pd.merge(isotopeA_df, isotopeB_df, on='x_scaled', how='inner', suffixes=('_A', '_B')).sort_values(by='x_scaled')
-    combined_df = combined_df[['x_scaled','intensity_A','intensity_B']]
-    # calculate the similarity
-    return float(cosine_similarity([combined_df.intensity_A.values], [combined_df.intensity_B.values])) if len(combined_df) > 0 else None
-
-# determine the mono peak apex and extent in CCS and RT and calculate isotopic peak intensities
-def determine_mono_characteristics(envelope, mono_mz_lower, mono_mz_upper, monoisotopic_mass, cuboid_points_df):
-
-    # determine the raw points that belong to the mono peak
-    # we use the wider cuboid points because we want to discover the apex and extent in CCS and RT
-    mono_points_df = cuboid_points_df[(cuboid_points_df.mz >= mono_mz_lower) & (cuboid_points_df.mz <= mono_mz_upper)]
-
-    # determine the peak's extent in CCS and RT
-    if len(mono_points_df) > 0:
-        # collapsing the monoisotopic's summed points onto the mobility dimension
-        scan_df = mono_points_df.groupby(['scan'], as_index=False).intensity.sum()
-        scan_df.sort_values(by=['scan'], ascending=True, inplace=True)
-
-        # apply a smoothing filter to the points
-        scan_df['filtered_intensity'] = scan_df.intensity  # set the default
-        try:
-            scan_df['filtered_intensity'] = signal.savgol_filter(scan_df.intensity, window_length=find_filter_length(number_of_points=len(scan_df)), polyorder=SCAN_FILTER_POLY_ORDER)
-        except:
-            pass
-
-        # find the peak(s)
-        peak_x_l = []
-        try:
-            peak_idxs = peakutils.indexes(scan_df.filtered_intensity.values.astype(int), thres=PEAKS_THRESHOLD_SCAN, min_dist=PEAKS_MIN_DIST_SCAN, thres_abs=False)
-            peak_x_l = scan_df.iloc[peak_idxs].scan.to_list()
-        except:
-            pass
-        if len(peak_x_l) == 0:
-            # if we couldn't find any peaks, take the maximum intensity point
-            peak_x_l = [scan_df.loc[scan_df.filtered_intensity.idxmax()].scan]
-        # peaks_df should now contain the rows from flattened_points_df that represent the peaks
-        peaks_df = scan_df[scan_df.scan.isin(peak_x_l)].copy()
-
-        # find the closest peak to the cuboid midpoint
-        cuboid_midpoint_scan = scan_df.scan.min() + ((scan_df.scan.max() - scan_df.scan.min()) / 2)
-        peaks_df['delta'] = abs(peaks_df.scan - cuboid_midpoint_scan)
-        peaks_df.sort_values(by=['delta'], ascending=True, inplace=True)
-        scan_apex = peaks_df.iloc[0].scan
-
-        # find the valleys nearest the scan apex
-        valley_idxs = peakutils.indexes(-scan_df.filtered_intensity.values.astype(int), thres=VALLEYS_THRESHOLD_SCAN, min_dist=VALLEYS_MIN_DIST_SCAN, thres_abs=False)
-        valley_x_l = scan_df.iloc[valley_idxs].scan.to_list()
-        valleys_df = scan_df[scan_df.scan.isin(valley_x_l)]
-
-        upper_x = valleys_df[valleys_df.scan > scan_apex].scan.min()
-        if math.isnan(upper_x):
-            upper_x = scan_df.scan.max()
-        lower_x = valleys_df[valleys_df.scan < scan_apex].scan.max()
-        if math.isnan(lower_x):
-            lower_x = scan_df.scan.min()
-
-        scan_lower = lower_x
-        scan_upper = upper_x
-
-        # constrain the mono points to the CCS extent
-        mono_points_df = mono_points_df[(mono_points_df.scan >= scan_lower) & (mono_points_df.scan <= scan_upper)]
-
-        # in the RT dimension, look wider to find the apex
-        rt_df = mono_points_df.groupby(['frame_id','retention_time_secs'], as_index=False).intensity.sum()
-        rt_df.sort_values(by=['retention_time_secs'], ascending=True, inplace=True)
-
-        # filter the points
-        rt_df['filtered_intensity'] = rt_df.intensity  # set the default
-        try:
-            rt_df['filtered_intensity'] = signal.savgol_filter(rt_df.intensity, window_length=find_filter_length(number_of_points=len(rt_df)), polyorder=RT_FILTER_POLY_ORDER)
-        except:
-            pass
-
-        # find the peak(s)
-        peak_x_l = []
-        try:
-            peak_idxs = peakutils.indexes(rt_df.filtered_intensity.values.astype(int), thres=PEAKS_THRESHOLD_RT, min_dist=PEAKS_MIN_DIST_RT, thres_abs=False)
-            peak_x_l = rt_df.iloc[peak_idxs].retention_time_secs.to_list()
-        except:
-            pass
-        if len(peak_x_l) == 0:
-            # if we couldn't find any peaks, take the maximum intensity point
-            peak_x_l = [rt_df.loc[rt_df.filtered_intensity.idxmax()].retention_time_secs]
-        # peaks_df should now contain the rows from flattened_points_df that represent the peaks
-        peaks_df = rt_df[rt_df.retention_time_secs.isin(peak_x_l)].copy()
-
-        # find the closest peak to the cuboid midpoint
-        cuboid_midpoint_rt = rt_df.retention_time_secs.min() + ((rt_df.retention_time_secs.max() - rt_df.retention_time_secs.min()) / 2)
-        peaks_df['delta'] = abs(peaks_df.retention_time_secs - cuboid_midpoint_rt)
-        peaks_df.sort_values(by=['delta'], ascending=True, inplace=True)
-        rt_apex = peaks_df.iloc[0].retention_time_secs
-
-        # find the valleys nearest the RT apex
-        valley_idxs = peakutils.indexes(-rt_df.filtered_intensity.values.astype(int), thres=VALLEYS_THRESHOLD_RT, min_dist=VALLEYS_MIN_DIST_RT, thres_abs=False)
-        valley_x_l = rt_df.iloc[valley_idxs].retention_time_secs.to_list()
-        valleys_df = rt_df[rt_df.retention_time_secs.isin(valley_x_l)]
-
-        upper_x = valleys_df[valleys_df.retention_time_secs > rt_apex].retention_time_secs.min()
-        if math.isnan(upper_x):
-            upper_x = rt_df.retention_time_secs.max()
-        lower_x = valleys_df[valleys_df.retention_time_secs < rt_apex].retention_time_secs.max()
-        if math.isnan(lower_x):
-            lower_x = rt_df.retention_time_secs.min()
-
-        rt_lower = lower_x
-        rt_upper = upper_x
-
-        # constrain the mono points to the RT extent
-        mono_points_df = mono_points_df[(mono_points_df.retention_time_secs >= rt_lower) & (mono_points_df.retention_time_secs <= rt_upper)]
-
-        # for the whole feature, constrain the raw points to the CCS and RT extent of the monoisotopic peak
-        mono_ccs_rt_extent_df = cuboid_points_df[(cuboid_points_df.scan >= scan_lower) & (cuboid_points_df.scan <= scan_upper) & (cuboid_points_df.retention_time_secs >= rt_lower) & (cuboid_points_df.retention_time_secs <= rt_upper)]
-
-        # calculate the isotope intensities from the constrained raw points
-        isotopes_l = []
-        for idx,isotope in enumerate(envelope):
-            # gather the points that belong to this isotope
-            iso_mz = isotope[0]
-            iso_intensity = isotope[1]
-            iso_mz_delta = calculate_peak_delta(iso_mz)
-            iso_mz_lower = iso_mz - iso_mz_delta
-            iso_mz_upper = iso_mz + iso_mz_delta
-            isotope_df = mono_ccs_rt_extent_df[(mono_ccs_rt_extent_df.mz >= iso_mz_lower) & (mono_ccs_rt_extent_df.mz <= iso_mz_upper)]
-            if len(isotope_df) > 0:
-                # find the intensity by summing the maximum point in the frame closest to the RT apex, and the frame maximums either side
-                frame_maximums_df = isotope_df.groupby(['retention_time_secs'], as_index=False, sort=False).intensity.agg(['max']).reset_index()
-                frame_maximums_df['rt_delta'] = np.abs(frame_maximums_df.retention_time_secs - rt_apex)
-                frame_maximums_df.sort_values(by=['rt_delta'], ascending=True, inplace=True)
-                # sum the maximum intensity and the max intensity of the frame either side in RT
-                summed_intensity = frame_maximums_df[:3]['max'].sum()
-                # are any of the three points in saturation?
-                isotope_in_saturation = (frame_maximums_df[:3]['max'].max() > SATURATION_INTENSITY)
-                # determine the isotope's profile in retention time
-                iso_rt_df = isotope_df.groupby(['retention_time_secs'], as_index=False).intensity.sum()
-                iso_rt_df.sort_values(by=['retention_time_secs'], ascending=True, inplace=True)
-                # measure it's elution similarity with the previous isotope
-                similarity_rt = measure_peak_similarity(pd.read_json(isotopes_l[idx-1]['rt_df']), iso_rt_df, x_label='retention_time_secs', scale=100) if idx > 0 else None
-                # determine the isotope's profile in mobility
-                iso_scan_df = isotope_df.groupby(['scan'], as_index=False).intensity.sum()
-                iso_scan_df.sort_values(by=['scan'], ascending=True, inplace=True)
-                # measure it's elution similarity with the previous isotope
-                similarity_scan = measure_peak_similarity(pd.read_json(isotopes_l[idx-1]['scan_df']), iso_scan_df, x_label='scan', scale=1) if idx > 0 else None
-                # add the isotope to the list
-                isotopes_l.append({'mz':iso_mz, 'mz_lower':iso_mz_lower, 'mz_upper':iso_mz_upper, 'intensity':summed_intensity, 'saturated':isotope_in_saturation, 'rt_df':iso_rt_df.to_json(orient='records'), 'scan_df':iso_scan_df.to_json(orient='records'), 'similarity_rt':similarity_rt, 'similarity_scan':similarity_scan})
-            else:
-                break
-        isotopes_df = pd.DataFrame(isotopes_l)
-
-        # calculate the coelution coefficient for the isotopic peak series
-        coelution_coefficient = isotopes_df.similarity_rt.mean()
-        mobility_coefficient = isotopes_df.similarity_scan.mean()
-
-        # set the summed intensity and m/z to be the default adjusted intensity for all isotopes
-        isotopes_df['inferred_intensity'] = isotopes_df.intensity
-        isotopes_df['inferred'] = False
-
-        # if the mono is saturated and there are non-saturated isotopes to use as a reference...
-        outcome = ''
-        if (isotopes_df.iloc[0].saturated == True):
-            outcome = 'monoisotopic_saturated_adjusted'
-            if (len(isotopes_df[isotopes_df.saturated == False]) > 0):
-                # find the first unsaturated isotope
-                unsaturated_idx = isotopes_df[(isotopes_df.saturated == False)].iloc[0].name
-
-                # using as a reference the most intense isotope that is not in saturation, derive the isotope intensities back to the monoisotopic
-                Hpn = isotopes_df.iloc[unsaturated_idx].intensity
-                for peak_number in reversed(range(1,unsaturated_idx+1)):
-                    # calculate the phr for the next-lower peak
-                    phr = peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
-                    if phr is not None:
-                        Hpn_minus_1 = Hpn / phr
-                        isotopes_df.at[peak_number-1, 'inferred_intensity'] = int(Hpn_minus_1)
-                        isotopes_df.at[peak_number-1, 'inferred'] = True
-                        Hpn = Hpn_minus_1
-                    else:
-                        outcome = 'could_not_calculate_phr'
-                        break
-            else:
-                outcome = 'no_nonsaturated_isotopes'
-        else:
-            outcome = 'monoisotopic_not_saturated'
-
-        # package the result
-        result_d = {}
-        result_d['scan_apex'] = scan_apex
-        result_d['scan_lower'] = scan_lower
-        result_d['scan_upper'] = scan_upper
-        result_d['rt_apex'] = rt_apex
-        result_d['rt_lower'] = rt_lower
-        result_d['rt_upper'] = rt_upper
-        result_d['intensity_without_saturation_correction'] = isotopes_df.iloc[:3].intensity.sum()  # only take the first three isotopes for intensity, as the number of isotopes varies
-        result_d['intensity_with_saturation_correction'] = isotopes_df.iloc[:3].inferred_intensity.sum()
-        result_d['mono_intensity_adjustment_outcome'] = outcome
-        result_d['isotopic_peaks'] = isotopes_df.to_json(orient='records')
-        result_d['coelution_coefficient'] = coelution_coefficient
-        result_d['mobility_coefficient'] = mobility_coefficient
-        result_d['scan_df'] = scan_df.to_json(orient='records')
-        result_d['rt_df'] = rt_df.to_json(orient='records')
-    else:
-        print('found no raw points where the mono peak should be')
-        result_d = None
-    return result_d
-
-# create the bins for mass defect windows in Da space
-def generate_mass_defect_windows(mass_defect_window_da_min, mass_defect_window_da_max):
-    bin_edges_l = []
-    for nominal_mass in range(mass_defect_window_da_min, mass_defect_window_da_max):
-        mass_centre = nominal_mass * 1.00048  # from https://www.ncbi.nlm.nih.gov/pmc/articles/PMC3184890/
-        width = 0.19 + (0.0001 * nominal_mass)
-        lower_mass = mass_centre - (width / 2)
-        upper_mass = mass_centre + (width / 2)
-        bin_edges_l.append((lower_mass, upper_mass))
-    return bin_edges_l
+
+# the library code shared between the scripts is in the repository's base directory
+TFDE_BASE_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(1, TFDE_BASE_DIR)
+from core import raw_cache
+from core import feature_dataset
+from core import mass_defect
+from core import isotope_model
+from core import peaks
+from core import mono_characteristics
+from core import deconvolution_cache as deconvolution_cache_lib
+
+# the ms1 deconvolution parameters; they're part of the deconvolution cache's key
+MS1_DECONVOLUTION_PARAMS = {'use_quick_charge':True, 'averagine':'peptide', 'truncate_after':0.95}
+
+# the stages of the detection that are timed for each ms1 work unit
+DETECTION_STAGES = ['slicing','ms1_descent','ms1_deconvolution','mono_characterisation','ms2_descent','ms2_deconvolution']
+STAGE_TIMING_PERCENTILES = [50,90,99]
+
+# the reasons the pre-screen skips a unit
+PRESCREEN_REASONS = ['too_few_points','low_summed_intensity','below_noise_floor']
+
+# task granularity for detection
+TASKS_PER_WORKER = 4
+MAXIMUM_CUBOIDS_PER_TASK = 100
 
 # resolve the fragment ions for this feature
-# returns a decharged peak list (neutral mass+proton mass, intensity)
-def resolve_fragment_ions(feature_d, ms2_points_df, mass_defect_bins):
+# returns a decharged peak list (neutral mass+proton mass, intensity), and if the detection is being visualised, the
+# ms2 points and the fragment ions before and after the mass defect filter
+def resolve_fragment_ions(feature_d, ms2_points_df, mass_defect_window_edges, visualise):
     vis_d = {}
-    vis_d['ms2_points_l'] = ms2_points_df[['mz','intensity']].to_json(orient='records')
+    if visualise:
+        vis_d['ms2_points_l'] = ms2_points_df[['mz','intensity']].to_json(orient='records')
     # perform intensity descent to resolve peaks
+    stage_start = time.perf_counter()
     raw_points_a = ms2_points_df[['mz','intensity']].to_numpy()
-    peaks_a = intensity_descent(peaks_a=raw_points_a, peak_delta=None)
+    peaks_a = peaks.intensity_descent(peaks_a=raw_points_a, instrument_resolution=INSTRUMENT_RESOLUTION, peak_delta=None, use_numba=args.use_numba)
+    ms2_descent_secs = time.perf_counter() - stage_start
+    stage_start = time.perf_counter()
     # deconvolution
     # for details on deconvolute_peaks see https://mobiusklein.github.io/ms_deisotope/docs/_build/html/deconvolution/deconvolution.html
     # returns a list of DeconvolutedPeak - see https://github.com/mobiusklein/ms_deisotope/blob/bce522a949579a5f54465eab24194eb5693f40ef/ms_deisotope/peak_set.py#L78
@@ -384,23 +68,25 @@ def resolve_fragment_ions(feature_d, ms2_points_df, mass_defect_bins):
         d['neutral_mass'] = round(peak.neutral_mass, 4)
         d['intensity'] = peak.intensity
         deconvoluted_peaks_l.append(d)
-    vis_d['before_fmdw'] = deconvoluted_peaks_l
+    ms2_deconvolution_secs = time.perf_counter() - stage_start
+    if visualise:
+        vis_d['before_fmdw'] = deconvoluted_peaks_l
 
     if args.filter_by_mass_defect:
-        fragment_ions_df = pd.DataFrame(deconvoluted_peaks_l)
-        fragment_ions_df['bin'] = pd.cut(fragment_ions_df.neutral_mass, mass_defect_bins)
-        filtered_fragment_ions_df = fragment_ions_df.dropna(subset = ['bin']).copy()
-        filtered_fragment_ions_df.drop('bin', axis=1, inplace=True)
-        deconvoluted_peaks_l = filtered_fragment_ions_df.to_dict(orient='records')
+        # keep the fragment ions with a neutral mass in a mass defect window
+        neutral_mass_a = np.array([d['neutral_mass'] for d in deconvoluted_peaks_l])
+        in_window_a = mass_defect.in_mass_defect_window(neutral_mass_a, mass_defect_window_edges)
+        deconvoluted_peaks_l = [d for d,in_window in zip(deconvoluted_peaks_l, in_window_a) if in_window]
 
-        vis_d['after_fmdw'] = deconvoluted_peaks_l
+        if visualise:
+            vis_d['after_fmdw'] = deconvoluted_peaks_l
 
         # removed = len(fragment_ions_df) - len(filtered_fragment_ions_df)
         # print('removed {} fragment ions ({}%)'.format(removed, round(removed/len(fragment_ions_df)*100,1)))
-    else:
+    elif visualise:
         vis_d['after_fmdw'] = []
 
-    return {'deconvoluted_peaks_l':deconvoluted_peaks_l, 'vis_d':vis_d}
+    return {'deconvoluted_peaks_l':deconvoluted_peaks_l, 'vis_d':vis_d, 'ms2_descent_secs':ms2_descent_secs, 'ms2_deconvolution_secs':ms2_deconvolution_secs}
 
 # save visualisation data for later analysis of how feature detection works
 def save_visualisation(visualise_d):
@@ -410,22 +96,12 @@ def save_visualisation(visualise_d):
     with open(VIS_FILE, 'wb') as handle:
         pickle.dump(visualise_d, handle)
 
-# prepare the metadata and raw points for the feature detection
-@ray.remote
-def detect_features(cuboid, mass_defect_bins, visualise):
-    # load the raw points for this cuboid
-    wide_ms1_points_df = cuboid['ms1_df']
-    precursor_cuboid = cuboid['precursor_cuboid']
-    # for deconvolution, constrain the CCS and RT dimensions to the fragmentation event
-    fe_ms1_points_df = wide_ms1_points_df[(wide_ms1_points_df.retention_time_secs >= precursor_cuboid.fe_ms1_rt_lower) & (wide_ms1_points_df.retention_time_secs <= precursor_cuboid.fe_ms1_rt_upper) & (wide_ms1_points_df.scan >= precursor_cuboid.fe_scan_lower) & (wide_ms1_points_df.scan <= precursor_cuboid.fe_scan_upper)]
-
-    # intensity descent
-    raw_points_a = fe_ms1_points_df[['mz','intensity']].to_numpy()
-    peaks_a = intensity_descent(peaks_a=raw_points_a, peak_delta=None)
-
-    # deconvolution - see https://mobiusklein.github.io/ms_deisotope/docs/_build/html/deconvolution/deconvolution.html
+# deconvolve the ms1 peaks, a numpy array of [mz,intensity], and collect the candidate features. The envelopes are
+# returned as lists of (mz,intensity) tuples so the result can be cached.
+def deconvolve_ms1_peaks(peaks_a):
+    # see https://mobiusklein.github.io/ms_deisotope/docs/_build/html/deconvolution/deconvolution.html
     ms1_peaks_l = list(map(tuple, peaks_a))
-    deconvoluted_peaks, _priority_targets = deconvolute_peaks(ms1_peaks_l, use_quick_charge=True, averagine=averagine.peptide, truncate_after=0.95)
+    deconvoluted_peaks, _priority_targets = deconvolute_peaks(ms1_peaks_l, use_quick_charge=MS1_DECONVOLUTION_PARAMS['use_quick_charge'], averagine=averagine.peptide, truncate_after=MS1_DECONVOLUTION_PARAMS['truncate_after'])
 
     # collect features from deconvolution
     ms1_deconvoluted_peaks_l = []
@@ -435,49 +111,128 @@ def detect_features(cuboid, mass_defect_bins, visualise):
             mono_peak_mz = peak.mz
             mono_intensity = peak.intensity
             second_peak_mz = peak.envelope[1][0]
-            ms1_deconvoluted_peaks_l.append((mono_peak_mz, second_peak_mz, mono_intensity, peak.score, peak.signal_to_noise, peak.charge, peak.envelope, peak.neutral_mass))
+            envelope_l = [tuple(e) for e in peak.envelope]
+            ms1_deconvoluted_peaks_l.append((mono_peak_mz, second_peak_mz, mono_intensity, peak.score, peak.signal_to_noise, peak.charge, envelope_l, peak.neutral_mass))
+    return ms1_deconvoluted_peaks_l
+
+# decide whether a unit's fragmentation event has too little signal for a feature to be found in it. The noise floor
+# is estimated as the median intensity of the unit's wide ms1 points, most of which are background. Returns the
+# reason the unit should be skipped, or None if it should be processed.
+def prescreen_fragmentation_event(fe_ms1_points_df, wide_ms1_points_df):
+    if (len(fe_ms1_points_df) == 0) or (len(fe_ms1_points_df) < args.prescreen_minimum_points):
+        return 'too_few_points'
+    intensity_a = fe_ms1_points_df.intensity.to_numpy()
+    if intensity_a.sum() < args.prescreen_minimum_summed_intensity:
+        return 'low_summed_intensity'
+    noise_floor = np.median(wide_ms1_points_df.intensity.to_numpy())
+    if intensity_a.max() < (args.prescreen_minimum_signal_to_noise * noise_floor):
+        return 'below_noise_floor'
+    return None
+
+# prepare the metadata and raw points for the feature detection in an ms1 work unit, a DataFrame of the precursor
+# cuboids that share an ms1 region. Unless the cuboids were merged, each unit has a single cuboid. Returns the features,
+# their fragment ions, and the unit's stage timings.
+def detect_features(unit_cuboids_df, raw_d, mass_defect_window_edges, visualise, deconvolution_cache=None):
+    unit_cuboids_l = list(unit_cuboids_df.itertuples())
+    # the time spent in each stage for this unit
+    stage_secs_d = dict.fromkeys(DETECTION_STAGES, 0.0)
+    # load the raw points for this unit
+    stage_start = time.perf_counter()
+    wide_ms1_points_df = load_unit_ms1_points(raw_d, unit_cuboids_df)
+    # for deconvolution, constrain the m/z, CCS and RT dimensions to the cuboids' fragmentation events
+    in_fragmentation_event_a = np.zeros(len(wide_ms1_points_df), dtype=bool)
+    for c in unit_cuboids_l:
+        in_fragmentation_event_a |= (wide_ms1_points_df.mz >= c.wide_mz_lower).to_numpy() & (wide_ms1_points_df.mz < c.wide_mz_upper).to_numpy() & (wide_ms1_points_df.retention_time_secs >= c.fe_ms1_rt_lower).to_numpy() & (wide_ms1_points_df.retention_time_secs <= c.fe_ms1_rt_upper).to_numpy() & (wide_ms1_points_df.scan >= c.fe_scan_lower).to_numpy() & (wide_ms1_points_df.scan <= c.fe_scan_upper).to_numpy()
+    fe_ms1_points_df = wide_ms1_points_df[in_fragmentation_event_a]
+    stage_secs_d['slicing'] += time.perf_counter() - stage_start
+
+    # skip the units whose fragmentation event has too little signal to be worth deconvolving
+    prescreen_reason = prescreen_fragmentation_event(fe_ms1_points_df, wide_ms1_points_df) if args.prescreen else None
+    if prescreen_reason is None:
+        # intensity descent
+        stage_start = time.perf_counter()
+        raw_points_a = fe_ms1_points_df[['mz','intensity']].to_numpy()
+        peaks_a = peaks.intensity_descent(peaks_a=raw_points_a, instrument_resolution=INSTRUMENT_RESOLUTION, peak_delta=None, use_numba=args.use_numba)
+        stage_secs_d['ms1_descent'] += time.perf_counter() - stage_start
+
+        # deconvolution, reusing the result if the same peaks have already been deconvolved
+        stage_start = time.perf_counter()
+        if deconvolution_cache is not None:
+            ms1_deconvoluted_peaks_l = deconvolution_cache_lib.cached_deconvolution(deconvolution_cache, peaks_a, MS1_DECONVOLUTION_PARAMS, deconvolve_ms1_peaks)
+        else:
+            ms1_deconvoluted_peaks_l = deconvolve_ms1_peaks(peaks_a)
+        stage_secs_d['ms1_deconvolution'] += time.perf_counter() - stage_start
+    else:
+        peaks_a = np.array([])
+        ms1_deconvoluted_peaks_l = []
     df = pd.DataFrame(ms1_deconvoluted_peaks_l, columns=['mono_mz','second_peak_mz','intensity','score','SN','charge','envelope','neutral_mass'])
     df.sort_values(by=['score'], ascending=False, inplace=True)
 
     if len(df) > 0:
-        # take the top N scoring features
-        deconvolution_features_df = df.head(n=TARGET_NUMBER_OF_FEATURES_FOR_CUBOID)
+        # take the top N x k scoring features across the whole unit of k cuboids, rather than the top N of each cuboid,
+        # because which cuboid a feature belongs to isn't known until its apex has been found. For an unmerged unit
+        # this is the cuboid's top N. The features are numbered across the unit, and the feature IDs allow up to 99.
+        deconvolution_features_df = df.head(n=min(TARGET_NUMBER_OF_FEATURES_FOR_CUBOID * len(unit_cuboids_l), 99))
+
+        # the ms2 data for each of the unit's cuboids, loaded when it's needed
+        ms2_points_d = {}
 
-        # load the ms2 data for the precursor
-        ms2_points_df = cuboid['ms2_df']
+        # the cuboid's points as arrays, shared by the features found in it
+        stage_start = time.perf_counter()
+        wide_ms1_points_d = mono_characteristics.cuboid_point_arrays(wide_ms1_points_df)
+        stage_secs_d['mono_characterisation'] += time.perf_counter() - stage_start
 
         # determine the feature attributes
         feature_l = []
+        fragment_ions_l = []
+        # the ms2 points and fragment ions of each feature before and after the mass defect filter, for visualisation
+        fmdw_before_after_d = {}
         for idx,row in enumerate(deconvolution_features_df.itertuples()):
             feature_d = {}
             envelope_mono_mz = row.envelope[0][0]
-            mz_delta = calculate_peak_delta(mz=envelope_mono_mz)
+            mz_delta = peaks.calculate_peak_delta(mz=envelope_mono_mz, instrument_resolution=INSTRUMENT_RESOLUTION)
             mono_mz_lower = envelope_mono_mz - mz_delta
             mono_mz_upper = envelope_mono_mz + mz_delta
             feature_d['mono_mz_lower'] = mono_mz_lower
             feature_d['mono_mz_upper'] = mono_mz_upper
-            mono_characteristics_d = determine_mono_characteristics(envelope=row.envelope, mono_mz_lower=mono_mz_lower, mono_mz_upper=mono_mz_upper, monoisotopic_mass=row.neutral_mass, cuboid_points_df=wide_ms1_points_df)
+            stage_start = time.perf_counter()
+            mono_characteristics_d = mono_characteristics.determine_mono_characteristics(envelope=row.envelope, mono_mz_lower=mono_mz_lower, mono_mz_upper=mono_mz_upper, monoisotopic_mass=row.neutral_mass, cuboid_points_d=wide_ms1_points_d, instrument_resolution=INSTRUMENT_RESOLUTION, saturation_intensity=SATURATION_INTENSITY)
+            stage_secs_d['mono_characterisation'] += time.perf_counter() - stage_start
             if mono_characteristics_d is not None:
                 # add the characteristics to the feature dictionary
                 feature_d = {**feature_d, **mono_characteristics_d}
                 feature_d['monoisotopic_mz'] = row.mono_mz
                 feature_d['charge'] = row.charge
-                feature_d['monoisotopic_mass'] = calculate_monoisotopic_mass_from_mz(monoisotopic_mz=feature_d['monoisotopic_mz'], charge=feature_d['charge'])
+                feature_d['monoisotopic_mass'] = peaks.calculate_monoisotopic_mass_from_mz(monoisotopic_mz=feature_d['monoisotopic_mz'], charge=feature_d['charge'], proton_mass=PROTON_MASS)
                 feature_d['feature_intensity'] = mono_characteristics_d['intensity_with_saturation_correction'] if (args.correct_for_saturation and (mono_characteristics_d['intensity_with_saturation_correction'] > mono_characteristics_d['intensity_without_saturation_correction'])) else mono_characteristics_d['intensity_without_saturation_correction']
                 feature_d['envelope'] = json.dumps([tuple(e) for e in row.envelope])
                 feature_d['isotope_count'] = len(row.envelope)
                 feature_d['deconvolution_score'] = row.score
+                # the feature's fragment ions come from the unit's cuboids whose fragmentation event it's in
+                cuboid_idxs = find_feature_cuboids(unit_cuboids_l, envelope_mono_mz, feature_d['scan_apex'], feature_d['rt_apex'])
+                stage_start = time.perf_counter()
+                for cuboid_idx in cuboid_idxs:
+                    if cuboid_idx not in ms2_points_d:
+                        ms2_points_d[cuboid_idx] = load_ms2_points(raw_d, unit_cuboids_l[cuboid_idx])
+                ms2_points_df = ms2_points_d[cuboid_idxs[0]] if len(cuboid_idxs) == 1 else pd.concat([ms2_points_d[i] for i in cuboid_idxs], axis=0, sort=False, ignore_index=True)
+                stage_secs_d['slicing'] += time.perf_counter() - stage_start
                 # from the precursor cuboid
+                precursor_cuboid = unit_cuboids_l[cuboid_idxs[0]]
                 feature_d['precursor_cuboid_id'] = precursor_cuboid.precursor_cuboid_id
                 # resolve the feature's fragment ions
-                ms2_resolution_d = resolve_fragment_ions(feature_d, ms2_points_df, mass_defect_bins)
-                feature_d['fragment_ions_l'] = json.dumps(ms2_resolution_d['deconvoluted_peaks_l'])
-                feature_d['fmdw_before_after_d'] = ms2_resolution_d['vis_d']
+                ms2_resolution_d = resolve_fragment_ions(feature_d, ms2_points_df, mass_defect_window_edges, visualise)
+                stage_secs_d['ms2_descent'] += ms2_resolution_d['ms2_descent_secs']
+                stage_secs_d['ms2_deconvolution'] += ms2_resolution_d['ms2_deconvolution_secs']
                 # assign a unique identifier to this feature
                 feature_d['feature_id'] = generate_feature_id(precursor_cuboid.precursor_cuboid_id, idx+1)
+                if visualise:
+                    fmdw_before_after_d[feature_d['feature_id']] = ms2_resolution_d['vis_d']
+                # the fragment ions are stored in their own table, keyed by the feature ID
+                fragment_ions_l += [(feature_d['feature_id'], ion['singly_protonated_mass'], ion['neutral_mass'], ion['intensity']) for ion in ms2_resolution_d['deconvoluted_peaks_l']]
                 # add it to the list
                 feature_l.append(feature_d)
         features_df = pd.DataFrame(feature_l)
+        fragment_ions_df = pd.DataFrame(fragment_ions_l, columns=feature_dataset.FRAGMENT_ION_COLUMNS)
 
         # downcast the data types to minimise the memory used
         int_columns = ['scan_lower','scan_upper','intensity_without_saturation_correction','intensity_with_saturation_correction','charge','feature_intensity','isotope_count','precursor_cuboid_id','feature_id']
@@ -487,33 +242,120 @@ def detect_features(cuboid, mass_defect_bins, visualise):
     else:
         deconvolution_features_df = pd.DataFrame()
         features_df = pd.DataFrame()
+        fmdw_before_after_d = {}
+        fragment_ions_df = pd.DataFrame(columns=feature_dataset.FRAGMENT_ION_COLUMNS)
 
     # gather the information for visualisation if required
     if visualise:
         visualisation_d = {
-            'precursor_cuboid_d':precursor_cuboid._asdict(),
+            'precursor_cuboid_d':unit_cuboids_l[0]._asdict(),
             'wide_ms1_points_df':wide_ms1_points_df,
             'fe_ms1_points_df':fe_ms1_points_df,
             'peaks_after_intensity_descent':peaks_a,
             'deconvolution_features_df':deconvolution_features_df,
-            'features_df':features_df
+            'features_df':features_df,
+            'fragment_ions_df':fragment_ions_df,
+            'fmdw_before_after_d':fmdw_before_after_d
         }
         save_visualisation(visualisation_d)
 
-    # print("found {} features for precursor {}".format(len(features_df), precursor_cuboid.precursor_cuboid_id))
-    return features_df
+    # the unit's stage timings, and the size of its data
+    stage_timings_d = {'ms1_unit_id':unit_cuboids_l[0].ms1_unit_id, 'number_of_cuboids':len(unit_cuboids_l), 'number_of_ms1_points':len(wide_ms1_points_df), 'number_of_fe_ms1_points':len(fe_ms1_points_df), 'number_of_ms1_peaks':len(peaks_a), 'number_of_features':len(features_df), 'prescreen_reason':(prescreen_reason if prescreen_reason is not None else '')}
+    for stage in DETECTION_STAGES:
+        stage_timings_d['{}_secs'.format(stage)] = stage_secs_d[stage]
+    stage_timings_d['total_secs'] = sum(stage_secs_d.values())
+
+    # print("found {} features for precursor {}".format(len(features_df), unit_cuboids_l[0].precursor_cuboid_id))
+    return features_df, fragment_ions_df, stage_timings_d
+
+# detect the features in a batch of precursor cuboids, a whole number of ms1 work units. Returns the features and
+# their fragment ions as a DataFrame each, the IDs of the cuboids processed, the task's counts of deconvolution cache
+# hits and misses and of units skipped by the pre-screen for each reason, and the stage timings of its units if
+# they're being traced.
+@ray.remote
+def detect_features_in_cuboids(precursor_cuboids_df, raw_cache_dir, mass_defect_window_edges, visualise, use_deconvolution_cache, deconvolution_cache_dir, trace_stages):
+    raw_d = raw_cache.open_cache(raw_cache_dir)
+    # the worker's deconvolution cache is kept between its tasks; the task reports its own hits and misses
+    deconvolution_cache = deconvolution_cache_lib.open_cache(deconvolution_cache_dir) if use_deconvolution_cache else None
+    counts_before_d = deconvolution_cache.counts() if deconvolution_cache is not None else {'hits':0, 'misses':0}
+    results_l = [detect_features(unit_cuboids_df=unit_cuboids_df, raw_d=raw_d, mass_defect_window_edges=mass_defect_window_edges, visualise=visualise, deconvolution_cache=deconvolution_cache) for _,unit_cuboids_df in precursor_cuboids_df.groupby('ms1_unit_id', sort=False)]
+    features_df = pd.concat([r[0] for r in results_l], axis=0, sort=False, ignore_index=True)
+    fragment_ions_df = pd.concat([r[1] for r in results_l], axis=0, sort=False, ignore_index=True).astype({'feature_id':np.int64, 'singly_protonated_mass':np.float64, 'neutral_mass':np.float64, 'intensity':np.float64})
+    counts_after_d = deconvolution_cache.counts() if deconvolution_cache is not None else {'hits':0, 'misses':0}
+    counts_d = {'deconvolution_cache_{}'.format(k):counts_after_d[k]-counts_before_d[k] for k in counts_after_d}
+    for reason in PRESCREEN_REASONS:
+        counts_d['prescreen_{}'.format(reason)] = sum(1 for r in results_l if r[2]['prescreen_reason'] == reason)
+    stage_timings_df = pd.DataFrame([r[2] for r in results_l]) if trace_stages else None
+    return {'features_df':features_df, 'fragment_ions_df':fragment_ions_df, 'precursor_cuboid_ids':precursor_cuboids_df.precursor_cuboid_id.tolist(), 'counts_d':counts_d, 'stage_timings_df':stage_timings_df}
+
+# add the results of completed tasks to the checkpoint as a part
+def write_features(checkpoint, results_l):
+    features_df = pd.concat([r['features_df'] for r in results_l], axis=0, sort=False, ignore_index=True)
+    features_df['run_name'] = args.run_name
+    fragment_ions_df = pd.concat([r['fragment_ions_df'] for r in results_l], axis=0, sort=False, ignore_index=True)
+    stage_timings_df = pd.concat([r['stage_timings_df'] for r in results_l], axis=0, sort=False, ignore_index=True) if args.trace_stages else None
+    precursor_cuboid_ids_l = [i for r in results_l for i in r['precursor_cuboid_ids']]
+    counts_d = {k:sum(r['counts_d'][k] for r in results_l) for k in results_l[0]['counts_d']}
+    checkpoint.write_part({'features':features_df, 'fragment-ions':fragment_ions_df, 'stage-timings':stage_timings_df}, precursor_cuboid_ids_l, counts_d)
+
+# determine the number of cuboids for each detection task, aiming for several tasks per worker so the load stays balanced
+def cuboids_per_task(number_of_cuboids):
+    if args.cuboids_per_task is not None:
+        return args.cuboids_per_task
+    return max(1, min(math.ceil(number_of_cuboids / (number_of_workers() * TASKS_PER_WORKER)), MAXIMUM_CUBOIDS_PER_TASK))
 
 # determine the number of workers based on the number of available cores and the proportion of the machine to be used
 def number_of_workers():
     number_of_cores = mp.cpu_count()
-    number_of_workers = round(args.proportion_of_cores_to_use * number_of_cores)
+    number_of_workers = max(round(args.proportion_of_cores_to_use * number_of_cores), 1)  # the proportion may be a share of the cores between several runs
     return number_of_workers
 
+# summarise the stage timings of the ms1 work units; prints the percentiles and a histogram of each stage's time, and
+# the slowest units, and returns the summary for the metadata
+def report_stage_timings(stage_timings_df):
+    summary_d = {}
+    total_secs = stage_timings_df.total_secs.sum()
+    # the histogram bins are powers of ten from 10us to 100s
+    bin_edges_a = np.concatenate(([0], np.logspace(-5, 2, 8), [np.inf]))
+    print('stage timings for {} ms1 work units ({} seconds of worker time):'.format(len(stage_timings_df), round(total_secs,1)))
+    for stage in DETECTION_STAGES + ['total']:
+        secs_a = stage_timings_df['{}_secs'.format(stage)].to_numpy()
+        percentiles_a = np.percentile(secs_a, STAGE_TIMING_PERCENTILES)
+        stage_d = {'p{}'.format(p):round(float(v),6) for p,v in zip(STAGE_TIMING_PERCENTILES, percentiles_a)}
+        stage_d['max'] = round(float(secs_a.max()),6)
+        stage_d['total'] = round(float(secs_a.sum()),3)
+        stage_d['proportion_of_total'] = round(float(secs_a.sum() / total_secs),4) if total_secs > 0 else 0.0
+        stage_d['histogram'] = np.histogram(secs_a, bins=bin_edges_a)[0].tolist()
+        summary_d[stage] = stage_d
+        print('  {:<22} {}'.format(stage, ', '.join('{} {}'.format(k, v) for k,v in stage_d.items() if k != 'histogram')))
+    summary_d['histogram_bin_edges_secs'] = bin_edges_a[1:-1].tolist()
+    slowest_df = stage_timings_df.nlargest(10, 'total_secs')
+    print('slowest ms1 work units:\n{}'.format(slowest_df.to_string(index=False)))
+    summary_d['slowest_ms1_unit_ids'] = slowest_df.ms1_unit_id.tolist()
+    return summary_d
+
 # generate a unique feature_id from the precursor id and the feature sequence number found for that precursor
 def generate_feature_id(precursor_id, feature_sequence_number):
     feature_id = (precursor_id * 100) + feature_sequence_number  # assumes there will not be more than 99 features found for a precursor
     return feature_id
 
+# load the ms1 raw points in the wide extent of an ms1 work unit's cuboids from the run's raw data cache
+def load_unit_ms1_points(raw_d, unit_cuboids_df):
+    return raw_cache.slice_points(raw_d, rt_lower=unit_cuboids_df.wide_ms1_rt_lower.min(), rt_upper=unit_cuboids_df.wide_ms1_rt_upper.max(), scan_lower=unit_cuboids_df.wide_scan_lower.min(), scan_upper=unit_cuboids_df.wide_scan_upper.max(), frame_type=FRAME_TYPE_MS1, mz_lower=unit_cuboids_df.wide_mz_lower.min(), mz_upper=unit_cuboids_df.wide_mz_upper.max())
+
+# load the ms2 raw points in a precursor cuboid's fragmentation event from the run's raw data cache
+def load_ms2_points(raw_d, row):
+    ms2_frame_indices = raw_cache.frames_in_frame_range(raw_d, frame_lower=row.fe_ms2_frame_lower, frame_upper=row.fe_ms2_frame_upper, frame_type=FRAME_TYPE_MS2)
+    return raw_cache.slice_raw_points(raw_d, ms2_frame_indices, scan_lower=row.fe_scan_lower, scan_upper=row.fe_scan_upper)
+
+# find the indexes of the unit's cuboids whose fragmentation event contains the feature. If none of them do, it's
+# assigned to the cuboid whose fragmentation event is nearest in RT.
+def find_feature_cuboids(unit_cuboids_l, mono_mz, scan_apex, rt_apex):
+    cuboid_idxs = [idx for idx,c in enumerate(unit_cuboids_l) if (c.wide_mz_lower <= mono_mz < c.wide_mz_upper) and (c.fe_scan_lower <= scan_apex <= c.fe_scan_upper) and (c.fe_ms1_rt_lower <= rt_apex <= c.fe_ms1_rt_upper)]
+    if len(cuboid_idxs) == 0:
+        cuboid_idxs = [int(np.argmin([abs(((c.fe_ms1_rt_lower + c.fe_ms1_rt_upper) / 2) - rt_apex) for c in unit_cuboids_l]))]
+    return cuboid_idxs
+
 ###################################
 parser = argparse.ArgumentParser(description='Detect the features in a run\'s precursor cuboids.')
 parser.add_argument('-eb','--experiment_base_dir', type=str, default='./experiments', help='Path to the experiments directory.', required=False)
@@ -527,6 +369,17 @@ parser.add_argument('-rm','--ray_mode', type=str, choices=['local','cluster'], h
 parser.add_argument('-pc','--proportion_of_cores_to_use', type=float, default=0.9, help='Proportion of the machine\'s cores to use for this program.', required=False)
 parser.add_argument('-cs','--correct_for_saturation', action='store_true', help='Correct for saturation when calculating monoisotopic m/z and intensity.')
 parser.add_argument('-fmdw','--filter_by_mass_defect', action='store_true', help='Filter fragment ions by mass defect windows.')
+parser.add_argument('-lbs','--loader_batch_size', type=int, default=500, help='Number of cuboids (or ms1 work units, if the cuboids were merged) to submit for detection at a time.', required=False)
+parser.add_argument('-cpt','--cuboids_per_task', type=int, help='Number of cuboids (or ms1 work units) processed by each detection task. If not specified, it\'s determined from the number of cuboids and workers.', required=False)
+parser.add_argument('-nb','--use_numba', action='store_true', help='Use the numba-compiled kernel for intensity descent.')
+parser.add_argument('-dc','--cache_deconvolution', action='store_true', help='Reuse the ms1 deconvolution results for peak lists that have already been deconvolved.')
+parser.add_argument('-ps','--prescreen', action='store_true', help='Skip the ms1 work units whose fragmentation event has too little signal to yield a feature.')
+parser.add_argument('-psp','--prescreen_minimum_points', type=int, default=10, help='Minimum number of ms1 points in the fragmentation event for the pre-screen.', required=False)
+parser.add_argument('-psi','--prescreen_minimum_summed_intensity', type=int, default=0, help='Minimum summed intensity of the ms1 points in the fragmentation event for the pre-screen.', required=False)
+parser.add_argument('-pssn','--prescreen_minimum_signal_to_noise', type=float, default=0.0, help='Minimum ratio of the most intense ms1 point in the fragmentation event to the noise floor for the pre-screen. The noise floor is estimated as the median intensity of the wide ms1 points.', required=False)
+parser.add_argument('-rs','--resume', action='store_true', help='Resume an interrupted detection from its checkpoint, skipping the cuboids already processed.')
+parser.add_argument('-ts','--trace_stages', action='store_true', help='Time the stages of the detection for each ms1 work unit, writing a trace of the timings and reporting their percentiles.')
+parser.add_argument('-dcd','--deconvolution_cache_dir', type=str, help='Directory for keeping the ms1 deconvolution results between the workers and runs of the detection. If not specified, each worker keeps its results in memory.', required=False)
 args = parser.parse_args()
 
 # Print the arguments for the log
@@ -550,6 +403,11 @@ if not os.path.exists(RAW_DATABASE_NAME):
     print("The raw database is required but doesn't exist: {}".format(RAW_DATABASE_NAME))
     sys.exit(1)
 
+# check numba is available if it's needed
+if args.use_numba and not peaks.NUMBA_AVAILABLE:
+    print("The numba intensity descent kernel was requested but numba is not installed.")
+    sys.exit(1)
+
 # check the INI file exists
 if not os.path.isfile(args.ini_file):
     print("The configuration file doesn't exist: {}".format(args.ini_file))
@@ -599,106 +457,135 @@ if args.precursor_id is not None:
         sys.exit(1)
 
 # set up the output directory
-if not os.path.exists(FEATURES_DIR):
-    os.makedirs(FEATURES_DIR)
+os.makedirs(FEATURES_DIR, exist_ok=True)
+
+# the detection's checkpoint; when resuming, the cuboids it has already processed are skipped. A checkpoint is only
+# resumed with the same settings, so the execution parameters are left out of them.
+settings_d = {k:v for k,v in vars(args).items() if k not in ['resume','ray_mode','proportion_of_cores_to_use','loader_batch_size','cuboids_per_task']}
+with open(args.ini_file, 'rb') as handle:
+    settings_d['ini_file_hash'] = hashlib.sha1(handle.read()).hexdigest()
+checkpoint = feature_dataset.DetectionCheckpoint(feature_dataset.checkpoint_path(FEATURES_DIR, args.experiment_name, args.run_name, 'pasef'), settings_d, args.resume)
+total_number_of_cuboids = len(precursor_cuboids_df)
+if len(checkpoint.processed_ids) > 0:
+    precursor_cuboids_df = precursor_cuboids_df[~precursor_cuboids_df.precursor_cuboid_id.isin(checkpoint.processed_ids)]
+    print('resuming from the checkpoint in {}: {} cuboids were already processed, {} remain'.format(checkpoint.checkpoint_dir, total_number_of_cuboids - len(precursor_cuboids_df), len(precursor_cuboids_df)))
+
+# the cuboids are detected in ms1 work units; if they weren't merged into units when they were defined, each cuboid is its own unit
+if 'ms1_unit_id' in precursor_cuboids_df.columns:
+    precursor_cuboids_df = precursor_cuboids_df.sort_values(by=['ms1_unit_id'], kind='stable')
+else:
+    precursor_cuboids_df = precursor_cuboids_df.assign(ms1_unit_id=precursor_cuboids_df.precursor_cuboid_id)
+# the position of the first cuboid of each unit, and the end of the last
+unit_starts_a = np.append(np.flatnonzero(np.diff(precursor_cuboids_df.ms1_unit_id.to_numpy(), prepend=-1) != 0), len(precursor_cuboids_df))
+number_of_units = len(unit_starts_a) - 1
+if number_of_units < len(precursor_cuboids_df):
+    print('the cuboids are merged into {} ms1 work units'.format(number_of_units))
+
+# the directory for the ms1 deconvolution cache, if it's shared through the file system
+if args.deconvolution_cache_dir is not None:
+    if not args.cache_deconvolution:
+        print("A deconvolution cache directory was specified but the deconvolution cache is not enabled (-dc).")
+        sys.exit(1)
+    DECONVOLUTION_CACHE_DIR = os.path.abspath(args.deconvolution_cache_dir)
+    os.makedirs(DECONVOLUTION_CACHE_DIR, exist_ok=True)
+    print('using the ms1 deconvolution cache {}'.format(DECONVOLUTION_CACHE_DIR))
+else:
+    DECONVOLUTION_CACHE_DIR = None
 
 # set up Ray
 print("setting up Ray")
 if not ray.is_initialized():
+    # the workers need to import the shared library code
+    os.environ['PYTHONPATH'] = os.pathsep.join([TFDE_BASE_DIR] + ([os.environ['PYTHONPATH']] if 'PYTHONPATH' in os.environ else []))
     if args.ray_mode == "cluster":
         ray.init(num_cpus=number_of_workers())
     else:
         ray.init(local_mode=True)
 
-# create the TimsTOF object
-RAW_HDF_FILE = '{}.hdf'.format(args.run_name)
-RAW_HDF_PATH = '{}/{}'.format(RAW_DATABASE_BASE_DIR, RAW_HDF_FILE)
-if not os.path.isfile(RAW_HDF_PATH):
-    print('{} doesn\'t exist so loading the raw data from {}'.format(RAW_HDF_PATH, RAW_DATABASE_NAME))
-    data = alphatims.bruker.TimsTOF(RAW_DATABASE_NAME)
-    print('saving to {}'.format(RAW_HDF_PATH))
-    _ = data.save_as_hdf(
-        directory=RAW_DATABASE_BASE_DIR,
-        file_name=RAW_HDF_FILE,
-        overwrite=True
-    )
-else:
-    print('loading raw data from {}'.format(RAW_HDF_PATH))
-    data = alphatims.bruker.TimsTOF(RAW_HDF_PATH)
-
-print('loading the cuboids')
-cuboids_l = []
-for row in precursor_cuboids_df.itertuples():
-    # load the ms1 points for this cuboid
-    ms1_df = data[
-        {
-            "rt_values": slice(float(row.wide_ms1_rt_lower), float(row.wide_ms1_rt_upper)),
-            "mz_values": slice(float(row.wide_mz_lower), float(row.wide_mz_upper)),
-            "scan_indices": slice(int(row.wide_scan_lower), int(row.wide_scan_upper+1)),
-            "precursor_indices": 0,  # ms1 frames only
-        }
-    ][['mz_values','scan_indices','frame_indices','rt_values','intensity_values']]
-    ms1_df.rename(columns={'mz_values':'mz', 'scan_indices':'scan', 'frame_indices':'frame_id', 'rt_values':'retention_time_secs', 'intensity_values':'intensity'}, inplace=True)
-    # downcast the data types to minimise the memory used
-    int_columns = ['frame_id','scan','intensity']
-    ms1_df[int_columns] = ms1_df[int_columns].apply(pd.to_numeric, downcast="unsigned")
-    float_columns = ['retention_time_secs']
-    ms1_df[float_columns] = ms1_df[float_columns].apply(pd.to_numeric, downcast="float")
-    # load the ms2 points for this cuboid
-    ms2_df = data[
-        {
-            "frame_indices": slice(int(row.fe_ms2_frame_lower), int(row.fe_ms2_frame_upper+1)),
-            "scan_indices": slice(int(row.fe_scan_lower), int(row.fe_scan_upper+1)),
-            "precursor_indices": slice(1, None)  # ms2 frames only
-        }
-    ][['mz_values','scan_indices','frame_indices','rt_values','intensity_values']]
-    ms2_df.rename(columns={'mz_values':'mz', 'scan_indices':'scan', 'frame_indices':'frame_id', 'rt_values':'retention_time_secs', 'intensity_values':'intensity'}, inplace=True)
-    # downcast the data types to minimise the memory used
-    int_columns = ['frame_id','scan','intensity']
-    ms2_df[int_columns] = ms2_df[int_columns].apply(pd.to_numeric, downcast="unsigned")
-    float_columns = ['retention_time_secs']
-    ms2_df[float_columns] = ms2_df[float_columns].apply(pd.to_numeric, downcast="float")
-    # add them to the list
-    cuboids_l.append({'ms1_df':ms1_df, 'ms2_df':ms2_df, 'precursor_cuboid':row})
-del data
+# make sure the run's raw data cache exists; the workers memory-map it and slice each cuboid's points from it, so
+# they share the page cache rather than each holding a copy of the run
+RAW_CACHE_DIR = raw_cache.convert_raw(RAW_DATABASE_BASE_DIR, args.run_name)
+print('using the raw data cache {}'.format(RAW_CACHE_DIR))
 
 # generate the mass defect windows
-mass_defect_bins = pd.IntervalIndex.from_tuples(generate_mass_defect_windows(100, 8000))
-
-# find the features in each precursor cuboid
-print('detecting features')
-features_l = ray.get([detect_features.remote(cuboid=cuboid, mass_defect_bins=mass_defect_bins, visualise=(args.precursor_id is not None)) for cuboid in cuboids_l])
-del cuboids_l[:]
-
-# join the list of dataframes into a single dataframe
-features_df = pd.concat(features_l, axis=0, sort=False, ignore_index=True)
-del features_l[:]
+mass_defect_window_edges = mass_defect.generate_mass_defect_windows(100, 8000)
+mass_defect_window_edges_ref = ray.put(mass_defect_window_edges)
+
+# find the features in each ms1 work unit. The units are grouped into tasks and submitted a batch at a time, and we
+# wait for the earlier tasks to finish before submitting more, so the number of tasks in flight is bounded.
+batch_cuboids_per_task = cuboids_per_task(number_of_units)
+maximum_pending_tasks = max(math.ceil(args.loader_batch_size / batch_cuboids_per_task), 2 * number_of_workers())  # keep all the workers busy
+print('detecting features in batches of {} cuboids, with {} cuboids per task'.format(args.loader_batch_size, batch_cuboids_per_task))
+pending_l = []
+for batch_idx in range(0, number_of_units, args.loader_batch_size):
+    batch_end_idx = min(batch_idx+args.loader_batch_size, number_of_units)
+    for task_idx in range(batch_idx, batch_end_idx, batch_cuboids_per_task):
+        task_end_idx = min(task_idx+batch_cuboids_per_task, batch_end_idx)
+        pending_l.append(detect_features_in_cuboids.remote(precursor_cuboids_df=precursor_cuboids_df.iloc[unit_starts_a[task_idx]:unit_starts_a[task_end_idx]], raw_cache_dir=RAW_CACHE_DIR, mass_defect_window_edges=mass_defect_window_edges_ref, visualise=(args.precursor_id is not None), use_deconvolution_cache=args.cache_deconvolution, deconvolution_cache_dir=DECONVOLUTION_CACHE_DIR, trace_stages=args.trace_stages))
+    # apply back-pressure so at most one batch's tasks (or enough to keep the workers busy) are waiting
+    if len(pending_l) > maximum_pending_tasks:
+        ready_l, pending_l = ray.wait(pending_l, num_returns=len(pending_l)-maximum_pending_tasks)
+        write_features(checkpoint, ray.get(ready_l))
+if len(pending_l) > 0:
+    write_features(checkpoint, ray.get(pending_l))
+
+# gather the checkpoint's parts into the run's files
+FEATURES_FILE = feature_dataset.features_path(FEATURES_DIR, args.experiment_name, args.run_name, 'pasef')
+features_writer = feature_dataset.FeatureDatasetWriter(FEATURES_FILE)
+for features_df in checkpoint.read_parts('features'):
+    features_writer.write(features_df)
 
 # check we got something
-if len(features_df) == 0:
+if features_writer.number_of_rows == 0:
     print('no features were found')
     sys.exit(1)
 
-# add the run name
-features_df['run_name'] = args.run_name
-
-# write out all the features
-chunk_size = 1000
-num_chunks = len(features_df) // chunk_size
-if len(features_df) % chunk_size != 0:
-    num_chunks += 1
-
-FEATURE_CHUNKS_DIR = '{}/chunks'.format(FEATURES_DIR)
-if not os.path.exists(FEATURE_CHUNKS_DIR):
-    os.makedirs(FEATURE_CHUNKS_DIR)
-else:
-    for f in glob.glob('{}/exp-{}-run-{}-features-pasef-*.feather'.format(FEATURE_CHUNKS_DIR, args.experiment_name, args.run_name)):
-        os.remove(f)
-
-print("writing {} features in {} chunks to {}".format(len(features_df), num_chunks, FEATURE_CHUNKS_DIR))
-for i in range(num_chunks):
-    FEATURES_FILE = '{}/exp-{}-run-{}-features-pasef-{:03d}.feather'.format(FEATURE_CHUNKS_DIR, args.experiment_name, args.run_name, i)
-    features_df[i*chunk_size:(i + 1) * chunk_size].reset_index(drop=True).to_feather(FEATURES_FILE)
+features_writer.close()
+print("wrote {} features in {} row groups to {}".format(features_writer.number_of_rows, features_writer.number_of_row_groups, FEATURES_FILE))
+FRAGMENT_IONS_FILE = feature_dataset.fragment_ions_path(FEATURES_DIR, args.experiment_name, args.run_name, 'pasef')
+fragment_ions_writer = feature_dataset.FeatureDatasetWriter(FRAGMENT_IONS_FILE, row_group_size=feature_dataset.FRAGMENT_IONS_ROW_GROUP_SIZE)
+for fragment_ions_df in checkpoint.read_parts('fragment-ions'):
+    fragment_ions_writer.write(fragment_ions_df)
+fragment_ions_writer.close()
+print("wrote {} fragment ions in {} row groups to {}".format(fragment_ions_writer.number_of_rows, fragment_ions_writer.number_of_row_groups, FRAGMENT_IONS_FILE))
+
+# report the distribution of the time taken by each stage, and the units that took the longest
+if args.trace_stages:
+    STAGE_TIMINGS_FILE = feature_dataset.stage_timings_path(FEATURES_DIR, args.experiment_name, args.run_name, 'pasef')
+    stage_timings_writer = feature_dataset.FeatureDatasetWriter(STAGE_TIMINGS_FILE)
+    for stage_timings_df in checkpoint.read_parts('stage-timings'):
+        stage_timings_writer.write(stage_timings_df)
+    stage_timings_writer.close()
+    print("wrote the stage timings for {} ms1 work units to {}".format(stage_timings_writer.number_of_rows, STAGE_TIMINGS_FILE))
+    if stage_timings_writer.number_of_rows > 0:
+        stage_timings_df = feature_dataset.read_features(STAGE_TIMINGS_FILE)
+        info.append(('stage_timings', report_stage_timings(stage_timings_df)))
+
+# the counts over all the parts, including those from before the detection was resumed
+counts_d = checkpoint.counts()
+
+# report how many units the pre-screen skipped; they should be checked against the identifications on benchmark runs
+if args.prescreen:
+    prescreen_skipped_counts_d = {reason:counts_d.get('prescreen_{}'.format(reason), 0) for reason in PRESCREEN_REASONS}
+    number_skipped = sum(prescreen_skipped_counts_d.values())
+    print("the pre-screen skipped {} ms1 work units: {}".format(number_skipped, prescreen_skipped_counts_d))
+    info.append(('prescreen_skipped_units', number_skipped))
+    info.append(('prescreen_skipped_units_by_reason', prescreen_skipped_counts_d))
+
+# report how often the ms1 deconvolution was reused
+if args.cache_deconvolution:
+    deconvolution_cache_hits = counts_d.get('deconvolution_cache_hits', 0)
+    deconvolution_cache_misses = counts_d.get('deconvolution_cache_misses', 0)
+    lookups = deconvolution_cache_hits + deconvolution_cache_misses
+    deconvolution_cache_hit_rate = round(deconvolution_cache_hits / lookups, 4) if lookups > 0 else 0.0
+    print("ms1 deconvolution cache: {} hits, {} misses, hit rate {}".format(deconvolution_cache_hits, deconvolution_cache_misses, deconvolution_cache_hit_rate))
+    info.append(('deconvolution_cache_hits', deconvolution_cache_hits))
+    info.append(('deconvolution_cache_misses', deconvolution_cache_misses))
+    info.append(('deconvolution_cache_hit_rate', deconvolution_cache_hit_rate))
+
+# the run's files are complete, so the checkpoint isn't needed
+info.append(('cuboids_resumed_from_checkpoint', total_number_of_cuboids - len(precursor_cuboids_df)))
+checkpoint.remove()
 
 # write the metadata
 info.append(('total_running_time',round(time.time()-start_run,1)))
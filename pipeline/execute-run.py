@@ -3,6 +3,7 @@ from doit.action import CmdAction
 import datetime
 import time
 import os
+import sys
 from os.path import expanduser
 
 # This is the set of tasks to take a raw instrument database and create a list of peptides
@@ -11,6 +12,9 @@ from os.path import expanduser
 # doit -f ./tfde/pipeline/execute-run.py clean pc=0.8 cs=true fmdw=true en=P3856 rn=P3856_YHE211_1_Slot1-1_1_5104,P3856_YHE211_2_Slot1-1_1_5105,P3856_YHE211_3_Slot1-1_1_5106,P3856_YHE211_4_Slot1-1_1_5107,P3856_YHE211_5_Slot1-1_1_5108,P3856_YHE211_6_Slot1-1_1_5109,P3856_YHE211_7_Slot1-1_1_5110,P3856_YHE211_8_Slot1-1_1_5111,P3856_YHE211_9_Slot1-1_1_5112,P3856_YHE211_10_Slot1-1_1_5113 rl=1650 ru=2200 ff="/home/daryl/tfde/fasta/Human_Yeast_Ecoli.fasta"
 # doit -f ./tfde/pipeline/execute-run.py pc=0.8 cs=true fmdw=true en=P3856 rn=P3856_YHE211_1_Slot1-1_1_5104,P3856_YHE211_2_Slot1-1_1_5105,P3856_YHE211_3_Slot1-1_1_5106,P3856_YHE211_4_Slot1-1_1_5107,P3856_YHE211_5_Slot1-1_1_5108,P3856_YHE211_6_Slot1-1_1_5109,P3856_YHE211_7_Slot1-1_1_5110,P3856_YHE211_8_Slot1-1_1_5111,P3856_YHE211_9_Slot1-1_1_5112,P3856_YHE211_10_Slot1-1_1_5113 rl=1650 ru=2200 ff="/home/daryl/tfde/fasta/Human_Yeast_Ecoli.fasta"
 
+# To process four runs at a time, sharing the cores between them (doit's -n 4 does the same):
+# doit -f ./tfde/pipeline/execute-run.py pc=0.8 pr=4 cs=true fmdw=true en=P3856 rn=P3856_YHE211_1_Slot1-1_1_5104,P3856_YHE211_2_Slot1-1_1_5105,P3856_YHE211_3_Slot1-1_1_5106,P3856_YHE211_4_Slot1-1_1_5107 rl=1650 ru=2200 ff="/home/daryl/tfde/fasta/Human_Yeast_Ecoli.fasta"
+
 # To run a single task, for example 'identify_searched_features':
 # doit -f ./tfde/pipeline/execute-run.py clean identify_searched_features pc=0.8 cs=true fmdw=true en=P3856 rn=P3856_YHE211_1_Slot1-1_1_5104,P3856_YHE211_2_Slot1-1_1_5105,P3856_YHE211_3_Slot1-1_1_5106,P3856_YHE211_4_Slot1-1_1_5107,P3856_YHE211_5_Slot1-1_1_5108,P3856_YHE211_6_Slot1-1_1_5109,P3856_YHE211_7_Slot1-1_1_5110,P3856_YHE211_8_Slot1-1_1_5111,P3856_YHE211_9_Slot1-1_1_5112,P3856_YHE211_10_Slot1-1_1_5113 rl=1650 ru=2200 ff="/home/daryl/tfde/fasta/Human_Yeast_Ecoli.fasta"
 # doit -f ./tfde/pipeline/execute-run.py identify_searched_features pc=0.8 cs=true fmdw=true en=P3856 rn=P3856_YHE211_1_Slot1-1_1_5104,P3856_YHE211_2_Slot1-1_1_5105,P3856_YHE211_3_Slot1-1_1_5106,P3856_YHE211_4_Slot1-1_1_5107,P3856_YHE211_5_Slot1-1_1_5108,P3856_YHE211_6_Slot1-1_1_5109,P3856_YHE211_7_Slot1-1_1_5110,P3856_YHE211_8_Slot1-1_1_5111,P3856_YHE211_9_Slot1-1_1_5112,P3856_YHE211_10_Slot1-1_1_5113 rl=1650 ru=2200 ff="/home/daryl/tfde/fasta/Human_Yeast_Ecoli.fasta"
@@ -32,11 +36,44 @@ config = {
     'rt_upper': get_var('ru', 2200),
     'correct_for_saturation': get_var('cs', 'true'),
     'filter_by_mass_defect': get_var('fmdw', 'true'),
-    'proportion_of_cores_to_use': get_var('pc', 0.8)
+    'merge_cuboids': get_var('mc', 'false'),
+    'proportion_of_cores_to_use': get_var('pc', 0.8),
+    'number_of_search_shards': get_var('ss', 1),
+    'use_peptide_index': get_var('pi', 'false'),
+    'comet_executable': get_var('ce', None),
+    'peptide_index_cache_dir': get_var('pic', None),
+    'number_of_parallel_runs': get_var('pr', None)
     }
 
 print('execution arguments: {}'.format(config))
 
+# the number of processes given with doit's -n option, which overrides num_process, or None if it's not given
+def doit_process_option(argv_l):
+    for idx,arg in enumerate(argv_l):
+        if (arg in ['-n','--process']) and (idx+1 < len(argv_l)):
+            return argv_l[idx+1]
+        if arg.startswith('--process='):
+            return arg.split('=', 1)[1]
+        if arg.startswith('-n') and arg[2:].isdigit():
+            return arg[2:]
+    return None
+
+# the per-run tasks are sub-tasks, so doit can process this many runs at a time. It's set with pr, or doit's -n option.
+doit_number_of_processes = doit_process_option(sys.argv[1:])
+if (doit_number_of_processes is not None) and (config['number_of_parallel_runs'] is not None) and (max(int(doit_number_of_processes), 1) != max(int(config['number_of_parallel_runs']), 1)):
+    print("doit's -n {} and pr={} disagree on the number of runs to process at a time; give one of them".format(doit_number_of_processes, config['number_of_parallel_runs']))
+    sys.exit(1)
+if doit_number_of_processes is not None:
+    number_of_parallel_runs = max(int(doit_number_of_processes), 1)
+elif config['number_of_parallel_runs'] is not None:
+    number_of_parallel_runs = max(int(config['number_of_parallel_runs']), 1)
+else:
+    number_of_parallel_runs = 1
+DOIT_CONFIG = {'num_process': number_of_parallel_runs, 'par_type': 'thread'}
+
+# share the proportion of cores between the runs processed at a time, so their Ray pools don't oversubscribe the machine
+config['proportion_of_cores_per_run'] = float(config['proportion_of_cores_to_use']) / number_of_parallel_runs
+
 # the names of the runs to process
 if config['run_names'] is None:
     run_names_l = []
@@ -55,142 +92,165 @@ if config['filter_by_mass_defect'] == 'true':
 else:
     config['fmdw_flag'] = ''
 
+# merge the overlapping precursor cuboids into ms1 work units
+if config['merge_cuboids'] == 'true':
+    config['mc_flag'] = '-mc'
+else:
+    config['mc_flag'] = ''
+
+# search a cached peptide index of the FASTA
+if config['use_peptide_index'] == 'true':
+    # the index is built with Comet, so its executable is required
+    if config['comet_executable'] is None:
+        print("The peptide index is built with Comet, so its executable is required: ce=<path to comet>")
+        sys.exit(1)
+    config['pi_flag'] = '-pi -ce {}'.format(config['comet_executable'])
+    if config['peptide_index_cache_dir'] is not None:
+        config['pi_flag'] += ' -pic {}'.format(config['peptide_index_cache_dir'])
+else:
+    config['pi_flag'] = ''
+
 EXPERIMENT_DIR = "{}/{}".format(config['experiment_base_dir'], config['experiment_name'])
 
 start_run = time.time()
 
 
-####################
-# feature extraction
-####################
-def task_define_precursor_cuboids():
+#########################
+# raw database conversion
+#########################
+def task_convert_raw():
     depend_l = []
-    cmd_l = []
     target_l = []
-    CUBOIDS_DIR = '{}/precursor-cuboids-{}'.format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         # input
         RAW_DATABASE_NAME = "{}/raw-databases/{}.d/analysis.tdf".format(EXPERIMENT_DIR, run_name)
         depend_l.append(RAW_DATABASE_NAME)
-        # command
-        cmd = 'python -u define-precursor-cuboids-pasef.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -rl {rl} -ru {ru} -rm cluster'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], rl=int(config['rt_lower']), ru=int(config['rt_upper']))
-        cmd_l.append(cmd)
         # output
-        CUBOIDS_FILE = '{}/exp-{}-run-{}-precursor-cuboids-{}.feather'.format(CUBOIDS_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        target_l.append(CUBOIDS_FILE)
-
+        RAW_CACHE_METADATA_FILE = "{}/raw-databases/{}.cache/metadata.json".format(EXPERIMENT_DIR, run_name)
+        target_l.append(RAW_CACHE_METADATA_FILE)
+    # command; all the runs are converted in parallel so the downstream tasks never need to convert them
+    cmd = 'python -u convert-raw-databases.py -eb {experiment_base} -en {experiment_name} -rn {run_names}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_names=config['run_names'])
+    # there's no clean action because the conversions are expensive and don't depend on the processing parameters
     return {
         'file_dep': depend_l,
-        'actions': cmd_l,
+        'actions': [cmd],
         'targets': target_l,
-        'clean': ['rm -rf {}'.format(CUBOIDS_DIR)],
         'verbosity': 2
     }
 
+
+####################
+# feature extraction
+####################
+def task_define_precursor_cuboids():
+    CUBOIDS_DIR = '{}/precursor-cuboids-{}'.format(EXPERIMENT_DIR, config['precursor_definition_method'])
+    for run_name in run_names_l:
+        # input
+        RAW_DATABASE_NAME = "{}/raw-databases/{}.d/analysis.tdf".format(EXPERIMENT_DIR, run_name)
+        # command
+        cmd = 'python -u define-precursor-cuboids-pasef.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -rl {rl} -ru {ru} {mc}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], rl=int(config['rt_lower']), ru=int(config['rt_upper']), mc=config['mc_flag'])
+        # output
+        CUBOIDS_FILE = '{}/exp-{}-run-{}-precursor-cuboids-{}.feather'.format(CUBOIDS_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
+
+        yield {
+            'name': run_name,
+            'file_dep': [RAW_DATABASE_NAME],
+            'actions': [cmd],
+            'targets': [CUBOIDS_FILE],
+            'clean': ['rm -f {} {}'.format(CUBOIDS_FILE, CUBOIDS_FILE.replace('.feather','-metadata.json'))],
+            'verbosity': 2
+        }
+
 def task_detect_features():
-    depend_l = []
-    cmd_l = []
-    target_l = []
     CUBOIDS_DIR = "{}/precursor-cuboids-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     FEATURES_DIR = "{}/features-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         CUBOIDS_FILE = '{}/exp-{}-run-{}-precursor-cuboids-{}.feather'.format(CUBOIDS_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        FEATURES_FILE = '{}/chunks/exp-{}-run-{}-features-{}-000.feather'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
+        FEATURES_FILE = '{}/exp-{}-run-{}-features-{}.parquet'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
+        FRAGMENT_IONS_FILE = '{}/exp-{}-run-{}-features-{}-fragment-ions.parquet'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
+        # the detection's other outputs; its stage timings, metadata, and the checkpoint it resumes from
+        STAGE_TIMINGS_FILE = '{}/exp-{}-run-{}-features-{}-stage-timings.parquet'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
+        FEATURES_METADATA_FILE = '{}/exp-{}-run-{}-features-{}.json'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
+        CHECKPOINT_DIR = '{}/exp-{}-run-{}-features-{}-checkpoint'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
         if not os.path.isfile(FEATURES_FILE):
             # input
-            depend_l.append(CUBOIDS_FILE)
-            # command
-            cmd = 'python -u detect-features.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -rm cluster -pc {proportion_of_cores_to_use} -rl {rl} -ru {ru} {cs} {fmdw}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], proportion_of_cores_to_use=config['proportion_of_cores_to_use'], rl=int(config['rt_lower']), ru=int(config['rt_upper']), cs=config['cs_flag'], fmdw=config['fmdw_flag'])
-            cmd_l.append(cmd)
-            # output
-            target_l.append(FEATURES_FILE)
-
-    return {
-        'file_dep': depend_l,
-        'actions': cmd_l,
-        'targets': target_l,
-        'clean': ['rm -rf {}'.format(FEATURES_DIR)],
-        'verbosity': 2
-    }
+            RAW_CACHE_METADATA_FILE = "{}/raw-databases/{}.cache/metadata.json".format(EXPERIMENT_DIR, run_name)
+            # command; each run's Ray pool gets its share of the cores, and a detection that was interrupted is resumed
+            cmd = 'python -u detect-features.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -rm cluster -pc {proportion_of_cores_to_use} -rl {rl} -ru {ru} {cs} {fmdw} -rs'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], proportion_of_cores_to_use=config['proportion_of_cores_per_run'], rl=int(config['rt_lower']), ru=int(config['rt_upper']), cs=config['cs_flag'], fmdw=config['fmdw_flag'])
+
+            yield {
+                'name': run_name,
+                'file_dep': [CUBOIDS_FILE,RAW_CACHE_METADATA_FILE],
+                'actions': [cmd],
+                'targets': [FEATURES_FILE,FRAGMENT_IONS_FILE],
+                'clean': ['rm -rf {} {} {} {} {}'.format(FEATURES_FILE, FRAGMENT_IONS_FILE, STAGE_TIMINGS_FILE, FEATURES_METADATA_FILE, CHECKPOINT_DIR)],
+                'verbosity': 2
+            }
 
 def task_remove_duplicate_features():
-    depend_l = []
-    cmd_l = []
-    target_l = []
     FEATURES_DIR = "{}/features-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         # input
-        FEATURES_FILE = '{}/chunks/exp-{}-run-{}-features-{}-000.feather'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        depend_l.append(FEATURES_FILE)
+        FEATURES_FILE = '{}/exp-{}-run-{}-features-{}.parquet'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
         # command
         cmd = 'python -u remove-duplicate-features.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -pdm {precursor_definition_method}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], precursor_definition_method=config['precursor_definition_method'])
-        cmd_l.append(cmd)
         # output
         FEATURES_DEDUP_FILE = '{}/exp-{}-run-{}-features-{}-dedup.feather'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        target_l.append(FEATURES_DEDUP_FILE)
         # pass-through command (no de-dup)
         # cmd = 'cp {} {}'.format(FEATURES_FILE, FEATURES_DEDUP_FILE)
 
-    return {
-        'file_dep': depend_l,
-        'actions': cmd_l,
-        'targets': target_l,
-        'clean': ['rm -rf {}'.format(FEATURES_DIR)],
-        'verbosity': 2
-    }
+        yield {
+            'name': run_name,
+            'file_dep': [FEATURES_FILE],
+            'actions': [cmd],
+            'targets': [FEATURES_DEDUP_FILE],
+            'clean': ['rm -f {} {}'.format(FEATURES_DEDUP_FILE, FEATURES_DEDUP_FILE.replace('.feather','-metadata.json'))],
+            'verbosity': 2
+        }
 
 ####################
 # initial search
 ####################
 
 def task_render_mgf():
-    depend_l = []
-    cmd_l = []
-    target_l = []
     FEATURES_DIR = '{}/features-{}'.format(EXPERIMENT_DIR, config['precursor_definition_method'])
     MGF_DIR = "{}/mgf-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         # input
         FEATURES_FILE = '{}/exp-{}-run-{}-features-{}-dedup.feather'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        depend_l.append(FEATURES_FILE)
+        FRAGMENT_IONS_FILE = '{}/exp-{}-run-{}-features-{}-fragment-ions.parquet'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
         # command
         cmd = 'python -u render-features-as-mgf.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -pdm {precursor_definition_method}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, precursor_definition_method=config['precursor_definition_method'])
-        cmd_l.append(cmd)
         # output
         MGF_FILE = '{}/exp-{}-run-{}-features-{}.mgf'.format(MGF_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        target_l.append(MGF_FILE)
 
-    return {
-        'file_dep': depend_l,
-        'actions': cmd_l,
-        'targets': target_l,
-        'clean': ['rm -rf {}'.format(MGF_DIR)],
-        'verbosity': 2
-    }
+        yield {
+            'name': run_name,
+            'file_dep': [FEATURES_FILE,FRAGMENT_IONS_FILE],
+            'actions': [cmd],
+            'targets': [MGF_FILE],
+            'clean': True,
+            'verbosity': 2
+        }
 
 def task_search_mgf():
-    depend_l = []
-    cmd_l = []
-    target_l = []
     MGF_DIR = "{}/mgf-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         # input
         MGF_FILE = '{}/exp-{}-run-{}-features-{}.mgf'.format(MGF_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        depend_l.append(MGF_FILE)
         # cmd
-        cmd = 'python -u search-mgf-against-sequence-db.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -ff {fasta_name} -pdm {precursor_definition_method}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], fasta_name=config['fasta_file_name'], precursor_definition_method=config['precursor_definition_method'])
-        cmd_l.append(cmd)
+        cmd = 'python -u search-mgf-against-sequence-db.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -ff {fasta_name} -pdm {precursor_definition_method} -ns {ns} -pc {proportion_of_cores_to_use} {pi}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], fasta_name=config['fasta_file_name'], precursor_definition_method=config['precursor_definition_method'], ns=int(config['number_of_search_shards']), proportion_of_cores_to_use=config['proportion_of_cores_per_run'], pi=config['pi_flag'])
         # output
         comet_output = '{experiment_base}/comet-output-pasef/{run_name}.comet.log.txt'.format(experiment_base=EXPERIMENT_DIR, run_name=run_name)
-        target_l.append(comet_output)
 
-    return {
-        'file_dep': depend_l,
-        'actions': cmd_l,
-        'targets': target_l,
-        'clean': ['rm -rf {experiment_base}/comet-output-pasef'.format(experiment_base=EXPERIMENT_DIR)],
-        'verbosity': 2
-    }
+        yield {
+            'name': run_name,
+            'file_dep': [MGF_FILE],
+            'actions': [cmd],
+            'targets': [comet_output],
+            'clean': ['rm -rf {comet_output_dir}/{run_name}.comet.* {comet_output_dir}/{run_name}-shards'.format(comet_output_dir='{}/comet-output-pasef'.format(EXPERIMENT_DIR), run_name=run_name)],
+            'verbosity': 2
+        }
 
 def task_identify_searched_features():
     depend_l = []
@@ -250,53 +310,44 @@ def task_mass_recalibration():
 ####################
 
 def task_render_mgf_recalibrated():
-    depend_l = []
-    cmd_l = []
-    target_l = []
     FEATURES_DIR = '{}/features-{}'.format(EXPERIMENT_DIR, config['precursor_definition_method'])
     MGF_DIR = "{}/mgf-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         # input
         FEATURES_FILE = '{}/exp-{}-run-{}-features-{}-recalibrated.feather'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        depend_l.append(FEATURES_FILE)
+        FRAGMENT_IONS_FILE = '{}/exp-{}-run-{}-features-{}-fragment-ions.parquet'.format(FEATURES_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
         # command
         cmd = 'python -u render-features-as-mgf.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -pdm {precursor_definition_method} -recal'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, precursor_definition_method=config['precursor_definition_method'])
-        cmd_l.append(cmd)
         # output
         MGF_FILE = '{}/exp-{}-run-{}-features-{}-recalibrated.mgf'.format(MGF_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        target_l.append(MGF_FILE)
 
-    return {
-        'file_dep': depend_l,
-        'actions': cmd_l,
-        'targets': target_l,
-        'clean': ['rm -rf {}'.format(MGF_DIR)],
-        'verbosity': 2
-    }
+        yield {
+            'name': run_name,
+            'file_dep': [FEATURES_FILE,FRAGMENT_IONS_FILE],
+            'actions': [cmd],
+            'targets': [MGF_FILE],
+            'clean': True,
+            'verbosity': 2
+        }
 
 def task_search_mgf_recalibrated():
-    depend_l = []
-    cmd_l = []
-    target_l = []
     MGF_DIR = "{}/mgf-{}".format(EXPERIMENT_DIR, config['precursor_definition_method'])
     for run_name in run_names_l:
         # input
         MGF_FILE = '{}/exp-{}-run-{}-features-{}-recalibrated.mgf'.format(MGF_DIR, config['experiment_name'], run_name, config['precursor_definition_method'])
-        depend_l.append(MGF_FILE)
         # cmd
-        cmd = 'python -u search-mgf-against-sequence-db.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -ff {fasta_name} -pdm {precursor_definition_method} -recal'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], fasta_name=config['fasta_file_name'], precursor_definition_method=config['precursor_definition_method'])
-        cmd_l.append(cmd)
+        cmd = 'python -u search-mgf-against-sequence-db.py -eb {experiment_base} -en {experiment_name} -rn {run_name} -ini {INI_FILE} -ff {fasta_name} -pdm {precursor_definition_method} -recal -ns {ns} -pc {proportion_of_cores_to_use} {pi}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_name=run_name, INI_FILE=config['ini_file'], fasta_name=config['fasta_file_name'], precursor_definition_method=config['precursor_definition_method'], ns=int(config['number_of_search_shards']), proportion_of_cores_to_use=config['proportion_of_cores_per_run'], pi=config['pi_flag'])
         # output
         comet_output = '{experiment_base}/comet-output-pasef-recalibrated/{run_name}.comet.log.txt'.format(experiment_base=EXPERIMENT_DIR, run_name=run_name)
-        target_l.append(comet_output)
 
-    return {
-        'file_dep': depend_l,
-        'actions': cmd_l,
-        'targets': target_l,
-        'clean': ['rm -rf {experiment_base}/comet-output-pasef-recalibrated'.format(experiment_base=EXPERIMENT_DIR)],
-        'verbosity': 2
-    }
+        yield {
+            'name': run_name,
+            'file_dep': [MGF_FILE],
+            'actions': [cmd],
+            'targets': [comet_output],
+            'clean': ['rm -rf {comet_output_dir}/{run_name}.comet.* {comet_output_dir}/{run_name}-shards'.format(comet_output_dir='{}/comet-output-pasef-recalibrated'.format(EXPERIMENT_DIR), run_name=run_name)],
+            'verbosity': 2
+        }
 
 def task_identify_searched_features_recalibrated():
     depend_l = []
@@ -402,6 +453,7 @@ def task_extract_features_for_library_sequences():
         for dim in ['mz','scan','rt']:
             ESTIMATOR_MODEL_FILE_NAME = "{}/run-{}-{}-estimator.pkl".format(COORDINATE_ESTIMATORS_DIR, run_name, dim)
             depend_l.append(ESTIMATOR_MODEL_FILE_NAME)
+        depend_l.append("{}/raw-databases/{}.cache/metadata.json".format(EXPERIMENT_DIR, run_name))
     # cmd
     cmd = 'python -u bulk-extract-sequence-library-features.py -eb {experiment_base} -en {experiment_name} -rn {run_names} -ini {INI_FILE}'.format(experiment_base=config['experiment_base_dir'], experiment_name=config['experiment_name'], run_names=config['run_names'], INI_FILE=config['ini_file'])
     cmd_l.append(cmd)
@@ -11,11 +11,16 @@ import time
 import math
 import multiprocessing as mp
 import json
-import alphatims.bruker
 import sqlite3
 import configparser
 from configparser import ExtendedInterpolation
 
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import raw_cache
+from core import isotope_model
+from core import peaks
+
 
 class FixedDict(object):
     def __init__(self, dictionary):
@@ -53,10 +58,6 @@ def get_ms1_frame_ids(rt_lower, rt_upper):
     ms1_frame_ids = tuple(df.Id)
     return ms1_frame_ids
 
-def calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge):
-    monoisotopic_mass = (monoisotopic_mz * charge) - (PROTON_MASS * charge)
-    return monoisotopic_mass
-
 # takes a numpy array of intensity, and another of mz
 def mz_centroid(_int_f, _mz_f):
     try:
@@ -125,66 +126,6 @@ def calculate_decoy_coordinates(row_as_series):
     (decoy_mz, decoy_scan, decoy_rt) = get_decoy_coordinates(estimated_monoisotopic_mz, estimated_scan_apex, peak_width_scan, estimated_rt_apex, peak_width_rt)
     return {"mono_mz":decoy_mz, "scan_apex":decoy_scan, "rt_apex":decoy_rt}
 
-# Find the ratio of H(peak_number)/H(peak_number-1) for peak_number=1..6
-# peak_number = 0 refers to the monoisotopic peak
-# number_of_sulphur = number of sulphur atoms in the molecule
-#
-# source: Valkenborg et al, "A Model-Based Method for the Prediction of the Isotopic Distribution of Peptides", https://core.ac.uk/download/pdf/82021511.pdf
-def peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur):
-    MAX_NUMBER_OF_SULPHUR_ATOMS = 3
-    MAX_NUMBER_OF_PREDICTED_RATIOS = 6
-
-    S0_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S0_r[1] = np.array([-0.00142320578040, 0.53158267080224, 0.00572776591574, -0.00040226083326, -0.00007968737684])
-    S0_r[2] = np.array([0.06258138406507, 0.24252967352808, 0.01729736525102, -0.00427641490976, 0.00038011211412])
-    S0_r[3] = np.array([0.03092092306220, 0.22353930450345, -0.02630395501009, 0.00728183023772, -0.00073155573939])
-    S0_r[4] = np.array([-0.02490747037406, 0.26363266501679, -0.07330346656184, 0.01876886839392, -0.00176688757979])
-    S0_r[5] = np.array([-0.19423148776489, 0.45952477474223, -0.18163820209523, 0.04173579115885, -0.00355426505742])
-    S0_r[6] = np.array([0.04574408690798, -0.05092121193598, 0.13874539944789, -0.04344815868749, 0.00449747222180])
-
-    S1_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S1_r[1] = np.array([-0.01040584267474, 0.53121149663696, 0.00576913817747, -0.00039325152252, -0.00007954180489])
-    S1_r[2] = np.array([0.37339166598255, -0.15814640001919, 0.24085046064819, -0.06068695741919, 0.00563606634601])
-    S1_r[3] = np.array([0.06969331604484, 0.28154425636993, -0.08121643989151, 0.02372741957255, -0.00238998426027])
-    S1_r[4] = np.array([0.04462649178239, 0.23204790123388, -0.06083969521863, 0.01564282892512, -0.00145145206815])
-    S1_r[5] = np.array([-0.20727547407753, 0.53536509500863, -0.22521649838170, 0.05180965157326, -0.00439750995163])
-    S1_r[6] = np.array([0.27169670700251, -0.37192045082925, 0.31939855191976, -0.08668833166842, 0.00822975581940])
-
-    S2_r = np.empty(MAX_NUMBER_OF_PREDICTED_RATIOS+1, dtype=np.ndarray)
-    S2_r[1] = np.array([-0.01937823810470, 0.53084210514216, 0.00580573751882, -0.00038281138203, -0.00007958217070])
-    S2_r[2] = np.array([0.68496829280011, -0.54558176102022, 0.44926662609767, -0.11154849560657, 0.01023294598884])
-    S2_r[3] = np.array([0.04215807391059, 0.40434195078925, -0.15884974959493, 0.04319968814535, -0.00413693825139])
-    S2_r[4] = np.array([0.14015578207913, 0.14407679007180, -0.01310480312503, 0.00362292256563, -0.00034189078786])
-    S2_r[5] = np.array([-0.02549241716294, 0.32153542852101, -0.11409513283836, 0.02617210469576, -0.00221816103608])
-    S2_r[6] = np.array([-0.14490868030324, 0.33629928307361, -0.08223564735018, 0.01023410734015, -0.00027717589598])
-
-    model_params = np.empty(MAX_NUMBER_OF_SULPHUR_ATOMS, dtype=np.ndarray)
-    model_params[0] = S0_r
-    model_params[1] = S1_r
-    model_params[2] = S2_r
-
-    ratio = None
-    if (((1 <= peak_number <= 3) & (((number_of_sulphur == 0) & (498 <= monoisotopic_mass <= 3915)) |
-                                    ((number_of_sulphur == 1) & (530 <= monoisotopic_mass <= 3947)) |
-                                    ((number_of_sulphur == 2) & (562 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 4) & (((number_of_sulphur == 0) & (907 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (939 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (971 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 5) & (((number_of_sulphur == 0) & (1219 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (1251 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (1283 <= monoisotopic_mass <= 3978)))) |
-       ((peak_number == 6) & (((number_of_sulphur == 0) & (1559 <= monoisotopic_mass <= 3915)) |
-                              ((number_of_sulphur == 1) & (1591 <= monoisotopic_mass <= 3947)) |
-                              ((number_of_sulphur == 2) & (1623 <= monoisotopic_mass <= 3978))))):
-        beta0 = model_params[number_of_sulphur][peak_number][0]
-        beta1 = model_params[number_of_sulphur][peak_number][1]
-        beta2 = model_params[number_of_sulphur][peak_number][2]
-        beta3 = model_params[number_of_sulphur][peak_number][3]
-        beta4 = model_params[number_of_sulphur][peak_number][4]
-        scaled_m = monoisotopic_mass / 1000.0
-        ratio = beta0 + (beta1*scaled_m) + beta2*(scaled_m**2) + beta3*(scaled_m**3) + beta4*(scaled_m**4)
-    return ratio
-
 # assumes the isotope's raw points have already been flattened to a particular dimension (e.g. scan, RT, m/z) and
 # sorted by ascending order in that dimension
 def fit_curve_to_flattened_isotope(flattened_points_df, estimated_apex, estimated_peak_width, maximum_number_of_peaks, isotope_dimension, isotope_number, sequence, charge, run_name):
@@ -452,10 +393,10 @@ def calculate_feature_metrics(isotope_peaks_df, isotope_raw_points_l, estimated_
         feature_metrics['monoisotope_auc_over_isotope_peak_auc_sum'] = None
 
     # calculate the theoretical and observed isotopic peak height ratios
-    monoisotopic_mass = calculate_monoisotopic_mass_from_mz(monoisotopic_mz_centroid, charge)
+    monoisotopic_mass = peaks.calculate_monoisotopic_mass_from_mz(monoisotopic_mz_centroid, charge, proton_mass=PROTON_MASS)
     ratios = []
     for isotope in [1,2]:  # ratio of isotopes 1:0, 2:1
-        expected_ratio = peak_ratio(monoisotopic_mass=monoisotopic_mass, peak_number=isotope, number_of_sulphur=0)
+        expected_ratio = isotope_model.peak_ratio(monoisotopic_mass=monoisotopic_mass, peak_number=isotope, number_of_sulphur=0)
         observed_ratio = isotope_peaks_df.iloc[isotope].summed_intensity / isotope_peaks_df.iloc[isotope-1].summed_intensity
         ratios.append((expected_ratio, observed_ratio))
 
@@ -663,7 +604,7 @@ def calculate_feature_attributes(isotope_raw_points_l, rt_0_metrics, scan_0_metr
     # calculate the monoisotopic m/z and mass
     monoisotopic_points_a = isotope_raw_points_df[isotope_raw_points_df.isotope_idx == 0][['mz','intensity']].to_numpy()
     monoisotopic_mz = mz_centroid(monoisotopic_points_a[:,1], monoisotopic_points_a[:,0])
-    monoisotopic_mass = calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge)
+    monoisotopic_mass = peaks.calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge, proton_mass=PROTON_MASS)
     monoisotopic_mz_delta_ppm = (monoisotopic_mz - estimated_mono_mz) / estimated_mono_mz * 1e6
 
     # infer the intensity of peaks made up of points in saturation
@@ -679,7 +620,7 @@ def calculate_feature_attributes(isotope_raw_points_l, rt_0_metrics, scan_0_metr
             # using as a reference the most intense isotope that is not in saturation, derive the isotope intensities back to the monoisotopic
             Hpn = isotope_intensities_df.iloc[isotope_idx_not_in_saturation].summed_intensity
             for peak_number in reversed(range(1,isotope_idx_not_in_saturation+1)):
-                phr = peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
+                phr = isotope_model.peak_ratio(monoisotopic_mass, peak_number, number_of_sulphur=0)
                 if phr is not None:
                     Hpn_minus_1 = Hpn / phr
                     isotope_intensities_df.at[peak_number-1, 'inferred_intensity'] = int(Hpn_minus_1)
@@ -742,7 +683,7 @@ def calculate_feature_attributes(isotope_raw_points_l, rt_0_metrics, scan_0_metr
 
     return feature_attributes
 
-def extract_feature_metrics_at_coords(coordinates_d, data_obj, run_name, sequence, charge, target_mode):
+def extract_feature_metrics_at_coords(coordinates_d, raw_d, run_name, sequence, charge, target_mode):
     feature_metrics_attributes_l = []
 
     estimated_mono_mz = coordinates_d['mono_mz']
@@ -776,20 +717,7 @@ def extract_feature_metrics_at_coords(coordinates_d, data_obj, run_name, sequenc
     isotope_raw_points_l = []
 
     # load the ms1 points for this feature region
-    feature_region_raw_points_df = data_obj[
-        {
-            "rt_values": slice(float(rt_lower), float(rt_upper)),
-            "mz_values": slice(float(feature_region_mz_lower), float(feature_region_mz_upper)),
-            "scan_indices": slice(int(scan_lower), int(scan_upper+1)),
-            "precursor_indices": 0,  # ms1 frames only
-        }
-    ][['mz_values','scan_indices','frame_indices','rt_values','intensity_values']]
-    feature_region_raw_points_df.rename(columns={'mz_values':'mz', 'scan_indices':'scan', 'frame_indices':'frame_id', 'rt_values':'retention_time_secs', 'intensity_values':'intensity'}, inplace=True)
-    # downcast the data types to minimise the memory used
-    int_columns = ['frame_id','scan','intensity']
-    feature_region_raw_points_df[int_columns] = feature_region_raw_points_df[int_columns].apply(pd.to_numeric, downcast="unsigned")
-    float_columns = ['retention_time_secs']
-    feature_region_raw_points_df[float_columns] = feature_region_raw_points_df[float_columns].apply(pd.to_numeric, downcast="float")
+    feature_region_raw_points_df = raw_cache.slice_points(raw_d, rt_lower=float(rt_lower), rt_upper=float(rt_upper), scan_lower=int(scan_lower), scan_upper=int(scan_upper), frame_type=FRAME_TYPE_MS1, mz_lower=float(feature_region_mz_lower), mz_upper=float(feature_region_mz_upper))
 
     MAXIMUM_NUMBER_OF_MONO_RT_PEAKS_FOR_TARGET_MODE = 10
 
@@ -1080,8 +1008,7 @@ def extract_feature_metrics_at_coords(coordinates_d, data_obj, run_name, sequenc
         info_d['feature_metrics_attributes_l'] = feature_metrics_attributes_l
         info_d['selected_peak_index'] = candidate_peak_idx
         DEBUG_DIR = "{}/debug".format(EXPERIMENT_DIR)
-        if not os.path.exists(DEBUG_DIR):
-            os.makedirs(DEBUG_DIR)
+        os.makedirs(DEBUG_DIR, exist_ok=True)
         with open('{}/run-{}-sequence-{}-metrics.json'.format(DEBUG_DIR, run_name, sequence), 'w') as f: 
             json.dump(info_d, fp=f, cls=NpEncoder)
 
@@ -1147,21 +1074,8 @@ if not os.path.exists(RAW_DATABASE_NAME):
     print("The raw database is required but doesn't exist: {}".format(RAW_DATABASE_NAME))
     sys.exit(1)
 
-# create the TimsTOF object
-RAW_HDF_FILE = '{}.hdf'.format(args.run_name)
-RAW_HDF_PATH = '{}/{}'.format(RAW_DATABASE_BASE_DIR, RAW_HDF_FILE)
-if not os.path.isfile(RAW_HDF_PATH):
-    print('{} doesn\'t exist so loading the raw data from {}'.format(RAW_HDF_PATH, RAW_DATABASE_NAME))
-    data = alphatims.bruker.TimsTOF(RAW_DATABASE_NAME)
-    print('saving to {}'.format(RAW_HDF_PATH))
-    _ = data.save_as_hdf(
-        directory=RAW_DATABASE_BASE_DIR,
-        file_name=RAW_HDF_FILE,
-        overwrite=True
-    )
-else:
-    print('loading raw data from {}'.format(RAW_HDF_PATH))
-    data = alphatims.bruker.TimsTOF(RAW_HDF_PATH)
+# open the run's raw data cache
+raw_d = raw_cache.load_raw_data(RAW_DATABASE_BASE_DIR, args.run_name)
 
 # load the MS1 frame IDs
 ms1_frame_properties_df = load_ms1_frame_ids(RAW_DATABASE_NAME)
@@ -1229,7 +1143,7 @@ library_sequences_for_this_run_df['decoy_coords'] = library_sequences_for_this_r
 
 # extract feature metrics from the target coordinates for each sequence in the run
 print("extracting feature metrics from the target coordinates")
-target_metrics_l = [extract_feature_metrics_at_coords(coordinates_d=row.target_coords, data_obj=data, run_name=args.run_name, sequence=row.sequence, charge=row.charge, target_mode=True) for row in library_sequences_for_this_run_df.itertuples()]
+target_metrics_l = [extract_feature_metrics_at_coords(coordinates_d=row.target_coords, raw_d=raw_d, run_name=args.run_name, sequence=row.sequence, charge=row.charge, target_mode=True) for row in library_sequences_for_this_run_df.itertuples()]
 flattened_target_metrics_l = [item for sublist in target_metrics_l for item in sublist]  # target_metrics_l is a list of lists, so we need to flatten it
 target_metrics_df = pd.DataFrame(flattened_target_metrics_l, columns=['sequence','charge','peak_idx','target_metrics','attributes'])
 # merge the target results with the library sequences for this run
@@ -1237,7 +1151,7 @@ library_sequences_with_target_metrics_df = pd.merge(library_sequences_for_this_r
 
 # extract feature metrics from the decoy coordinates for each sequence in the run
 print("extracting feature metrics from the decoy coordinates")
-decoy_metrics_l = [extract_feature_metrics_at_coords(coordinates_d=row.decoy_coords, data_obj=data, run_name=args.run_name, sequence=row.sequence, charge=row.charge, target_mode=False) for row in library_sequences_for_this_run_df.itertuples()]
+decoy_metrics_l = [extract_feature_metrics_at_coords(coordinates_d=row.decoy_coords, raw_d=raw_d, run_name=args.run_name, sequence=row.sequence, charge=row.charge, target_mode=False) for row in library_sequences_for_this_run_df.itertuples()]
 flattened_decoy_metrics_l = [item for sublist in decoy_metrics_l for item in sublist]  # decoy_metrics_l is a list of lists, so we need to flatten it
 decoy_metrics_df = pd.DataFrame(flattened_decoy_metrics_l, columns=['sequence','charge','peak_idx','decoy_metrics','attributes'])
 # don't include the attributes because we're not interested in the decoy's attributes
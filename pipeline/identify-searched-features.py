@@ -7,21 +7,14 @@ import sys
 import pandas as pd
 import configparser
 from configparser import ExtendedInterpolation
-from os.path import expanduser
 import json
 
-# run the command in a shell
-def run_process(process):
-    print("Executing: {}".format(process))
-    exit_status = os.WEXITSTATUS(os.system(process))
-    if exit_status != 0:
-        print('command had an exit status of {}'.format(exit_status))
-    return exit_status
-
-# calculate the monoisotopic mass    
-def calculate_monoisotopic_mass_from_mz(monoisotopic_mz, charge):
-    monoisotopic_mass = (monoisotopic_mz * charge) - (PROTON_MASS * charge)
-    return monoisotopic_mass
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import peaks
+from core import processes
+from core import comet
+from core import feature_dataset
 
 
 ################################
@@ -33,6 +26,7 @@ parser.add_argument('-pe','--protein_enzyme', type=str, default='trypsin', choic
 parser.add_argument('-pdm','--precursor_definition_method', type=str, choices=['pasef','3did'], help='The method used to define the precursor cuboids.', required=True)
 parser.add_argument('-ini','--ini_file', type=str, default='./tfde/pipeline/pasef-process-short-gradient.ini', help='Path to the config file.', required=False)
 parser.add_argument('-recal','--recalibration_mode', action='store_true', help='Use the recalibrated Comet output.')
+parser.add_argument('-pto','--process_timeout', type=int, help='Number of seconds after which Percolator is killed.', required=False)
 args = parser.parse_args()
 
 # Print the arguments for the log
@@ -86,32 +80,44 @@ os.makedirs(PERCOLATOR_OUTPUT_DIR)
 
 # process all the Comet output files in the base directory
 PERCOLATOR_STDOUT_FILE_NAME = "{}/percolator-stdout.log".format(PERCOLATOR_OUTPUT_DIR)
-comet_output_file_list = glob.glob('{}/*.comet.pin'.format(COMET_OUTPUT_DIR))
+comet_output_file_list = sorted(glob.glob('{}/*.comet.pin'.format(COMET_OUTPUT_DIR)))
 if len(comet_output_file_list) == 0:
     print('found no comet input files in {}'.format(COMET_OUTPUT_DIR))
     sys.exit(1)
 else:
     print('found {} comet input files in {}'.format(len(comet_output_file_list), COMET_OUTPUT_DIR))
 
-comet_output_file_list_as_string = ' '.join(map(str, comet_output_file_list))
-cmd = "{}/crux-4.0.Linux.x86_64/bin/crux percolator --overwrite T --subset-max-train 1000000 --klammer F --maxiter 10 --output-dir {} --picked-protein {} --protein T --protein-enzyme {} --search-input auto --verbosity 30 --fileroot {} {} > {} 2>&1".format(expanduser("~"), PERCOLATOR_OUTPUT_DIR, args.fasta_file_name, args.protein_enzyme, args.experiment_name, comet_output_file_list_as_string, PERCOLATOR_STDOUT_FILE_NAME)
-exit_status = run_process(cmd)
-if exit_status != 0:
+# the resource usage of Percolator is recorded in the experiment's log directory
+LOG_DIR = "{}/logs".format(EXPERIMENT_DIR)
+if not os.path.exists(LOG_DIR):
+    os.makedirs(LOG_DIR)
+
+args_l = [processes.crux_executable(), 'percolator', '--overwrite', 'T', '--subset-max-train', 1000000, '--klammer', 'F', '--maxiter', 10, '--output-dir', PERCOLATOR_OUTPUT_DIR, '--picked-protein', args.fasta_file_name, '--protein', 'T', '--protein-enzyme', args.protein_enzyme, '--search-input', 'auto', '--verbosity', 30, '--fileroot', args.experiment_name] + comet_output_file_list
+result = processes.run_command(processes.command(args_l, PERCOLATOR_STDOUT_FILE_NAME, timeout=args.process_timeout), resources_file='{}/processes.jsonl'.format(LOG_DIR))
+if result['exit_status'] != 0:
+    print('percolator failed; its output is in {}'.format(PERCOLATOR_STDOUT_FILE_NAME))
     sys.exit(1)
+info.append(('percolator_wall_secs', result['wall_secs']))
+info.append(('percolator_cpu_secs', round(result['user_cpu_secs']+result['system_cpu_secs'],3)))
+info.append(('percolator_peak_rss_mb', result['peak_rss_mb']))
 
-# determine the mapping between the percolator index and the run file name - this is only available by parsing percolator's stdout redirected to a text file.
+# percolator indexes its input files in the order they're given, and each file's run is recorded in its search's sidecar
 print("Determining the mapping between percolator index and each run")
-mapping = []
+mapping_df = pd.DataFrame([(file_idx, comet.run_name_of_output(f), os.path.basename(f)) for file_idx,f in enumerate(comet_output_file_list)], columns=['file_idx','run_name','comet_output_file'])
+
+# check the order against the index percolator reports assigning to each file, e.g. "INFO: Assigning index 0 to x.comet.pin."
+assigned_d = {}
 with open(PERCOLATOR_STDOUT_FILE_NAME) as f:
-    lines = f.readlines()
-    for line in lines:
+    for line in f:
         if line.startswith('INFO: Assigning index'):
-            splits = line.split(' ')
-            percolator_index = int(splits[3])
-            comet_filename = splits[5]
-            run_name = comet_filename.split('/')[-1].split('.')[0]  # e.g. 190719_Hela_Ecoli_1to3_06
-            mapping.append((percolator_index, run_name))
-mapping_df = pd.DataFrame(mapping, columns=['file_idx','run_name'])
+            splits = line.split()
+            assigned_d[int(splits[3])] = os.path.basename(splits[5].rstrip('.'))
+expected_d = dict(zip(mapping_df.file_idx, mapping_df.comet_output_file))
+if assigned_d != expected_d:
+    print('percolator assigned its file indexes differently from the order of its input files; expected {}, found {} in {}'.format(expected_d, assigned_d, PERCOLATOR_STDOUT_FILE_NAME))
+    sys.exit(1)
+mapping_df.to_json('{}/{}.percolator.file-index.json'.format(PERCOLATOR_OUTPUT_DIR, args.experiment_name), orient='records')
+mapping_df = mapping_df[['file_idx','run_name']]
 
 # load the percolator output
 PERCOLATOR_OUTPUT_FILE_NAME = "{}/{}.percolator.target.psms.txt".format(PERCOLATOR_OUTPUT_DIR, args.experiment_name)
@@ -129,22 +135,20 @@ del mapping_df
 
 # load the detected features
 FEATURES_DIR = '{}/features-{}'.format(EXPERIMENT_DIR, args.precursor_definition_method)
-df_l = []
 if not args.recalibration_mode:
     files_l = glob.glob('{}/exp-{}-run-*-features-*-dedup.feather'.format(FEATURES_DIR, args.experiment_name))
 else:
     files_l = glob.glob('{}/exp-{}-run-*-features-*-recalibrated.feather'.format(FEATURES_DIR, args.experiment_name))
 
+# read just the identified features of each run, and join them with the identifications on the run and feature ID
 print('loading the detected features and merging them with the identifications')
-for f in files_l:
-    df = pd.merge(pd.read_feather(f), percolator_df, how='inner', left_on=['run_name','feature_id'], right_on=['run_name','feature_id'])
-    df_l.append(df)
-identifications_df = pd.concat(df_l, axis=0, sort=False, ignore_index=True)
-del df_l[:]
+features_df = feature_dataset.read_identified_features(files_l, percolator_df[['run_name','feature_id']])
+identifications_df = pd.merge(features_df, percolator_df, how='inner', left_on=['run_name','feature_id'], right_on=['run_name','feature_id'])
+del features_df
 
 # add the mass of cysteine carbamidomethylation to the theoretical peptide mass from percolator, for the fixed modification of carbamidomethyl
 print('calculating mass error for identifications')
-identifications_df['observed_monoisotopic_mass'] = calculate_monoisotopic_mass_from_mz(identifications_df[monoisotopic_mz_column_name], identifications_df.charge)
+identifications_df['observed_monoisotopic_mass'] = peaks.calculate_monoisotopic_mass_from_mz(identifications_df[monoisotopic_mz_column_name], identifications_df.charge, proton_mass=PROTON_MASS)
 identifications_df['theoretical_peptide_mass'] = identifications_df['peptide mass'] + (identifications_df.sequence.str.count('C') * ADD_C_CYSTEINE_DA)
 
 # now we can calculate the difference between the feature's monoisotopic mass and the theoretical peptide mass that is calculated from the 
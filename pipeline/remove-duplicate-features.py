@@ -6,7 +6,11 @@ import configparser
 from configparser import ExtendedInterpolation
 import pandas as pd
 import json
-import glob
+
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import feature_dataset
+from core import duplicates
 
 
 ###################################
@@ -67,19 +71,14 @@ if not os.path.exists(FEATURES_DIR):
 
 if args.precursor_definition_method == 'pasef':
     # check we have some to process
-    FEATURE_CHUNKS_DIR = '{}/chunks'.format(FEATURES_DIR)
-    feature_files = glob.glob('{}/exp-{}-run-{}-features-pasef-*.feather'.format(FEATURE_CHUNKS_DIR, args.experiment_name, args.run_name))
-    if len(feature_files) == 0:
-        print("The features files are required but doesn't exist: {}".format(FEATURE_CHUNKS_DIR))
+    FEATURES_FILE = feature_dataset.features_path(FEATURES_DIR, args.experiment_name, args.run_name, 'pasef')
+    if not os.path.isfile(FEATURES_FILE):
+        print("The features file is required but doesn't exist: {}".format(FEATURES_FILE))
         sys.exit(1)
 
     # load the detected features
-    features_l = []
-    for f in feature_files:
-        features_l.append(pd.read_feather(f))
-    features_df = pd.concat(features_l, axis=0, sort=False, ignore_index=True)
-    print('loaded {} features in {} chunks from {}'.format(len(features_df), len(feature_files), FEATURE_CHUNKS_DIR))
-    del features_l[:]
+    features_df = feature_dataset.read_features(FEATURES_FILE)
+    print('loaded {} features from {}'.format(len(features_df), FEATURES_FILE))
 else:
     FEATURES_IDENT_FILE = '{}/exp-{}-run-{}-features-3did-ident.feather'.format(FEATURES_DIR, args.experiment_name, args.run_name)
     features_df = pd.read_feather(FEATURES_IDENT_FILE)
@@ -117,16 +116,7 @@ if (len(features_df) > 2):
         features_df.sort_values(by=['voxel_id'], ascending=True, ignore_index=True, inplace=True)
 
     # see if any detections have a duplicate
-    keep_l = []
-    features_processed = set()
-    for row in features_df.itertuples():
-        if row.feature_id not in features_processed:
-            df = features_df[(row.charge == features_df.charge) & (row.dup_mz >= features_df.dup_mz_lower) & (row.dup_mz <= features_df.dup_mz_upper) & (row.scan_apex >= features_df.dup_scan_lower) & (row.scan_apex <= features_df.dup_scan_upper) & (row.rt_apex >= features_df.dup_rt_lower) & (row.rt_apex <= features_df.dup_rt_upper)]
-            if (len(df) > 1) and args.verbose_mode:
-                print('{} are duplicates'.format(df.feature_id.tolist()))
-            keep_l.append(row.feature_id)
-            # record the features that have been processed
-            features_processed.update(set(df.feature_id.tolist()))
+    keep_l = duplicates.find_features_to_keep(features_df, mz_tolerance_percent=MZ_TOLERANCE_PERCENT, verbose=args.verbose_mode)
 
     # remove any features that are not in the keep list
     dedup_df = features_df[features_df.feature_id.isin(keep_l)].copy()
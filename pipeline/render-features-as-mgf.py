@@ -1,33 +1,40 @@
-import pandas as pd
 import numpy as np
-import json
 import time
 import argparse
 import os
-from pyteomics import mgf
-
-# collate the feature attributes for MGF rendering
-def collate_spectra_for_feature(feature_d, monoisotopic_mz_column_name, run_name):
-    spectrum = None
-    # sort the fragment ions by increasing m/z
-    fragment_ions_df = pd.DataFrame(json.loads(feature_d['fragment_ions_l']))
-    if len(fragment_ions_df) > 0:
-        fragment_ions_df.sort_values(by=['singly_protonated_mass'], ascending=True, inplace=True)
-
-        spectrum = {}
-        spectrum["m/z array"] = fragment_ions_df['singly_protonated_mass'].to_numpy(dtype='float')
-        spectrum["intensity array"] = fragment_ions_df['intensity'].to_numpy(dtype='uint')
-
-        params = {}
-        params["TITLE"] = "RawFile: {} Charge: {} FeatureIntensity: {} Feature#: {} RtApex: {} Precursor: {}".format(run_name, int(feature_d['charge']), int(feature_d['feature_intensity']), int(feature_d['feature_id']), round(feature_d['rt_apex'],2), int(feature_d['precursor_cuboid_id']))
-        params["INSTRUMENT"] = "ESI-QUAD-TOF"
-        params["PEPMASS"] = "{} {}".format(round(feature_d[monoisotopic_mz_column_name],6), int(feature_d['feature_intensity']))
-        params["CHARGE"] = "{}+".format(int(feature_d['charge']))
-        params["RTINSECONDS"] = "{}".format(round(feature_d['rt_apex'],2))
-        params["SCANS"] = "{}".format(int(feature_d['feature_id']))
-
-        spectrum["params"] = params
-    return spectrum
+import sys
+import shutil
+from multiprocessing import Pool
+import pyarrow.feather as feather
+import pyarrow.compute as pc
+
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import feature_dataset
+from core import mgf
+
+# the number of features rendered at a time
+RENDER_BATCH_SIZE = 10000
+
+# render the spectra of the features in the range [lower,upper) to the file a batch at a time, and return the number of spectra
+def render_features(file_name, lower, upper):
+    number_of_spectra = 0
+    batch_lower = lower
+    with open(file_name, 'w', buffering=1024*1024) as handle:
+        for batch in features_table.slice(lower, upper-lower).to_batches(max_chunksize=RENDER_BATCH_SIZE):
+            batch_upper = batch_lower + batch.num_rows
+            features_d = batch.to_pydict()
+            text, n = mgf.render_spectra(features_d, features_d[monoisotopic_mz_column_name], ions_start_a[batch_lower:batch_upper], ions_end_a[batch_lower:batch_upper], fragment_ions_mz_a, fragment_ions_intensity_a, args.run_name)
+            handle.write(text)
+            number_of_spectra += n
+            batch_lower = batch_upper
+    return number_of_spectra
+
+# render a shard of the features to its own file; the shards are contiguous ranges of the features
+def render_shard(shard_idx):
+    lower = shard_boundaries_a[shard_idx]
+    upper = shard_boundaries_a[shard_idx+1]
+    return render_features(shard_files_l[shard_idx], lower, upper)
 
 
 ###################################
@@ -38,6 +45,7 @@ parser.add_argument('-rn','--run_name', type=str, help='Name of the run.', requi
 parser.add_argument('-pdm','--precursor_definition_method', type=str, choices=['pasef','3did'], help='The method used to define the precursor cuboids.', required=True)
 parser.add_argument('-pid', '--precursor_id', type=int, help='Only process this precursor ID.', required=False)
 parser.add_argument('-recal','--recalibration_mode', action='store_true', help='Use the recalibrated features.')
+parser.add_argument('-ns','--number_of_shards', type=int, default=1, help='Number of shards of the features to render in parallel.', required=False)
 args = parser.parse_args()
 
 # Print the arguments for the log
@@ -69,31 +77,52 @@ else:
 if not os.path.isfile(FEATURES_FILE):
     print("The features file is required but doesn't exist: {}".format(FEATURES_FILE))
 
-# load the features
-features_df = pd.read_feather(FEATURES_FILE)
+# the fragment ions of the detected features
+FRAGMENT_IONS_FILE = feature_dataset.fragment_ions_path(FEATURES_DIR, args.experiment_name, args.run_name, args.precursor_definition_method)
+if not os.path.isfile(FRAGMENT_IONS_FILE):
+    print("The fragment ions file is required but doesn't exist: {}".format(FRAGMENT_IONS_FILE))
+    sys.exit(1)
+
+# load the columns of the features needed for their spectra; the file is memory-mapped, and the features are rendered
+# from it a batch at a time
+features_table = feather.read_table(FEATURES_FILE, columns=mgf.FEATURE_COLUMNS+[monoisotopic_mz_column_name], memory_map=True)
 
 # trim down the features to just those from the specified precursor_id
 if args.precursor_id is not None:
-    features_df = features_df[(features_df.precursor_cuboid_id == args.precursor_id)]
-print('loaded {} features from {}'.format(len(features_df), FEATURES_FILE))
+    features_table = features_table.filter(pc.equal(features_table.column('precursor_cuboid_id'), args.precursor_id))
+print('loaded {} features from {}'.format(features_table.num_rows, FEATURES_FILE))
 
 # set up the output directory
-if not os.path.exists(MGF_DIR):
-    os.makedirs(MGF_DIR)
-
-# associate the spectra with each feature found for this precursor
-associations = []
-for row in features_df.itertuples():
-    # collate them for the MGF
-    spectrum = collate_spectra_for_feature(feature_d=row._asdict(), monoisotopic_mz_column_name=monoisotopic_mz_column_name, run_name=args.run_name)
-    if spectrum is not None:
-        associations.append(spectrum)
-
-# generate the MGF for all the features
-print("writing {} entries to {}".format(len(associations), MGF_FILE))
-if os.path.isfile(MGF_FILE):
-    os.remove(MGF_FILE)
-_ = mgf.write(output=MGF_FILE, spectra=associations)
+os.makedirs(MGF_DIR, exist_ok=True)
+
+# load the fragment ions, and find each feature's ions
+fragment_ions_df = feature_dataset.read_features(FRAGMENT_IONS_FILE, columns=['feature_id','singly_protonated_mass','intensity'])
+print('loaded {} fragment ions from {}'.format(len(fragment_ions_df), FRAGMENT_IONS_FILE))
+fragment_ions_df, ions_start_a, ions_end_a = feature_dataset.group_fragment_ions(fragment_ions_df, features_table.column('feature_id').to_numpy())
+fragment_ions_mz_a = fragment_ions_df.singly_protonated_mass.to_numpy(dtype='float')
+fragment_ions_intensity_a = fragment_ions_df.intensity.to_numpy().astype('uint')
+del fragment_ions_df
+
+# generate the MGF for all the features; it's written to a temporary name and renamed when it's complete
+print("writing the spectra of {} features to {}".format(features_table.num_rows, MGF_FILE))
+temp_mgf_file = '{}-tmp-{}'.format(MGF_FILE, os.getpid())
+number_of_shards = max(min(args.number_of_shards, features_table.num_rows), 1)
+if number_of_shards == 1:
+    number_of_spectra = render_features(temp_mgf_file, 0, features_table.num_rows)
+else:
+    # render the shards in parallel, and join them in order
+    shard_boundaries_a = np.linspace(0, features_table.num_rows, number_of_shards+1).astype(int)
+    shard_files_l = ['{}-shard-{}'.format(temp_mgf_file, shard_idx) for shard_idx in range(number_of_shards)]
+    pool = Pool(processes=number_of_shards)
+    number_of_spectra = sum(pool.map(render_shard, range(number_of_shards)))
+    pool.close()
+    with open(temp_mgf_file, 'wb') as output_handle:
+        for shard_file in shard_files_l:
+            with open(shard_file, 'rb') as shard_handle:
+                shutil.copyfileobj(shard_handle, output_handle, length=16*1024*1024)
+            os.remove(shard_file)
+os.replace(temp_mgf_file, MGF_FILE)
+print("wrote {} spectra to {}".format(number_of_spectra, MGF_FILE))
 
 stop_run = time.time()
 print("total running time ({}): {} seconds".format(parser.prog, round(stop_run-start_run,1)))
@@ -1,19 +1,19 @@
 import os
+import glob
 import time
 import argparse
 import sys
+import shutil
 import configparser
 from configparser import ExtendedInterpolation
-from os.path import expanduser
+import multiprocessing as mp
 
-
-# run the command in a shell
-def run_process(process):
-    print("Executing: {}".format(process))
-    exit_status = os.WEXITSTATUS(os.system(process))
-    if exit_status != 0:
-        print('command had an exit status of {}'.format(exit_status))
-    return exit_status
+# the library code shared between the scripts is in the repository's base directory
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from core import mgf
+from core import comet
+from core import peptide_index
+from core import processes
 
 
 ###########################
@@ -25,6 +25,12 @@ parser.add_argument('-pdm','--precursor_definition_method', type=str, choices=['
 parser.add_argument('-ff','--fasta_file_name', type=str, default='./tfde/fasta/Human_Yeast_Ecoli.fasta', help='File name of the FASTA file.', required=False)
 parser.add_argument('-recal','--recalibration_mode', action='store_true', help='Use the recalibrated MGF.')
 parser.add_argument('-ini','--ini_file', type=str, default='./tfde/pipeline/pasef-process-short-gradient.ini', help='Path to the config file.', required=False)
+parser.add_argument('-ns','--number_of_shards', type=int, default=1, help='Number of shards of the MGF to search with separate Comet processes.', required=False)
+parser.add_argument('-pc','--proportion_of_cores_to_use', type=float, default=0.9, help='Proportion of the machine\'s cores to share between the shards\' searches.', required=False)
+parser.add_argument('-pi','--use_peptide_index', action='store_true', help='Search a peptide index of the FASTA, built once and cached.')
+parser.add_argument('-pic','--peptide_index_cache_dir', type=str, help='Directory for the cached peptide indexes. Defaults to the experiment directory.', required=False)
+parser.add_argument('-ce','--comet_executable', type=str, help='Path to the Comet executable used to build the peptide index.', required=False)
+parser.add_argument('-pto','--process_timeout', type=int, help='Number of seconds after which a search is killed.', required=False)
 args = parser.parse_args()
 
 # Print the arguments for the log
@@ -79,14 +85,103 @@ if not os.path.isfile(MGF_FILE):
     sys.exit(1)
 
 # set up the Comet output directory
-if not os.path.exists(COMET_OUTPUT_DIR):
-    os.makedirs(COMET_OUTPUT_DIR)
-
-# run comet on it
-cmd = "{}/crux-4.0.Linux.x86_64/bin/crux comet --parameter-file {} --output-dir {} --fileroot \"{}\" {} {}".format(expanduser("~"), COMET_PARAM_FILE, COMET_OUTPUT_DIR, args.run_name, MGF_FILE, args.fasta_file_name)
-exit_status = run_process(cmd)
-if exit_status != 0:
-    sys.exit(1)
+os.makedirs(COMET_OUTPUT_DIR, exist_ok=True)
+
+# the external processes' output is logged, and their resource usage recorded, in the experiment's log directory
+LOG_DIR = "{}/logs".format(EXPERIMENT_DIR)
+os.makedirs(LOG_DIR, exist_ok=True)
+LOG_FILE_PREFIX = '{}/search-{}{}'.format(LOG_DIR, args.run_name, '-recalibrated' if args.recalibration_mode else '')
+RESOURCES_FILE = '{}/processes.jsonl'.format(LOG_DIR)
+
+# the sequence database to search; the FASTA, or the peptide index of it
+SEQUENCE_DB = args.fasta_file_name
+if args.use_peptide_index:
+    if args.comet_executable is None:
+        print("The Comet executable is required to build the peptide index.")
+        sys.exit(1)
+    if args.peptide_index_cache_dir is not None:
+        PEPTIDE_INDEX_DIR = args.peptide_index_cache_dir
+    else:
+        PEPTIDE_INDEX_DIR = '{}/peptide-index'.format(EXPERIMENT_DIR)
+    # the index's format depends on the version of Comet that builds it
+    COMET_VERSION = peptide_index.comet_version(args.comet_executable)
+    if COMET_VERSION is None:
+        print("The version of the Comet executable couldn't be determined from its usage: {}".format(args.comet_executable))
+        sys.exit(1)
+    # the index can only be read by the version of Comet that built it, so check crux searches with the same version
+    # before the index is built; if it doesn't, the FASTA is searched
+    CRUX_COMET_VERSION = peptide_index.crux_comet_version(processes.crux_executable(), PEPTIDE_INDEX_DIR)
+    if CRUX_COMET_VERSION != COMET_VERSION:
+        print("The peptide index would be built by Comet {} but crux searches with Comet {}; searching {} instead. Set the Comet executable to the version crux runs to use the index.".format(COMET_VERSION, CRUX_COMET_VERSION, args.fasta_file_name))
+    else:
+        # build the index with Comet's index option; it's written alongside the FASTA
+        build_index = lambda fasta_file, param_file: processes.run_command(processes.command([args.comet_executable, '-P{}'.format(param_file), '-D{}'.format(fasta_file), '-i'], '{}-index.log'.format(LOG_FILE_PREFIX), timeout=args.process_timeout), RESOURCES_FILE)['exit_status']
+        SEQUENCE_DB, index_built = peptide_index.cached_index(args.fasta_file_name, COMET_PARAM_FILE, COMET_VERSION, PEPTIDE_INDEX_DIR, build_index)
+        if SEQUENCE_DB is None:
+            print("The peptide index of {} couldn't be built; the output of Comet {} is in {}-index.log".format(args.fasta_file_name, COMET_VERSION, LOG_FILE_PREFIX))
+            sys.exit(1)
+        print('{} the peptide index {} built by Comet {}'.format('built' if index_built else 'reusing', SEQUENCE_DB, COMET_VERSION))
+
+# the command to run comet on an MGF, optionally limiting its threads; its output is logged to the file
+def comet_command(mgf_file, output_dir, log_file, number_of_threads=None):
+    threads_option_l = ['--num_threads', number_of_threads] if number_of_threads is not None else []
+    args_l = [processes.crux_executable(), 'comet', '--parameter-file', COMET_PARAM_FILE] + threads_option_l + ['--output-dir', output_dir, '--fileroot', args.run_name, mgf_file, SEQUENCE_DB]
+    return processes.command(args_l, log_file, timeout=args.process_timeout)
+
+# don't make more shards than there are spectra
+number_of_shards = args.number_of_shards
+if number_of_shards > 1:
+    number_of_shards = max(min(number_of_shards, mgf.count_spectra(MGF_FILE)), 1)
+
+if number_of_shards == 1:
+    # run comet on it
+    result = processes.run_command(comet_command(MGF_FILE, COMET_OUTPUT_DIR, '{}.log'.format(LOG_FILE_PREFIX)), RESOURCES_FILE)
+    if result['exit_status'] != 0:
+        print('the search failed; its output is in {}'.format(result['stdout_file']))
+        sys.exit(1)
+else:
+    # split the MGF into shards; each is searched in its own directory with the MGF's file name, so the outputs of
+    # the shards have the same names as the output of searching the whole MGF
+    SHARDS_DIR = '{}/{}-shards'.format(COMET_OUTPUT_DIR, args.run_name)
+    if os.path.exists(SHARDS_DIR):
+        shutil.rmtree(SHARDS_DIR)
+    shard_dirs_l = ['{}/shard-{:03d}'.format(SHARDS_DIR, shard_idx) for shard_idx in range(number_of_shards)]
+    for d in shard_dirs_l:
+        os.makedirs(d)
+    shard_mgf_files_l = ['{}/{}'.format(d, os.path.basename(MGF_FILE)) for d in shard_dirs_l]
+    spectra_per_shard_l = mgf.split_mgf(MGF_FILE, shard_mgf_files_l)
+    print('split the {} spectra of {} into {} shards'.format(sum(spectra_per_shard_l), MGF_FILE, number_of_shards))
+
+    # share the cores between the shards; if there are more shards than cores, they wait for a core to be free
+    number_of_cores = max(round(args.proportion_of_cores_to_use * mp.cpu_count()), 1)
+    number_of_concurrent_searches = min(number_of_shards, number_of_cores)
+    threads_per_search = max(number_of_cores // number_of_concurrent_searches, 1)
+    print('searching {} shards at a time with {} threads each'.format(number_of_concurrent_searches, threads_per_search))
+
+    # run comet on the shards
+    commands_l = [comet_command(shard_mgf_files_l[shard_idx], shard_dirs_l[shard_idx], '{}-shard-{:03d}.log'.format(LOG_FILE_PREFIX, shard_idx), threads_per_search) for shard_idx in range(number_of_shards)]
+    results_l = processes.run_commands(commands_l, maximum_concurrent=number_of_concurrent_searches, resources_file=RESOURCES_FILE)
+    failed_l = [result for result in results_l if result['exit_status'] != 0]
+    if len(failed_l) > 0:
+        print('the search of {} of the shards failed; their outputs are in {}, and their logs are {}'.format(len(failed_l), SHARDS_DIR, [result['stdout_file'] for result in failed_l]))
+        sys.exit(1)
+
+    # merge the shards' outputs into the layout of a search of the whole MGF
+    merged_l = comet.merge_shard_outputs(shard_dirs_l, COMET_OUTPUT_DIR)
+    print('merged the shards\' outputs into {}: {}'.format(COMET_OUTPUT_DIR, merged_l))
+    shutil.rmtree(SHARDS_DIR)
+
+# check the search of the index was done by the version of Comet that was found for crux before it started
+if SEQUENCE_DB != args.fasta_file_name:
+    SEARCH_PARAMS_FILE = '{}/{}.comet.params.txt'.format(COMET_OUTPUT_DIR, args.run_name)
+    search_comet_version = peptide_index.params_comet_version(SEARCH_PARAMS_FILE) if os.path.isfile(SEARCH_PARAMS_FILE) else None
+    if search_comet_version != COMET_VERSION:
+        print("The peptide index was built by Comet {} but the search was done by Comet {}, according to {}; set the Comet executable to the version crux runs, or search without the index.".format(COMET_VERSION, search_comet_version, SEARCH_PARAMS_FILE))
+        sys.exit(1)
+
+# record the run each of the search's Percolator inputs is for, so they can be mapped back to the run
+for pin_file in glob.glob('{}/{}.comet*.pin'.format(COMET_OUTPUT_DIR, glob.escape(args.run_name))):
+    comet.write_sidecar(pin_file, args.run_name, MGF_FILE, COMET_PARAM_FILE)
 
 stop_run = time.time()
 print("total running time ({}): {} seconds".format(parser.prog, round(stop_run-start_run,1)))